@@ -0,0 +1,93 @@
+"""Submit resources one request at a time, many of them at once
+
+Each resource is sent as its own create (or update) much like LoadStage does,
+but the requests go out over the FhirSession's pool of keep-alive connections
+and the number in flight is steered by an AimdLimiter: it climbs for as long
+as the server keeps up and falls back as soon as it starts to throttle us,
+error out or slow down.
+
+As with the BatchSubmitter, creates are conditional (If-None-Exist on the
+resource's first identifier) so that resending one the server may already
+have carried out can't create it twice, and a create with nothing to make it
+conditional is only resent when the server was throttling us.
+"""
+
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from include_load.batch import resource_request, safe_to_resend, id_from_location, DEFAULT_MAX_RETRIES
+from include_load.concurrency import run_bounded
+
+def retry_delay(response, attempt):
+    """Honor the server's Retry-After (in seconds) when it sends one"""
+    retry_after = response.headers.get('Retry-After') if response.headers else None
+    try:
+        return min(float(retry_after), 60)
+    except (TypeError, ValueError):
+        return min(2 ** attempt, 30)
+
+class AdaptiveSubmitter:
+    def __init__(self, session, limiter, max_retries=DEFAULT_MAX_RETRIES):
+        self.session = session
+        self.limiter = limiter
+        self.max_retries = max_retries
+        self.log = logging.getLogger(__name__)
+
+    def send(self, body):
+        request = resource_request(body)
+        headers = None
+        if 'ifNoneExist' in request:
+            headers = {"If-None-Exist": request['ifNoneExist']}
+        with self.limiter.slot() as outcome:
+            response = self.session.request(request['method'], request['url'], body, headers=headers)
+            outcome.status = response.status_code
+        return response
+
+    def submit_one(self, entry):
+        """Returns (key, target_id), with a target_id of None if the resource
+        was ultimately rejected"""
+        key, body = entry
+        for attempt in range(self.max_retries + 1):
+            response = self.send(body)
+            if response.ok():
+                target_id = body.get('id')
+                if 'Location' in response.headers:
+                    target_id = id_from_location(response.headers['Location'])
+                elif isinstance(response.body, dict):
+                    target_id = response.body.get('id', target_id)
+                return key, target_id
+
+            if not response.retriable():
+                break
+            if response.status_code != 429 and not safe_to_resend(body):
+                self.log.error(f"Not resending {body['resourceType']} {key}, it has no identifier to keep it from being created twice")
+                break
+            if attempt < self.max_retries:
+                # Tallied by the limiter, under it's lock, since every
+                # worker thread ends up here
+                self.limiter.count_retry()
+                time.sleep(retry_delay(response, attempt))
+
+        self.log.error(f"{resource_request(body)['url']} rejected ({response.status_code}): {response.body}")
+        return key, None
+
+    def submit(self, class_name, entries, on_result):
+        """Submit all of the (key, resource) entries for a class, calling
+        on_result(key, target_id) for each one accepted by the server.
+
+        Returns (submitted, failed)"""
+        submitted = 0
+        failed = 0
+        # The limiter decides how many of these are actually on the wire
+        with ThreadPoolExecutor(max_workers=self.limiter.ceiling) as executor:
+            for key, target_id in run_bounded(executor, self.submit_one, entries, self.limiter.ceiling * 2):
+                if target_id is None:
+                    failed += 1
+                else:
+                    on_result(key, target_id)
+                    submitted += 1
+
+        stats = self.limiter.stats()
+        self.log.info(f"{class_name}: concurrency {stats['limit']} (peak {stats['peak_in_flight']}), {stats['throttled']} throttled, {stats['retries']} retries")
+        return submitted, failed
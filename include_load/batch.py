@@ -0,0 +1,212 @@
+"""Submit resources to the FHIR server as batch (or transaction) bundles
+
+Rather than one request per resource, resources are grouped into Bundles of
+batch_size entries. Each entry's response is mapped back to the key of the
+resource it was built from so the target ID can be cached.
+
+When entries fail for reasons that might not happen a second time (throttling,
+server errors, lost connections) they are split into smaller bundles and tried
+again. A transaction that is rejected outright is split in half repeatedly in
+order to isolate the offending resource(s) and let the rest through.
+
+Given an AimdLimiter, several bundles are kept in flight at once with the
+limiter deciding how many.
+
+A create that timed out or errored may well have been carried out anyway, so
+sending it again could leave a duplicate behind. Creates are therefore
+conditional (ifNoneExist on the resource's first identifier) and only
+those, or updates with an ID, are retried after a failure that the server
+may have acted on. A create with no identifier to make it conditional is
+counted as a failure instead, unless the server said it was throttling us
+(429), which means nothing was done.
+"""
+
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from threading import Lock
+from urllib.parse import quote
+
+from include_load.concurrency import run_bounded
+
+DEFAULT_BATCH_SIZE = 250
+DEFAULT_MAX_RETRIES = 4
+
+def create_condition(body):
+    """The search for a create's ifNoneExist, identifier=system|value of the
+    first identifier that has both, or None if there isn't one"""
+    for identifier in body.get('identifier', []):
+        if identifier.get('system') and identifier.get('value'):
+            return "identifier=" + quote(f"{identifier['system']}|{identifier['value']}", safe='')
+    return None
+
+def resource_request(body):
+    """Updates for resources that already carry an ID, (conditional) creates
+    otherwise"""
+    resource_type = body['resourceType']
+    if body.get('id'):
+        return {"method": "PUT", "url": f"{resource_type}/{body['id']}"}
+    request = {"method": "POST", "url": resource_type}
+    condition = create_condition(body)
+    if condition is not None:
+        request['ifNoneExist'] = condition
+    return request
+
+def safe_to_resend(body):
+    """Can the resource be sent again without risk of creating it twice?"""
+    return bool(body.get('id')) or create_condition(body) is not None
+
+def id_from_location(location):
+    """Patient/123/_history/1 => 123"""
+    parts = location.split("/")
+    if "_history" in parts:
+        parts = parts[:parts.index("_history")]
+    return parts[-1]
+
+def entry_status(response):
+    """The numeric status from a bundle entry's response ("201 Created")"""
+    return int(str(response.get('status', '0')).split(" ")[0])
+
+def chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+class BatchSubmitter:
+    def __init__(self, session, batch_size=DEFAULT_BATCH_SIZE, bundle_type='batch', max_retries=DEFAULT_MAX_RETRIES, limiter=None):
+        assert bundle_type in ('batch', 'transaction'), f"Unknown bundle type {bundle_type}"
+        self.session = session
+        self.batch_size = batch_size
+        self.bundle_type = bundle_type
+        self.max_retries = max_retries
+        self.limiter = limiter
+        self.log = logging.getLogger(__name__)
+
+    def bundle(self, entries):
+        return {
+            "resourceType": "Bundle",
+            "type": self.bundle_type,
+            "entry": [{"resource": body, "request": resource_request(body)} for key, body in entries]
+        }
+
+    def retry_or_fail(self, entries, status):
+        """Split entries that failed with a retriable status into (retry,
+        failed), failing the creates that might have gone through"""
+        if status == 429:
+            return entries, []
+        retry = []
+        failed = []
+        for key, body in entries:
+            if safe_to_resend(body):
+                retry.append((key, body))
+            else:
+                self.log.error(f"Not resending {body['resourceType']} {key} ({status}), it has no identifier to keep it from being created twice")
+                failed.append((key, body))
+        return retry, failed
+
+    def send(self, entries):
+        """Post a single bundle. Returns (results, retry, failed) where results
+        is a list of (key, target_id), retry is the entries worth trying again
+        and failed the entries that were rejected outright"""
+        if self.limiter is None:
+            response = self.session.post("", self.bundle(entries))
+        else:
+            with self.limiter.slot() as outcome:
+                response = self.session.post("", self.bundle(entries))
+                outcome.status = response.status_code
+
+        if not response.ok():
+            if self.bundle_type == 'transaction' and not response.retriable() and len(entries) > 1:
+                # One bad apple spoils the whole transaction, so split it up
+                middle = len(entries) // 2
+                results, retry, failed = self.send(entries[:middle])
+                more = self.send(entries[middle:])
+                return results + more[0], retry + more[1], failed + more[2]
+
+            self.log.warning(f"Bundle of {len(entries)} failed with {response.status_code}: {response.body}")
+            if response.retriable():
+                retry, failed = self.retry_or_fail(entries, response.status_code)
+                return [], retry, failed
+            return [], [], entries
+
+        response_entries = response.body.get('entry') if isinstance(response.body, dict) else None
+        if not isinstance(response_entries, list) or len(response_entries) != len(entries):
+            # The responses can't be matched up with the entries, so there's
+            # no telling which (if any) were accepted
+            self.log.warning(f"Unexpected response to a bundle of {len(entries)}: {response.body}")
+            retry, failed = self.retry_or_fail(entries, response.status_code)
+            return [], retry, failed
+
+        results = []
+        retry = []
+        failed = []
+        for (key, body), entry in zip(entries, response_entries):
+            entry_response = entry.get('response', {}) if isinstance(entry, dict) else {}
+            status = entry_status(entry_response)
+            if 200 <= status < 300:
+                target_id = body.get('id')
+                if 'location' in entry_response:
+                    target_id = id_from_location(entry_response['location'])
+                elif 'resource' in entry:
+                    target_id = entry['resource'].get('id', target_id)
+                results.append((key, target_id))
+            elif status in (408, 409, 429) or status >= 500:
+                entry_retry, entry_failed = self.retry_or_fail([(key, body)], status)
+                retry += entry_retry
+                failed += entry_failed
+            else:
+                self.log.error(f"{resource_request(body)['url']} rejected ({status}): {entry_response.get('outcome')}")
+                failed.append((key, body))
+        return results, retry, failed
+
+    def submit_chunk(self, entries, on_result, attempt=0):
+        """Returns the number of entries that were ultimately rejected"""
+        results, retry, failed = self.send(entries)
+        for key, target_id in results:
+            on_result(key, target_id)
+
+        if len(retry) > 0:
+            if attempt >= self.max_retries:
+                self.log.error(f"Giving up on {len(retry)} entries after {attempt} retries")
+                return len(failed) + len(retry)
+
+            time.sleep(min(2 ** attempt, 30))
+            if len(retry) > 1:
+                middle = len(retry) // 2
+                return len(failed) + \
+                    self.submit_chunk(retry[:middle], on_result, attempt + 1) + \
+                    self.submit_chunk(retry[middle:], on_result, attempt + 1)
+            return len(failed) + self.submit_chunk(retry, on_result, attempt + 1)
+        return len(failed)
+
+    def submit(self, class_name, entries, on_result):
+        """Submit all of the (key, resource) entries for a class, calling
+        on_result(key, target_id) for each one accepted by the server.
+
+        Returns (submitted, failed)"""
+        submitted = 0
+        failed = 0
+        if self.limiter is None:
+            for chunk in chunks(entries, self.batch_size):
+                rejected = self.submit_chunk(chunk, on_result)
+                submitted += len(chunk) - rejected
+                failed += rejected
+            return submitted, failed
+
+        lock = Lock()
+        def locked_result(key, target_id):
+            with lock:
+                on_result(key, target_id)
+
+        def submit_counted(chunk):
+            return len(chunk), self.submit_chunk(chunk, locked_result)
+
+        with ThreadPoolExecutor(max_workers=self.limiter.ceiling) as executor:
+            for size, rejected in run_bounded(executor, submit_counted, chunks(entries, self.batch_size), self.limiter.ceiling * 2):
+                submitted += size - rejected
+                failed += rejected
+        return submitted, failed
@@ -0,0 +1,232 @@
+"""Load a study using the FHIR Bulk Data $import operation
+
+For the first load of a large study, sending each resource along as it's own
+request (or even in batch bundles) is far slower than letting the server
+ingest NDJSON files in bulk. The BulkImporter:
+
+    * builds every class's resources (with the plugin's target classes, just
+      as the ResourceLoader does) into NDJSON files, a set per resource type
+    * assigns each new resource it's ID up front. The IDs are uuid5s of the
+      study, class and key, so rebuilding the files gives the very same IDs
+      and references between resources are known before anything is sent.
+      Anything already in the UID cache keeps the ID the server gave it
+    * makes the files available to the server, either by serving them
+      itself or by pointing at a URL where they have been staged
+    * kicks off $import and polls the status URL until the server is done
+    * reconciles the result, searching for each of the assigned IDs and
+      adding those the server actually has to the UID cache. That way later
+      (incremental) loads with either loader update those resources rather
+      than creating them again
+
+The key and ID assigned to each resource are written to assigned.tsv as the
+files are built, so memory use doesn't grow with the size of the study.
+"""
+
+import csv
+import logging
+import time
+import uuid
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from pathlib import Path
+from threading import Thread
+
+from include_load.loader import ResourceLoader
+from include_load.ndjson import NdjsonWriter
+
+# Namespace for the assigned IDs. Never change this, or previously imported
+# resources will be given new IDs
+ID_NAMESPACE = uuid.UUID("5c9a4e0b-6d2f-4c47-9a55-3f0c6a1e2b7d")
+
+# Seconds between status checks (unless the server asks for something else)
+DEFAULT_POLL_INTERVAL = 5
+# Seconds to wait on the import before giving up
+DEFAULT_IMPORT_TIMEOUT = 6 * 60 * 60
+# IDs searched for at a time while reconciling
+RECONCILE_BATCH_SIZE = 100
+
+def assigned_id(study_id, class_name, key):
+    return str(uuid.uuid5(ID_NAMESPACE, f"{study_id}|{class_name}|{key}"))
+
+def header(response, name):
+    """Case insensitive header lookup"""
+    for header_name, value in response.headers.items():
+        if header_name.lower() == name.lower():
+            return value
+    return None
+
+class AssignedIds:
+    """Stands in for the UID cache while the files are built. Anything that
+    isn't in the UID cache gets it's assigned ID"""
+    def __init__(self, uid_cache, study_id):
+        self.uid_cache = uid_cache
+        self.study_id = study_id
+
+    def get(self, class_name, key):
+        target_id = self.uid_cache.get(class_name, key)
+        if target_id is None:
+            target_id = assigned_id(self.study_id, class_name, key)
+        return target_id
+
+class NdjsonServer:
+    """Serves the NDJSON files over HTTP for the server to fetch"""
+    def __init__(self, directory, host="127.0.0.1", port=0, public_host=None):
+        handler = partial(_QuietHandler, directory=str(directory))
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        # The name the FHIR server knows this machine by, if not host
+        self.public_host = public_host or host
+        self.thread = None
+
+    @property
+    def base_url(self):
+        return f"http://{self.public_host}:{self.httpd.server_address[1]}"
+
+    def start(self):
+        self.thread = Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        logging.getLogger(__name__).debug(format % args)
+
+class BulkImporter:
+    def __init__(self, plugin_path, uid_cache, session, study_id, poll_interval=DEFAULT_POLL_INTERVAL, timeout=DEFAULT_IMPORT_TIMEOUT):
+        self.uid_cache = uid_cache
+        self.session = session
+        self.study_id = study_id
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.loader = ResourceLoader(plugin_path, AssignedIds(uid_cache, study_id), None)
+        self.log = logging.getLogger(__name__)
+
+    def build(self, class_names, basic_reports, directory):
+        """Write the NDJSON files (and assigned.tsv) into directory. Returns
+        the NdjsonWriter's outputs"""
+        directory = Path(directory)
+        ids = self.loader.uid_cache
+        with NdjsonWriter(directory) as writer, open(directory / "assigned.tsv", 'wt', newline='') as f:
+            assigned = csv.writer(f, delimiter='\t')
+            assigned.writerow(['class_name', 'key', 'resource_type', 'id'])
+            for class_name in class_names:
+                written = 0
+                for key, resource in self.loader.prepare(class_name, basic_reports):
+                    # Not every class carries it's ID through target_id_concept
+                    resource['id'] = ids.get(class_name, key)
+                    writer.write(resource)
+                    assigned.writerow([class_name, key, resource['resourceType'], resource['id']])
+                    written += 1
+                print(f"{class_name}: {written} written for import")
+        return writer.outputs
+
+    def parameters(self, base_url, outputs):
+        """The $import request for the files, which are found at base_url"""
+        parameters = [
+            {"name": "inputFormat", "valueCode": "application/fhir+ndjson"},
+            {"name": "inputSource", "valueUri": base_url},
+            {"name": "storageDetail", "part": [{"name": "type", "valueCode": "https"}]}
+        ]
+        for output in outputs:
+            parameters.append({"name": "input", "part": [
+                {"name": "type", "valueCode": output['type']},
+                {"name": "url", "valueUri": f"{base_url.rstrip('/')}/{output['file']}"}
+            ]})
+        return {"resourceType": "Parameters", "parameter": parameters}
+
+    def start(self, base_url, outputs):
+        """Kick off the import. Returns the URL to poll for it's status"""
+        response = self.session.post("$import", self.parameters(base_url, outputs), headers={"Prefer": "respond-async"})
+        status_url = header(response, 'Content-Location')
+        if response.status_code != 202 or status_url is None:
+            raise RuntimeError(f"$import was refused ({response.status_code}): {response.body}")
+        return status_url
+
+    def poll(self, status_url):
+        """Wait for the import to finish. Returns the server's final report"""
+        deadline = time.monotonic() + self.timeout
+        while True:
+            response = self.session.get(status_url)
+            if response.status_code == 200:
+                return response.body
+            if response.status_code != 202 and not response.retriable():
+                raise RuntimeError(f"$import failed ({response.status_code}): {response.body}")
+
+            progress = header(response, 'X-Progress')
+            if progress:
+                print(f"$import: {progress}")
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"$import still hadn't finished after {self.timeout}s ({status_url})")
+            retry_after = header(response, 'Retry-After')
+            time.sleep(float(retry_after) if retry_after and retry_after.isdigit() else self.poll_interval)
+
+    def present(self, resource_type, ids):
+        """The subset of ids the server has for resource_type"""
+        response = self.session.get(f"{resource_type}?_id={','.join(ids)}&_elements=id&_count={len(ids)}")
+        if not response.ok():
+            self.log.error(f"Unable to check {resource_type} IDs ({response.status_code}): {response.body}")
+            return set()
+        return {entry['resource']['id'] for entry in response.body.get('entry', []) if 'resource' in entry}
+
+    def reconcile(self, directory):
+        """Add everything the server now has to the UID cache. Returns
+        {class_name: (loaded, missing)}"""
+        outcome = {}
+
+        def check(batch):
+            resource_type = batch[0][2]
+            found = self.present(resource_type, [target_id for class_name, key, resource_type, target_id in batch])
+            for class_name, key, resource_type, target_id in batch:
+                loaded, missing = outcome.get(class_name, (0, 0))
+                if target_id in found:
+                    self.uid_cache.set(class_name, key, target_id)
+                    outcome[class_name] = (loaded + 1, missing)
+                else:
+                    self.log.error(f"{class_name} {key} ({resource_type}/{target_id}) wasn't imported")
+                    outcome[class_name] = (loaded, missing + 1)
+
+        with open(Path(directory) / "assigned.tsv", 'rt', newline='') as f:
+            rows = csv.reader(f, delimiter='\t')
+            next(rows)
+            batch = []
+            for row in rows:
+                if len(batch) > 0 and (len(batch) >= RECONCILE_BATCH_SIZE or batch[0][2] != row[2]):
+                    check(batch)
+                    batch = []
+                batch.append(row)
+            if len(batch) > 0:
+                check(batch)
+        self.uid_cache.commit()
+        return outcome
+
+    def run(self, class_names, basic_reports, directory, base_url=None, serve=("127.0.0.1", 0), public_host=None):
+        """Build, import and reconcile. If base_url is provided, the files
+        must be staged there (as they are in directory) before the server
+        goes looking for them. Otherwise, they are served from here on
+        serve's (host, port) for the duration of the import"""
+        outputs = self.build(class_names, basic_reports, directory)
+        if len(outputs) == 0:
+            print("Nothing to import")
+            return {}
+
+        server = None
+        if base_url is None:
+            server = NdjsonServer(directory, *serve, public_host=public_host).start()
+            base_url = server.base_url
+        try:
+            print(f"Importing {sum(output['count'] for output in outputs)} resources from {base_url}")
+            report = self.poll(self.start(base_url, outputs))
+        finally:
+            if server is not None:
+                server.stop()
+
+        for error in (report or {}).get('error', []):
+            self.log.error(f"$import reported errors: {error}")
+        outcome = self.reconcile(directory)
+        for class_name, (loaded, missing) in outcome.items():
+            print(f"{class_name}: {loaded} imported, {missing} missing")
+        return outcome
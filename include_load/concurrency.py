@@ -0,0 +1,133 @@
+"""Adaptive control over how many requests are in flight at once
+
+The AimdLimiter works much like TCP congestion control. Every successful,
+reasonably quick response nudges the limit up (by roughly one request per
+"window" of responses) while throttling (429/503), server errors, lost
+connections and responses that are much slower than usual cut the limit
+back down. The limit always stays between floor and ceiling.
+"""
+
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+from contextlib import contextmanager
+
+# Responses slower than this multiple of the baseline latency count as congestion
+DEFAULT_LATENCY_FACTOR = 2.0
+# Smoothing used for the running latency estimate
+EWMA_WEIGHT = 0.1
+
+throttle_codes = set([429, 503])
+
+class AimdLimiter:
+    def __init__(self, floor=1, ceiling=32, initial=None, decrease=0.5, latency_factor=DEFAULT_LATENCY_FACTOR):
+        assert 1 <= floor <= ceiling, "Concurrency floor must be between 1 and the ceiling"
+        self.floor = floor
+        self.ceiling = ceiling
+        self.limit = float(initial or floor)
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+
+        self.in_flight = 0
+        self.latency = None         # Smoothed latency
+        self.baseline = None        # Best smoothed latency seen so far
+        self.last_decrease = 0.0
+        self.condition = threading.Condition()
+
+        self.responses = 0
+        self.throttled = 0
+        self.errors = 0
+        self.retries = 0
+        self.peak = 0
+
+    def current_limit(self):
+        return max(self.floor, min(self.ceiling, int(self.limit)))
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= self.current_limit():
+                self.condition.wait()
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+
+    def back_off(self, factor, now):
+        # Only react once per round trip, otherwise a single burst of
+        # failures would take us all the way to the floor
+        if now - self.last_decrease > (self.latency or 0):
+            self.limit = max(self.floor, self.limit * factor)
+            self.last_decrease = now
+
+    def release(self, latency, status):
+        """Record the outcome of a request. A status of 0 means the request
+        never got a response at all"""
+        now = time.monotonic()
+        with self.condition:
+            self.in_flight -= 1
+            self.responses += 1
+
+            if status in throttle_codes:
+                self.throttled += 1
+                self.back_off(self.decrease, now)
+            elif status == 0 or status >= 500:
+                self.errors += 1
+                self.back_off(self.decrease, now)
+            else:
+                if self.latency is None:
+                    self.latency = latency
+                else:
+                    self.latency = (1 - EWMA_WEIGHT) * self.latency + EWMA_WEIGHT * latency
+                if self.baseline is None or self.latency < self.baseline:
+                    self.baseline = self.latency
+
+                if self.latency > self.baseline * self.latency_factor:
+                    self.back_off(0.9, now)
+                else:
+                    self.limit = min(self.ceiling, self.limit + 1.0 / self.current_limit())
+            self.condition.notify_all()
+
+    def count_retry(self):
+        """Record that a request is about to be resent"""
+        with self.condition:
+            self.retries += 1
+
+    @contextmanager
+    def slot(self):
+        """Hold a slot for the duration of a request. Set .status on the
+        yielded object to the response's status code"""
+        self.acquire()
+        outcome = _Outcome()
+        start = time.monotonic()
+        try:
+            yield outcome
+        finally:
+            self.release(time.monotonic() - start, outcome.status)
+
+    def stats(self):
+        with self.condition:
+            return {
+                'limit': self.current_limit(),
+                'peak_in_flight': self.peak,
+                'responses': self.responses,
+                'throttled': self.throttled,
+                'errors': self.errors,
+                'retries': self.retries,
+                'latency': self.latency
+            }
+
+class _Outcome:
+    status = 0
+
+def run_bounded(executor, func, items, max_pending):
+    """Run func over items using executor, keeping no more than max_pending
+    submitted at a time (so the items don't all end up queued in memory).
+    Yields the results as they complete."""
+    pending = set()
+    for item in items:
+        pending.add(executor.submit(func, item))
+        if len(pending) >= max_pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+    for future in pending:
+        yield future.result()
@@ -0,0 +1,257 @@
+"""Load a study into several environments at once
+
+Loading the same study into dev, qa and prod one after the other means
+reading the transformed tables and having the plugin build every resource
+again for each of them. The only thing that differs from one environment to
+the next are the target IDs: the resource's own ID (if it was loaded there
+before) and those of everything it references.
+
+So the resources for each class are built just once, with a placeholder
+wherever a target ID would go. Each environment then fills in the
+placeholders from it's own UID cache and hands the result to it's own
+submitter, with all of the environments being loaded at the same time.
+
+The templates are built and handed over in chunks (of chunk_size) as the
+class is loaded, rather than all at once. Each environment's TemplateFeed
+holds just a couple of chunks, so the building never gets far ahead of the
+slowest environment and only a few chunks of a class are in memory at once. Each
+environment has it's own ResourceLoader, and so it's own UID cache, journal
+and log, just as it would when loaded on it's own.
+
+A resource that references something an environment doesn't have (because
+it failed to load there, say) can't be sent to that environment. It's
+logged and counted as a failure for that environment alone.
+"""
+
+import logging
+import queue
+import re
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Lock
+
+from include_load.loader import load_plugin, records_for
+from include_load.scheduler import ClassScheduler
+
+# Templates built (and handed to the environments) at a time
+DEFAULT_CHUNK_SIZE = 1000
+# Chunks waiting on each environment before the building stops to let it
+# catch up
+DEFAULT_FEED_DEPTH = 2
+
+placeholder_pattern = re.compile(r"__uid_(\d+)__")
+
+def placeholder(number):
+    return f"__uid_{number}__"
+
+class Unresolved(Exception):
+    """A placeholder for something that isn't in the environment's UID cache"""
+
+class PayloadTemplates:
+    """Builds the resources using the plugin's target classes (just as the
+    ResourceLoader does) but with placeholders in place of the target IDs"""
+    def __init__(self, plugin_path):
+        self.plugin = load_plugin(plugin_path)
+        self.entity_classes = {cls.class_name: cls for cls in self.plugin.all_targets}
+        self.targets = []           # placeholder number => (class_name, key)
+        self.numbers = {}           # (class_name, key) => placeholder number
+        self.lock = Lock()
+        self.log = logging.getLogger(__name__)
+
+    def placeholder(self, class_name, key):
+        with self.lock:
+            number = self.numbers.get((class_name, key))
+            if number is None:
+                number = len(self.targets)
+                self.numbers[(class_name, key)] = number
+                self.targets.append((class_name, key))
+        return placeholder(number)
+
+    def build_key(self, entity_class, record):
+        # Keys built from references end up with placeholders of their own
+        components = entity_class.get_key_components(record, self.get_target_id_from_record)
+        return str(components)
+
+    def get_target_id_from_record(self, entity_class, record):
+        return self.placeholder(entity_class.class_name, self.build_key(entity_class, record))
+
+    def build(self, class_name, basic_reports, chunk_size=DEFAULT_CHUNK_SIZE):
+        """Yield the unique (key, resource, own) templates for a class in
+        lists of up to chunk_size, where own is the placeholder for the
+        resource's own ID (or None if the class doesn't have one)"""
+        entity_class = self.entity_classes[class_name]
+        target_id_concept = getattr(entity_class, 'target_id_concept', None)
+
+        templates = []
+        seen = set()
+        for record in records_for(class_name, basic_reports):
+            try:
+                key = self.build_key(entity_class, record)
+            except Exception as e:
+                self.log.debug(f"Skipping {class_name} record: {e}")
+                continue
+
+            if key in seen:
+                continue
+            seen.add(key)
+
+            own = None
+            if target_id_concept:
+                own = self.placeholder(class_name, key)
+                record[target_id_concept] = own
+            templates.append((key, entity_class.build_entity(record, self.get_target_id_from_record), own))
+            if len(templates) >= chunk_size:
+                yield templates
+                templates = []
+
+        if len(templates) > 0:
+            yield templates
+
+class BuildFailed(Exception):
+    """The templates for a class couldn't all be built, so the environment
+    mustn't treat the class as loaded"""
+
+class TemplateFeed:
+    """Hands the chunks of templates for a class to one environment. At most
+    depth chunks wait on the environment; put() blocks until there is room,
+    unless the environment has stopped reading (closed)"""
+    finished = object()
+
+    def __init__(self, depth=DEFAULT_FEED_DEPTH):
+        self.queue = queue.Queue(maxsize=depth)
+        self.closed = Event()
+        self.error = None
+
+    def put(self, chunk):
+        while not self.closed.is_set():
+            try:
+                self.queue.put(chunk, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def finish(self, error=None):
+        self.error = error
+        self.put(self.finished)
+
+    def close(self):
+        self.closed.set()
+
+    def __iter__(self):
+        while True:
+            chunk = self.queue.get()
+            if chunk is self.finished:
+                if self.error is not None:
+                    raise BuildFailed(str(self.error)) from self.error
+                return
+            yield chunk
+
+class EnvironmentEntries:
+    """The (key, resource) entries for one environment, filled in from it's
+    UID cache as they are sent. skipped counts those with a reference the
+    environment doesn't have"""
+    def __init__(self, templates, builder, uid_cache, confirmed, log):
+        self.templates = templates          # Lists of templates (a TemplateFeed)
+        self.builder = builder
+        self.uid_cache = uid_cache
+        self.confirmed = confirmed
+        self.log = log
+        self.ids = {}               # placeholder number => target ID
+        self.skipped = 0
+
+    def target_id(self, number):
+        target_id = self.ids.get(number)
+        if target_id is None:
+            class_name, key = self.builder.targets[number]
+            target_id = self.uid_cache.get(class_name, self.fill(key))
+            if target_id is not None:
+                self.ids[number] = target_id
+        return target_id
+
+    def replace(self, match):
+        target_id = self.target_id(int(match.group(1)))
+        if target_id is None:
+            raise Unresolved(*self.builder.targets[int(match.group(1))])
+        return str(target_id)
+
+    def fill(self, value):
+        if isinstance(value, str):
+            if "__uid_" not in value:
+                return value
+            return placeholder_pattern.sub(self.replace, value)
+        if isinstance(value, dict):
+            return {k: self.fill(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self.fill(v) for v in value]
+        return value
+
+    def entry(self, key, resource, own):
+        key = self.fill(key)
+        if key in self.confirmed:
+            return None
+        if own is not None and self.target_id(int(placeholder_pattern.match(own).group(1))) is None:
+            # New to this environment, so it's created rather than updated
+            resource = {k: v for k, v in resource.items() if v != own}
+        return key, self.fill(resource)
+
+    def __iter__(self):
+        for templates in self.templates:
+            for key, resource, own in templates:
+                try:
+                    entry = self.entry(key, resource, own)
+                except Unresolved as e:
+                    class_name, target_key = e.args
+                    self.log.error(f"Skipping a resource that references a {class_name} ({target_key}) that hasn't been loaded")
+                    self.skipped += 1
+                    continue
+                if entry is not None:
+                    yield entry
+
+class FanOutLoader:
+    def __init__(self, plugin_path, loaders, chunk_size=DEFAULT_CHUNK_SIZE):
+        """loaders is {env: ResourceLoader}, each with the environment's own
+        UID cache, submitter and journal"""
+        self.builder = PayloadTemplates(plugin_path)
+        self.loaders = loaders
+        self.chunk_size = chunk_size
+
+    def load_class(self, class_name, basic_reports):
+        """Returns {env: (submitted, failed)}"""
+        print(f"Building {class_name}")
+        feeds = {env: TemplateFeed() for env in self.loaders}
+
+        def load_env(env, loader):
+            try:
+                return loader.load_entries(class_name,
+                            lambda confirmed: EnvironmentEntries(feeds[env], self.builder, loader.uid_cache, confirmed, loader.log))
+            finally:
+                # Whether it's done or already loaded, the builder shouldn't
+                # wait on this environment any longer
+                feeds[env].close()
+
+        with ThreadPoolExecutor(max_workers=len(self.loaders)) as executor:
+            jobs = {env: executor.submit(load_env, env, loader) for env, loader in self.loaders.items()}
+            error = None
+            try:
+                for templates in self.builder.build(class_name, basic_reports, self.chunk_size):
+                    for feed in feeds.values():
+                        feed.put(templates)
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                for feed in feeds.values():
+                    feed.finish(error)
+            return {env: job.result() for env, job in jobs.items()}
+
+    def run(self, class_names, basic_reports, max_parallel=1, dependencies=None):
+        """Load each class into every environment. Returns {env: {class_name:
+        (submitted, failed)}}"""
+        if max_parallel > 1 and dependencies is not None:
+            scheduler = ClassScheduler(class_names, dependencies, max_parallel)
+            by_class = scheduler.run(lambda class_name: self.load_class(class_name, basic_reports))
+        else:
+            by_class = {}
+            for class_name in class_names:
+                by_class[class_name] = self.load_class(class_name, basic_reports)
+
+        return {env: {class_name: outcome[env] for class_name, outcome in by_class.items()} for env in self.loaders}
@@ -0,0 +1,122 @@
+"""A thin HTTP session for talking to the FHIR server directly
+
+LoadStage goes through the FhirClient for every request. The alternative
+loaders here talk to the server using a single requests session instead,
+borrowing the FhirClient's authentication so any of the auth types supported
+in fhir_hosts work the same way.
+
+The session keeps a pool of keep-alive connections (pool_size of them) so
+concurrent requests don't pay for a new connection (and TLS handshake) each
+time. Request bodies can optionally be gzip compressed for servers that
+accept Content-Encoding: gzip.
+"""
+
+import gzip
+import json
+import logging
+
+# Seconds to wait on the server before giving up on a request
+DEFAULT_TIMEOUT = 300
+# Number of keep-alive connections held open to the server
+DEFAULT_POOL_SIZE = 10
+
+fhir_json = "application/fhir+json"
+
+def _auth_args(fhir_host):
+    """Ask the FhirClient's auth module to add it's details to the request"""
+    request_args = {}
+    auth = getattr(fhir_host, 'auth', None)
+    if auth is not None and hasattr(auth, 'update_request_args'):
+        auth.update_request_args(request_args)
+    return request_args
+
+class FhirResponse:
+    def __init__(self, status_code, body=None, headers=None, error=None):
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers or {}
+        # Transport level error (connection reset, timeout, etc)
+        self.error = error
+
+    def ok(self):
+        return self.error is None and 200 <= self.status_code < 300
+
+    def retriable(self):
+        """Would the same request have a chance of succeeding if we tried again?"""
+        return self.error is not None or self.status_code in (408, 409, 429) or self.status_code >= 500
+
+class FhirSession:
+    def __init__(self, base_url, fhir_host=None, timeout=DEFAULT_TIMEOUT, pool_size=DEFAULT_POOL_SIZE, compress=False):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.base_url = base_url.rstrip("/")
+        self.fhir_host = fhir_host
+        self.timeout = timeout
+        self.compress = compress
+        self.session = requests.Session()
+
+        # Retries are left up to the submitters, which know what is safe to resend
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({
+            "Content-Type": f"{fhir_json};charset=utf-8",
+            "Accept": fhir_json
+        })
+
+    def url(self, path):
+        if path.startswith("http"):
+            return path
+        if path == "":
+            return self.base_url
+        return f"{self.base_url}/{path.lstrip('/')}"
+
+    def encode(self, body):
+        """Returns (data, extra headers) for a request body"""
+        data = json.dumps(body).encode("utf-8")
+        if self.compress:
+            return gzip.compress(data, compresslevel=5), {"Content-Encoding": "gzip"}
+        return data, {}
+
+    def request(self, method, path, body=None, headers=None):
+        import requests
+
+        request_args = _auth_args(self.fhir_host)
+        request_headers = dict(request_args.pop('headers', {}))
+        if headers:
+            request_headers.update(headers)
+        if body is not None:
+            data, extra_headers = self.encode(body)
+            request_args['data'] = data
+            request_headers.update(extra_headers)
+
+        try:
+            response = self.session.request(method,
+                        self.url(path),
+                        headers=request_headers,
+                        timeout=self.timeout,
+                        **request_args)
+        except requests.RequestException as e:
+            logging.getLogger(__name__).warning(f"{method} {path} failed: {e}")
+            return FhirResponse(0, error=e)
+
+        content = None
+        if len(response.content) > 0:
+            try:
+                content = response.json()
+            except ValueError:
+                content = response.text
+        return FhirResponse(response.status_code, content, response.headers)
+
+    def get(self, path, headers=None):
+        return self.request("GET", path, headers=headers)
+
+    def post(self, path, body, headers=None):
+        return self.request("POST", path, body, headers=headers)
+
+    def put(self, path, body, headers=None):
+        return self.request("PUT", path, body, headers=headers)
+
+    def close(self):
+        self.session.close()
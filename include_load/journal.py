@@ -0,0 +1,75 @@
+"""A write-ahead journal of every resource the server has acknowledged
+
+As each resource is accepted, it's class, key and target ID are committed to
+the journal (an SQLite database in WAL mode living alongside the LoadStage
+cache directory) before anything else happens to it. In WAL mode with normal
+syncing, those commits are cheap appends that still survive the loader being
+killed, so nothing the server acknowledged is sent a second time.
+
+When resuming, classes the journal has marked as complete are skipped
+entirely and, within the class that was interrupted, anything already
+confirmed is skipped while the rest are sent along as usual.
+"""
+
+import sqlite3
+from pathlib import Path
+from threading import Lock
+
+def journal_filename(cache_dir, study_id):
+    return Path(cache_dir) / f"{study_id}_load_journal.db"
+
+class LoadJournal:
+    def __init__(self, cache_dir, study_id, resume=False):
+        self.filename = journal_filename(cache_dir, study_id)
+        self.filename.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = Lock()
+
+        self.db = sqlite3.connect(str(self.filename), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS acknowledged (
+                class_name TEXT,
+                key TEXT,
+                target_id TEXT,
+                PRIMARY KEY (class_name, key))""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS checkpoint (
+                class_name TEXT PRIMARY KEY,
+                complete INTEGER,
+                acknowledged INTEGER)""")
+
+        if not resume:
+            # A fresh load has nothing to pick up from
+            self.db.execute("DELETE FROM acknowledged")
+            self.db.execute("DELETE FROM checkpoint")
+        self.db.commit()
+
+    def record(self, class_name, key, target_id):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO acknowledged VALUES (?, ?, ?)",
+                        (class_name, str(key), target_id))
+            self.db.commit()
+
+    def confirmed(self, class_name):
+        """key => target_id for everything from class_name the server has
+        already accepted"""
+        with self.lock:
+            return dict(self.db.execute("SELECT key, target_id FROM acknowledged WHERE class_name=?",
+                        (class_name,)))
+
+    def is_complete(self, class_name):
+        with self.lock:
+            row = self.db.execute("SELECT complete FROM checkpoint WHERE class_name=?",
+                        (class_name,)).fetchone()
+        return row is not None and row[0] == 1
+
+    def complete(self, class_name):
+        with self.lock:
+            acknowledged = self.db.execute("SELECT COUNT(*) FROM acknowledged WHERE class_name=?",
+                        (class_name,)).fetchone()[0]
+            self.db.execute("INSERT OR REPLACE INTO checkpoint VALUES (?, 1, ?)",
+                        (class_name, acknowledged))
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
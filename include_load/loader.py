@@ -0,0 +1,165 @@
+"""Load the transformed tables without going through LoadStage
+
+LoadStage sends each resource as it's own request. The ResourceLoader builds
+the very same resources (using the target classes from the FHIR plugin, just
+as LoadStage does) but leaves it to a submitter to decide how those are sent
+to the server, such as grouped into batch bundles.
+
+The resulting target IDs are stored in the LoadStage compatible UID cache,
+so references between classes are resolved the same way and subsequent runs
+of either loader pick up where the other left off.
+
+With a LoadJournal, every acknowledged resource is journaled as it comes
+back, which lets an interrupted load resume without resending anything the
+server already has.
+
+Given a bundle (an NdjsonWriter), each resource is also written out as the
+server accepts it, with the ID it was given, so the bundle comes out of the
+load itself rather than a second pass over the tables. When resuming, only
+the resources sent by this run end up in the bundle.
+"""
+
+import importlib.util
+import logging
+import math
+from pathlib import Path
+from threading import Lock
+
+from include_load.scheduler import ClassScheduler
+
+def load_plugin(plugin_path):
+    """Import the target service plugin the same way LoadStage does"""
+    plugin_path = Path(plugin_path)
+    spec = importlib.util.spec_from_file_location(plugin_path.stem, plugin_path)
+    plugin = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(plugin)
+    return plugin
+
+def records_for(class_name, basic_reports):
+    """Each class is built from it's own report, or the default if it has none"""
+    table = basic_reports.get(class_name, basic_reports['default'])
+    for record in table.to_dict(orient='records'):
+        # Anything pandas considers missing is None to the plugin
+        yield {k: (None if isinstance(v, float) and math.isnan(v) else v) for k, v in record.items()}
+
+class ResourceLoader:
+    def __init__(self, plugin_path, uid_cache, submitter, journal=None, label=None, log=None, bundle=None):
+        self.plugin = load_plugin(plugin_path)
+        self.entity_classes = {cls.class_name: cls for cls in self.plugin.all_targets}
+        self.uid_cache = uid_cache
+        self.submitter = submitter
+        self.journal = journal
+        # Prefixed to the progress messages (such as the environment's name)
+        self.prefix = "" if label is None else f"[{label}] "
+        self.log = logging.getLogger(__name__) if log is None else log
+        self.bundle = bundle
+        # Classes loaded at the same time all write to the one bundle
+        self.bundle_lock = Lock()
+
+    def build_key(self, entity_class, record):
+        components = entity_class.get_key_components(record, self.get_target_id_from_record)
+        return str(components)
+
+    def get_target_id_from_record(self, entity_class, record):
+        return self.uid_cache.get(entity_class.class_name, self.build_key(entity_class, record))
+
+    def prepare(self, class_name, basic_reports, confirmed={}):
+        """Build the unique (key, resource) pairs for a class, skipping those
+        whose keys are in confirmed"""
+        entity_class = self.entity_classes[class_name]
+        target_id_concept = getattr(entity_class, 'target_id_concept', None)
+
+        seen = set()
+        for record in records_for(class_name, basic_reports):
+            try:
+                key = self.build_key(entity_class, record)
+            except Exception as e:
+                # Not every row carries what a given class needs
+                self.log.debug(f"Skipping {class_name} record: {e}")
+                continue
+
+            if key in seen or key in confirmed:
+                continue
+            seen.add(key)
+
+            if target_id_concept:
+                # Previously loaded entities are updated rather than recreated
+                record[target_id_concept] = self.uid_cache.get(class_name, key)
+            yield key, entity_class.build_entity(record, self.get_target_id_from_record)
+
+    def store(self, class_name, key, target_id):
+        if self.journal is not None:
+            self.journal.record(class_name, key, target_id)
+        self.uid_cache.set(class_name, key, target_id)
+
+    def write_bundle(self, resource, target_id):
+        if target_id is not None:
+            resource = dict(resource, id=target_id)
+        with self.bundle_lock:
+            self.bundle.write(resource)
+
+    def resume_point(self, class_name):
+        """The keys already confirmed for class_name by a previous run. The
+        UID cache may not have been committed before that run died, so the
+        IDs are restored from the journal"""
+        confirmed = self.journal.confirmed(class_name)
+        for key, target_id in confirmed.items():
+            self.uid_cache.set(class_name, key, target_id)
+        if len(confirmed) > 0:
+            print(f"{self.prefix}{class_name}: resuming after {len(confirmed)} previously loaded")
+        return confirmed
+
+    def load_class(self, class_name, basic_reports):
+        return self.load_entries(class_name, 
+                    lambda confirmed: self.prepare(class_name, basic_reports, confirmed))
+
+    def load_entries(self, class_name, entries_for):
+        """Submit the (key, resource) entries returned by entries_for(confirmed),
+        which should leave out those whose keys are in confirmed. Entries that
+        couldn't be sent at all (entries.skipped, if there is such a thing)
+        count as failures"""
+        confirmed = {}
+        if self.journal is not None:
+            if self.journal.is_complete(class_name):
+                print(f"{self.prefix}{class_name}: already loaded, skipping")
+                return 0, 0
+            confirmed = self.resume_point(class_name)
+
+        print(f"{self.prefix}Loading {class_name}")
+        entries = entries_for(confirmed)
+        # The resources in flight, kept until the server accepts them for
+        # the bundle
+        in_flight = {}
+
+        def sent():
+            for key, resource in entries:
+                in_flight[key] = resource
+                yield key, resource
+
+        def accepted(key, target_id):
+            self.store(class_name, key, target_id)
+            if self.bundle is not None:
+                self.write_bundle(in_flight.pop(key), target_id)
+
+        submitted, failed = self.submitter.submit(class_name,
+                    entries if self.bundle is None else sent(),
+                    accepted)
+        failed += getattr(entries, 'skipped', 0)
+        self.uid_cache.commit()
+        # Anything that failed should get another chance when resuming
+        if self.journal is not None and failed == 0:
+            self.journal.complete(class_name)
+        print(f"{self.prefix}{class_name}: {submitted} loaded, {failed} failed")
+        return submitted, failed
+
+    def run(self, class_names, basic_reports, max_parallel=1, dependencies=None):
+        """Load each class. When max_parallel is more than one, independent
+        classes (according to dependencies) are loaded at the same time"""
+        if max_parallel > 1 and dependencies is not None:
+            scheduler = ClassScheduler(class_names, dependencies, max_parallel)
+            return scheduler.run(lambda class_name: self.load_class(class_name, basic_reports))
+
+        outcome = {}
+        for class_name in class_names:
+            outcome[class_name] = self.load_class(class_name, basic_reports)
+        return outcome
@@ -0,0 +1,348 @@
+"""A minimal, in memory stand in for a FHIR server
+
+This is only intended for exercising the loaders locally. It understands
+enough of the REST API to create, update and read resources and to process
+batch and transaction bundles. Everything lives in memory and disappears once
+the server is stopped.
+
+    server = MockFhirServer().start()
+    ... point a FhirSession at server.base_url ...
+    server.stop()
+
+For benchmarking, the server can be made to behave more like a real (busy)
+one: each request can be delayed by latency (plus up to jitter) seconds, a
+fraction of requests (error_rate) can fail with a 500 and a fraction
+(throttle_rate) be turned away with a 429. If max_concurrent is set, requests
+beyond that many at once are also throttled. Every request is recorded in
+the server's stats so the client's view of things can be checked against it.
+
+The server also understands enough of Bulk Data $import to stand in for a
+real one: the NDJSON files named in the request are fetched and ingested in
+the background (each resource keeping the ID it came with) while the status
+URL reports on the progress.
+"""
+
+import gzip
+import json
+import logging
+import random
+import threading
+import time
+from collections import defaultdict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from itertools import count
+from urllib.parse import urlparse, parse_qs
+from urllib.request import urlopen
+
+class MockFhirServer:
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, jitter=0.0, error_rate=0.0, throttle_rate=0.0, 
+                max_concurrent=None, retry_after=1, seed=None):
+        self.resources = defaultdict(dict)          # resourceType => id => resource
+        self.requests = defaultdict(int)            # method => count
+        self.lock = threading.RLock()
+        self.ids = count(1)
+
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.max_concurrent = max_concurrent
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.in_flight = 0
+        self.stats = []                             # RequestStat for each request
+        self.imports = {}                           # job ID => status of each $import
+
+        handler = type("Handler", (_Handler,), {"fhir": self})
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def take_stats(self):
+        """Returns the stats gathered since the last call"""
+        with self.lock:
+            stats = self.stats
+            self.stats = []
+        return stats
+
+    def misbehave(self):
+        """Decide whether this request should be throttled or fail. Returns
+        (status, body, headers) if so, otherwise None"""
+        with self.lock:
+            roll = self.random.random()
+            delay = self.latency + self.random.random() * self.jitter
+            busy = self.max_concurrent is not None and self.in_flight > self.max_concurrent
+        if delay > 0:
+            time.sleep(delay)
+
+        if busy or roll < self.throttle_rate:
+            return 429, outcome("Too many requests"), {"Retry-After": str(self.retry_after)}
+        if roll < self.throttle_rate + self.error_rate:
+            return 500, outcome("Simulated server error"), {}
+        return None
+
+    def count(self, resource_type=None):
+        with self.lock:
+            if resource_type is not None:
+                return len(self.resources[resource_type])
+            return sum(len(r) for r in self.resources.values())
+
+    # The following return (status, body, headers)
+    def create(self, resource_type, resource, if_none_exist=None):
+        if resource.get('resourceType') != resource_type:
+            return 400, outcome(f"Expected a {resource_type}"), {}
+        with self.lock:
+            if if_none_exist:
+                # Conditional create, so hand back the match if there is one
+                status, found, headers = self.search(resource_type, parse_qs(if_none_exist))
+                if found['total'] > 1:
+                    return 412, outcome(f"{if_none_exist} matches more than one {resource_type}"), {}
+                if found['total'] == 1:
+                    existing = found['entry'][0]['resource']
+                    return 200, existing, {"Location": location(existing)}
+            resource = dict(resource, id=str(next(self.ids)))
+            self.resources[resource_type][resource['id']] = resource
+        return 201, resource, {"Location": location(resource)}
+
+    def update(self, resource_type, resource_id, resource):
+        if resource.get('resourceType') != resource_type:
+            return 400, outcome(f"Expected a {resource_type}"), {}
+        with self.lock:
+            status = 200 if resource_id in self.resources[resource_type] else 201
+            resource = dict(resource, id=resource_id)
+            self.resources[resource_type][resource_id] = resource
+        return status, resource, {"Location": location(resource)}
+
+    def read(self, resource_type, resource_id):
+        with self.lock:
+            resource = self.resources[resource_type].get(resource_id)
+        if resource is None:
+            return 404, outcome(f"{resource_type}/{resource_id} not found"), {}
+        return 200, resource, {}
+
+    def search(self, resource_type, params):
+        with self.lock:
+            matches = list(self.resources[resource_type].values())
+        if 'identifier' in params:
+            wanted = params['identifier'][0]
+            matches = [r for r in matches if wanted in identifiers(r)]
+        if '_id' in params:
+            wanted = set(params['_id'][0].split(","))
+            matches = [r for r in matches if r['id'] in wanted]
+        return 200, {
+            "resourceType": "Bundle",
+            "type": "searchset",
+            "total": len(matches),
+            "entry": [{"resource": r} for r in matches]
+        }, {}
+
+    def bundle(self, bundle):
+        if bundle.get('resourceType') != 'Bundle' or bundle.get('type') not in ('batch', 'transaction'):
+            return 400, outcome("Expected a batch or transaction Bundle"), {}
+
+        results = []
+        for entry in bundle.get('entry', []):
+            request = entry.get('request', {})
+            status, body, headers = self.dispatch(request.get('method', 'POST'), request.get('url', ''), entry.get('resource'), request.get('ifNoneExist'))
+            response = {"status": str(status)}
+            if "Location" in headers:
+                response['location'] = headers['Location']
+            if status >= 300:
+                response['outcome'] = body
+            results.append((status, body, response))
+
+        failures = [status for status, body, response in results if status >= 300]
+        if bundle['type'] == 'transaction' and len(failures) > 0:
+            # All or nothing, so undo whatever did get created and report the
+            # first failure as the outcome for the whole thing
+            with self.lock:
+                for status, body, response in results:
+                    if status == 201:
+                        self.resources[body['resourceType']].pop(body['id'], None)
+            return failures[0], outcome("Transaction failed"), {}
+
+        return 200, {
+            "resourceType": "Bundle",
+            "type": f"{bundle['type']}-response",
+            "entry": [{"response": response} for status, body, response in results]
+        }, {}
+
+    def bulk_import(self, parameters):
+        """Start importing the inputs of a $import request"""
+        if parameters is None or parameters.get('resourceType') != 'Parameters':
+            return 400, outcome("Expected Parameters"), {}
+        inputs = []
+        for parameter in parameters.get('parameter', []):
+            if parameter.get('name') == 'input':
+                part = {p['name']: p.get('valueCode', p.get('valueUri')) for p in parameter.get('part', [])}
+                inputs.append((part.get('type'), part.get('url')))
+
+        with self.lock:
+            job = str(len(self.imports) + 1)
+            self.imports[job] = {'done': False, 'output': [], 'error': []}
+        threading.Thread(target=self.run_import, args=(job, inputs), daemon=True).start()
+        return 202, outcome("Accepted"), {"Content-Location": f"{self.base_url}/$import-poll-status/{job}"}
+
+    def run_import(self, job, inputs):
+        status = self.imports[job]
+        for resource_type, url in inputs:
+            count = 0
+            errors = 0
+            try:
+                with urlopen(url) as f:
+                    for line in f:
+                        if line.strip() == b"":
+                            continue
+                        resource = json.loads(line)
+                        if resource.get('resourceType') != resource_type or 'id' not in resource:
+                            errors += 1
+                            continue
+                        self.update(resource_type, resource['id'], resource)
+                        count += 1
+            except (OSError, ValueError) as e:
+                logging.getLogger(__name__).warning(f"Unable to import {url}: {e}")
+                errors += 1
+            with self.lock:
+                status['output'].append({'type': resource_type, 'count': count, 'inputUrl': url})
+                if errors > 0:
+                    status['error'].append({'type': 'OperationOutcome', 'count': errors, 'inputUrl': url})
+        with self.lock:
+            status['request'] = f"{self.base_url}/$import"
+            status['transactionTime'] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+            status['done'] = True
+
+    def import_status(self, job):
+        with self.lock:
+            status = self.imports.get(job)
+            if status is None:
+                return 404, outcome(f"No such import, {job}"), {}
+            if not status['done']:
+                return 202, outcome("In progress"), {"X-Progress": f"{len(status['output'])} files imported", "Retry-After": "1"}
+            return 200, {k: v for k, v in status.items() if k != 'done'}, {}
+
+    def dispatch(self, method, url, body, if_none_exist=None):
+        parsed = urlparse(url)
+        parts = [p for p in parsed.path.split("/") if p != ""]
+
+        if method == "POST" and len(parts) == 0:
+            return self.bundle(body)
+        if method == "POST" and parts == ["$import"]:
+            return self.bulk_import(body)
+        if method == "GET" and len(parts) == 2 and parts[0] == "$import-poll-status":
+            return self.import_status(parts[1])
+        if method == "POST" and len(parts) == 1:
+            return self.create(parts[0], body, if_none_exist)
+        if method == "PUT" and len(parts) == 2:
+            return self.update(parts[0], parts[1], body)
+        if method == "GET" and len(parts) == 2:
+            return self.read(parts[0], parts[1])
+        if method == "GET" and len(parts) == 1:
+            return self.search(parts[0], parse_qs(parsed.query))
+        return 404, outcome(f"Unsupported request {method} {url}"), {}
+
+def outcome(message):
+    return {
+        "resourceType": "OperationOutcome",
+        "issue": [{"severity": "error", "code": "processing", "diagnostics": message}]
+    }
+
+def location(resource):
+    return f"{resource['resourceType']}/{resource['id']}/_history/1"
+
+class RequestStat:
+    """What the server saw of a single request"""
+    __slots__ = ('method', 'status', 'seconds', 'resources')
+
+    def __init__(self, method, status, seconds, resources):
+        self.method = method
+        self.status = status
+        self.seconds = seconds
+        # Number of resources carried (the entry count for bundles)
+        self.resources = resources
+
+def resource_count(method, body):
+    if body is None:
+        return 0
+    if isinstance(body, dict) and body.get('resourceType') == 'Bundle' and method == "POST":
+        return len(body.get('entry', []))
+    return 1
+
+def identifiers(resource):
+    found = set()
+    for identifier in resource.get('identifier', []):
+        found.add(identifier.get('value'))
+        found.add(f"{identifier.get('system')}|{identifier.get('value')}")
+    return found
+
+class _Handler(BaseHTTPRequestHandler):
+    fhir = None
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logging.getLogger(__name__).debug(format % args)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        if length == 0:
+            return None
+        data = self.rfile.read(length)
+        if self.headers.get('Content-Encoding') == 'gzip':
+            data = gzip.decompress(data)
+        return json.loads(data)
+
+    def respond(self, status, body, headers):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/fhir+json")
+        self.send_header("Content-Length", str(len(data)))
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def handle_method(self, method):
+        start = time.monotonic()
+        with self.fhir.lock:
+            self.fhir.requests[method] += 1
+            self.fhir.in_flight += 1
+
+        body = None
+        try:
+            body = self.read_body() if method in ("POST", "PUT") else None
+            response = self.fhir.misbehave() or self.fhir.dispatch(method, self.path, body, self.headers.get('If-None-Exist'))
+        except (ValueError, OSError):
+            response = 400, outcome("Invalid JSON"), {}
+        self.respond(*response)
+
+        with self.fhir.lock:
+            self.fhir.in_flight -= 1
+            self.fhir.stats.append(RequestStat(method, response[0], time.monotonic() - start, resource_count(method, body)))
+
+    def do_GET(self):
+        self.handle_method("GET")
+
+    def do_POST(self):
+        self.handle_method("POST")
+
+    def do_PUT(self):
+        self.handle_method("PUT")
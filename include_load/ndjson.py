@@ -0,0 +1,95 @@
+"""Write resources out as NDJSON, one set of files per resource type
+
+A single JSON bundle for a study has to be held (or at least assembled) as
+one enormous document, which doesn't go well for studies with millions of
+observations. Here, each resource is appended as a line of it's own to the
+file for it's resource type as soon as it's written, so memory use stays
+flat no matter how large the study is.
+
+Each resource type's output is split into chunks of roughly max_bytes
+(before compression) so no one file gets out of hand, and the files can be
+compressed as they are written (gzip, bz2 or zstd). Once closed, a
+manifest.json listing every file, it's resource type and how many resources
+it holds is written alongside them, along the lines of a Bulk Data export
+manifest.
+"""
+
+import json
+from pathlib import Path
+
+from include_transform.compression import open_binary
+
+# Uncompressed bytes written to a file before moving on to the next
+DEFAULT_CHUNK_BYTES = 256 * 1024 * 1024
+
+suffixes = {
+    None: '',
+    'gzip': '.gz',
+    'bz2': '.bz2',
+    'zstd': '.zst'
+}
+
+class _Chunk:
+    __slots__ = ['filename', 'file', 'size', 'count']
+
+    def __init__(self, filename, compression):
+        self.filename = filename
+        self.file = open_binary(filename, 'wb', compression=compression)
+        self.size = 0
+        self.count = 0
+
+class NdjsonWriter:
+    def __init__(self, directory, compression=None, max_bytes=DEFAULT_CHUNK_BYTES):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.compression = compression
+        self.suffix = ".ndjson" + suffixes[compression]
+        self.max_bytes = max_bytes
+        self.current = {}           # resourceType => _Chunk being written
+        self.outputs = []           # {type, file, count} for each finished file
+
+    def chunk_for(self, resource_type, size):
+        chunk = self.current.get(resource_type)
+        if chunk is not None and chunk.count > 0 and chunk.size + size > self.max_bytes:
+            self.finish(resource_type, chunk)
+            chunk = None
+        if chunk is None:
+            number = sum(1 for output in self.outputs if output['type'] == resource_type) + 1
+            chunk = _Chunk(self.directory / f"{resource_type}-{number:04d}{self.suffix}", self.compression)
+            self.current[resource_type] = chunk
+        return chunk
+
+    def finish(self, resource_type, chunk):
+        chunk.file.close()
+        self.outputs.append({'type': resource_type, 'file': chunk.filename.name, 'count': chunk.count})
+        del self.current[resource_type]
+
+    def write(self, resource):
+        line = json.dumps(resource, separators=(',', ':')).encode('utf-8') + b"\n"
+        chunk = self.chunk_for(resource['resourceType'], len(line))
+        chunk.file.write(line)
+        chunk.size += len(line)
+        chunk.count += 1
+
+    def write_all(self, resources):
+        """Returns the number of resources written"""
+        written = 0
+        for resource in resources:
+            self.write(resource)
+            written += 1
+        return written
+
+    def close(self):
+        """Finish every file and write the manifest. Returns the outputs"""
+        for resource_type, chunk in list(self.current.items()):
+            self.finish(resource_type, chunk)
+        self.outputs.sort(key=lambda output: output['file'])
+        with open(self.directory / "manifest.json", 'wt') as f:
+            json.dump({'output': self.outputs}, f, indent=2)
+        return self.outputs
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
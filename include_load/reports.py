@@ -0,0 +1,107 @@
+"""Gather the transformed tables into the reports handed to LoadStage
+
+The tables can either be read back from the files written by 01-transform.py 
+or handed over directly (as DataFrames) when the transform and load are run 
+together. A table can be in any of the formats 01-transform.py writes. The
+transform removes a table's other formats as it writes it, but in case more
+than one is found, the most recently written wins. Every column of the
+columnar formats is read as a string, so the loader sees the same values
+read_df would have produced from the TSV.
+"""
+
+from pathlib import Path
+
+from include_transform.tables import transformed_tables, table_filename, file_formats, tsv_formats
+
+def string_schema(schema):
+    """schema with every column as a string"""
+    import pyarrow as pa
+
+    return pa.schema([(name, pa.string()) for name in schema.names])
+
+def table_file(input_file_dir, name):
+    """The (file_format, path) of the most recently written version of the
+    table, or (None, None) if there isn't one"""
+    found = []
+    for file_format in file_formats:
+        path = Path(input_file_dir) / table_filename(name, file_format)
+        if path.is_file():
+            found.append((path.stat().st_mtime, file_format, path))
+    if len(found) == 0:
+        return None, None
+    mtime, file_format, path = max(found, key=lambda f: f[0])
+    return file_format, path
+
+def read_table(input_file_dir, name):
+    """Read a single transformed table, using whichever format is newest"""
+    file_format, path = table_file(input_file_dir, name)
+
+    if file_format == 'parquet':
+        import pyarrow.parquet as pq
+        schema = string_schema(pq.read_schema(path))
+        return pq.read_table(path, memory_map=True, schema=schema).to_pandas()
+
+    if file_format == 'arrow':
+        import pyarrow as pa
+        with pa.memory_map(str(path)) as source:
+            table = pa.ipc.open_file(source).read_all()
+            return table.cast(string_schema(table.schema)).to_pandas()
+
+    if file_format in tsv_formats[1:]:
+        import pandas as pd
+        # Every value as a string, just as read_df would have it
+        return pd.read_csv(path, sep='\t', quotechar='"', dtype=str, keep_default_na=False)
+
+    from kf_lib_data_ingest.common.io import read_df
+    return read_df(f"{input_file_dir}/{table_filename(name)}")
+
+def read_transformed(input_file_dir):
+    """Read each of the transformed tables from input_file_dir"""
+    tables = {}
+    for name in transformed_tables:
+        tables[name] = read_table(input_file_dir, name)
+    return tables
+
+def build_basic_reports(tables, input_file_dir=None):
+    """Map each of the loadable classes to the table it is built from"""
+    subjects = tables['participant']
+    conditions = tables['condition']
+    diseases = tables['disease']
+    encounters = tables['encounter']
+    observations = tables['observation']
+    consents = tables['consent']
+
+    basic_reports = {
+        "default": subjects,
+        'research_study': consents,
+        'consent': consents,
+        'group': consents,
+        'research_subject': subjects,
+        'sequencing_center': consents,
+        'specimen': encounters,
+        'condition': conditions,
+        'disease': diseases,
+        'human_phenotype': conditions,
+        'encounter': encounters,
+        "measurement": encounters,
+        'observation': observations
+    }
+    # Not enough time right now to figure out what is wrong with this
+    offs = {    
+        'service_request': encounters,
+    }
+
+    if input_file_dir is not None:
+        from kf_lib_data_ingest.common.io import read_df
+
+        if Path(f"{input_file_dir}/discovery_variant.tsv").is_file():
+            discovery_variant = read_df(f"{input_file_dir}/discovery_variant.tsv") 
+
+            basic_reports['discovery_variant'] = discovery_variant
+            basic_reports["discovery_implication"] = discovery_variant
+
+        if Path(f"{input_file_dir}/discovery_report.tsv").is_file():
+            discovery_report = read_df(f"{input_file_dir}/discovery_report.tsv")
+
+            basic_reports["discovery_report"] = discovery_report
+    return basic_reports
@@ -0,0 +1,99 @@
+"""Load resource classes in parallel wherever their dependencies allow
+
+A class can't be loaded until everything it references has been loaded (and
+the target IDs are sitting in the UID cache), but classes that don't
+reference one another can go at the same time. So, given the dependencies
+between classes, the scheduler starts each class as soon as all of it's
+dependencies are done, running up to max_parallel classes at once. The
+whole load then takes as long as the longest chain of dependencies rather
+than the sum of every class.
+"""
+
+import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+def restrict_dependencies(class_names, dependencies):
+    """Dependencies among class_names only.
+
+    Classes that aren't being loaded this time are assumed to be in the UID
+    cache already. However, anything they in turn depend on that is being
+    loaded still has to go first, so we follow the chain through them."""
+    selected = set(class_names)
+
+    def reachable(class_name, visited):
+        found = set()
+        for dependency in dependencies.get(class_name, []):
+            if dependency in visited:
+                continue
+            visited.add(dependency)
+            if dependency in selected:
+                found.add(dependency)
+            else:
+                found |= reachable(dependency, visited)
+        return found
+
+    return {class_name: reachable(class_name, set([class_name])) for class_name in class_names}
+
+def critical_path(class_names, dependencies):
+    """Length of the longest chain of classes waiting on each class"""
+    dependents = {class_name: [] for class_name in class_names}
+    for class_name in class_names:
+        for dependency in dependencies[class_name]:
+            dependents[dependency].append(class_name)
+
+    lengths = {}
+    def length(class_name):
+        if class_name not in lengths:
+            lengths[class_name] = 1 + max([length(c) for c in dependents[class_name]], default=0)
+        return lengths[class_name]
+
+    return {class_name: length(class_name) for class_name in class_names}
+
+class ClassScheduler:
+    def __init__(self, class_names, dependencies, max_parallel=4):
+        self.class_names = list(class_names)
+        self.dependencies = restrict_dependencies(self.class_names, dependencies)
+        self.priority = critical_path(self.class_names, self.dependencies)
+        self.max_parallel = max_parallel
+        self.log = logging.getLogger(__name__)
+
+    def ready(self, done, started):
+        """Classes that can start now, those holding up the most work first
+        (and otherwise in the order they were given)"""
+        ready = [c for c in self.class_names if c not in started and self.dependencies[c] <= done]
+        return sorted(ready, key=lambda c: -self.priority[c])
+
+    def run(self, load_class):
+        """Call load_class(class_name) for every class. Returns a dict of
+        class_name => whatever load_class returned"""
+        outcome = {}
+        done = set()
+        started = set()
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=self.max_parallel) as executor:
+            while len(done) < len(self.class_names):
+                for class_name in self.ready(done, started):
+                    if len(running) >= self.max_parallel:
+                        break
+                    self.log.info(f"Starting {class_name}")
+                    started.add(class_name)
+                    running[executor.submit(load_class, class_name)] = class_name
+
+                if len(running) == 0:
+                    # Only possible if the dependencies loop back on themselves
+                    stuck = [c for c in self.class_names if c not in done]
+                    raise ValueError(f"Circular dependencies among: {', '.join(stuck)}")
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    class_name = running.pop(future)
+                    # Nothing that depends on a class that failed should be
+                    # loaded, so let the error through once the rest finish
+                    try:
+                        outcome[class_name] = future.result()
+                    except Exception:
+                        wait(running)
+                        raise
+                    done.add(class_name)
+        return outcome
@@ -0,0 +1,271 @@
+"""Load a single transformed study into a FHIR server using LoadStage
+
+This is shared by 02-load.py (which reads the transformed tables back from 
+disk) and 01-transform.py --load (which hands the tables over directly).
+"""
+
+from os import remove
+import logging
+from pathlib import Path
+
+from kf_lib_data_ingest.etl.load.load import LoadStage
+
+import ncpi_fhir_plugin as fhir # import SetAuthorization, remote_authorization
+
+from include_load.reports import read_transformed, build_basic_reports
+from include_load.loader import ResourceLoader
+from include_load.fanout import FanOutLoader
+from include_load.uid_cache import UidCache
+from include_load.journal import LoadJournal
+from include_load.ndjson import NdjsonWriter
+from include_load.bulk_import import BulkImporter
+
+#   "family_relationship",
+all_loadable_classes = [
+    'patient',
+    "consent",
+    "group",
+    "research_study", 
+    "research_subject",
+    'specimen',
+    "disease",
+    "human_phenotype",
+    "sequencing_center",
+    'encounter',
+    'condition',
+    'measurement',
+    'observation'
+]
+_off = [
+    'service_request'
+]
+""" For now, we'll leave these off. None of those fields mapped well anyway
+    "sequencing_file_info"  """
+
+# The classes each class references, and so must be loaded before it. Those
+# that don't depend on one another can be loaded at the same time
+class_dependencies = {
+    'patient': [],
+    'consent': ['patient'],
+    'group': ['patient'],
+    'research_study': ['group'],
+    'research_subject': ['patient', 'research_study'],
+    'specimen': ['patient'],
+    'disease': ['patient', 'research_subject'],
+    'human_phenotype': ['patient', 'research_subject'],
+    'sequencing_center': [],
+    'encounter': ['patient', 'research_subject'],
+    'condition': ['patient', 'research_subject'],
+    'measurement': ['patient', 'research_subject'],
+    'observation': ['patient', 'research_subject'],
+    'service_request': ['patient', 'specimen']
+}
+
+def init_logging(log_filename):
+    # This clears out previous logging entities so we can determine what and where to log
+    for handler in logging.root.handlers[:]:
+        logging.root.removeHandler(handler)
+
+    logging.basicConfig(filename=log_filename,
+                            filemode='wt',
+                            format='%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
+                            datefmt='%H:%M:%S',
+                            level=logging.WARNING)
+
+def cache_directory(input_file_dir, env, study_id, purge_ids=False):
+    """The environment's LoadStage cache directory (with the UID cache and
+    journal), emptied of previously loaded IDs if purge_ids is set"""
+    path_to_cache_storage_directory = Path(f"{input_file_dir}/{env}")
+    path_to_cache_storage_directory.mkdir(parents=True, exist_ok=True)
+
+    if purge_ids:
+        cache_file = f"{path_to_cache_storage_directory}/LoadStage/localhost_8000_{study_id}_uid_cache.db"
+        print(f"Purging local cache: {cache_file}")
+        try:
+            remove(cache_file)
+        except:
+            pass
+    return path_to_cache_storage_directory
+
+def bundle_directory(out, study_id, env):
+    return f"{out}/{study_id}-{env}-bundle"
+
+def open_bundle(out, study_id, env, bundle_options=None):
+    """The NdjsonWriter for the environment's bundle (see NdjsonWriter for
+    the bundle_options)"""
+    directory = bundle_directory(out, study_id, env)
+    print(f"Writing bundle: {directory}")
+    return NdjsonWriter(directory, **(bundle_options or {}))
+
+def load_study(fhir_host, env, study, out, class_names, tables=None, write_bundle=False, purge_ids=False, submitter=None, parallel_classes=1, resume=False, bundle_options=None):
+    """Load a study's transformed tables into fhir_host
+
+    If tables isn't provided, they are read from the study's transformed 
+    directory inside out. 
+
+    By default, the resources are loaded using LoadStage. If a submitter is
+    provided (such as a BatchSubmitter) the ResourceLoader is used instead, 
+    which hands the resources over to the submitter to send along. In that
+    case, up to parallel_classes classes are loaded at once as their
+    dependencies allow. Acknowledged resources are journaled and, when
+    resume is set, anything a previous (interrupted) run already loaded is
+    skipped.
+
+    With write_bundle, the resources are also written out. With a submitter,
+    that's NDJSON written as the server accepts them (see NdjsonWriter for the
+    bundle_options). LoadStage keeps the resources to itself, so it's left to
+    fhir_host's own bundle ({study_id}-{env}.json) as before."""
+    study_id = study['study_id']
+    study_name = study['study_name'].replace(' ', '_')
+
+    path_to_my_target_service_plugin = Path(fhir.__file__).parent / "fhir_plugin.py"
+    target_service_base_url = fhir_host.target_service_url
+
+    #pdb.set_trace()
+    print(f"Loading '{study_id}'")
+    log_filename = f"{out}/{study_name}-{env}-load.log"
+    print(f"Logfile: {log_filename}")
+    init_logging(log_filename)
+
+    fhir_host.init_log()
+    input_file_dir = f"{out}/{study_name}/transformed"
+    path_to_cache_storage_directory = cache_directory(input_file_dir, env, study_id, purge_ids)
+
+    if tables is None:
+        tables = read_transformed(input_file_dir)
+    basic_reports = build_basic_reports(tables, input_file_dir)
+
+    if submitter is not None:
+        uid_cache = UidCache(path_to_cache_storage_directory, target_service_base_url, study_id)
+        journal = LoadJournal(path_to_cache_storage_directory, study_id, resume=resume and not purge_ids)
+        bundle = open_bundle(out, study_id, env, bundle_options) if write_bundle else None
+        loader = ResourceLoader(
+            path_to_my_target_service_plugin,
+            uid_cache,
+            submitter,
+            journal,
+            bundle=bundle
+        )
+        try:
+            outcome = loader.run(class_names, basic_reports, parallel_classes, class_dependencies)
+        finally:
+            if bundle is not None:
+                bundle.close()
+            uid_cache.close()
+            journal.close()
+    else:
+        if write_bundle:
+            fhir_host.init_bundle(f"{out}/{study_id}-{env}.json", study_id)
+        use_async = True #use_async = True
+        try:
+            outcome = LoadStage(
+                path_to_my_target_service_plugin,
+                target_service_base_url,
+                class_names,
+                study_id,
+                str(path_to_cache_storage_directory),
+                use_async=use_async
+            ).run(basic_reports)
+        finally:
+            fhir_host.close_bundle()
+
+    return outcome
+
+def load_study_environments(fhir_hosts, submitters, study, out, class_names, tables=None, purge_ids=False, parallel_classes=1, resume=False, write_bundle=False, bundle_options=None):
+    """Load a study into several environments at once (see FanOutLoader)
+
+    fhir_hosts and submitters are {env: FhirClient} and {env: submitter}.
+    The tables are read and the resources built only once, and then sent to
+    every environment concurrently. Each environment keeps it's own UID
+    cache and journal, just as with load_study, along with it's own log (and
+    bundle, with write_bundle).
+
+    Returns {env: outcome}"""
+    study_id = study['study_id']
+    study_name = study['study_name'].replace(' ', '_')
+
+    path_to_my_target_service_plugin = Path(fhir.__file__).parent / "fhir_plugin.py"
+
+    print(f"Loading '{study_id}' into {', '.join(fhir_hosts)}")
+    log_filename = f"{out}/{study_name}-fanout-load.log"
+    print(f"Logfile: {log_filename}")
+    init_logging(log_filename)
+
+    input_file_dir = f"{out}/{study_name}/transformed"
+    if tables is None:
+        tables = read_transformed(input_file_dir)
+    basic_reports = build_basic_reports(tables, input_file_dir)
+
+    loaders = {}
+    handlers = []
+    for env, fhir_host in fhir_hosts.items():
+        fhir_host.init_log()
+        path_to_cache_storage_directory = cache_directory(input_file_dir, env, study_id, purge_ids)
+
+        # Whatever the fan out reports about an environment goes to it's own
+        # log (as well as the shared one)
+        handler = logging.FileHandler(f"{out}/{study_name}-{env}-load.log", mode='wt')
+        handler.setFormatter(logging.Formatter('%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s', datefmt='%H:%M:%S'))
+        log = logging.getLogger(f"{__name__}.{env}")
+        log.addHandler(handler)
+        handlers.append((log, handler))
+
+        loaders[env] = ResourceLoader(
+            path_to_my_target_service_plugin,
+            UidCache(path_to_cache_storage_directory, fhir_host.target_service_url, study_id),
+            submitters[env],
+            LoadJournal(path_to_cache_storage_directory, study_id, resume=resume and not purge_ids),
+            label=env,
+            log=log,
+            bundle=open_bundle(out, study_id, env, bundle_options) if write_bundle else None
+        )
+
+    try:
+        outcome = FanOutLoader(path_to_my_target_service_plugin, loaders).run(class_names, basic_reports, parallel_classes, class_dependencies)
+    finally:
+        for loader in loaders.values():
+            if loader.bundle is not None:
+                loader.bundle.close()
+            loader.uid_cache.close()
+            loader.journal.close()
+        for log, handler in handlers:
+            log.removeHandler(handler)
+            handler.close()
+    return outcome
+
+def import_study(fhir_host, env, study, out, class_names, session, tables=None, purge_ids=False, import_options=None):
+    """Load a study's transformed tables into fhir_host using $import (see
+    BulkImporter). The NDJSON files are written to import_options' directory
+    (by default, OUT/{study_id}-{env}-import). The rest of import_options are
+    passed along to BulkImporter.run (base_url, serve and public_host) aside
+    from poll_interval and timeout, which go to the BulkImporter itself.
+
+    Returns {class_name: (loaded, missing)}"""
+    study_id = study['study_id']
+    study_name = study['study_name'].replace(' ', '_')
+    import_options = dict(import_options or {})
+
+    path_to_my_target_service_plugin = Path(fhir.__file__).parent / "fhir_plugin.py"
+
+    print(f"Importing '{study_id}'")
+    log_filename = f"{out}/{study_name}-{env}-load.log"
+    print(f"Logfile: {log_filename}")
+    init_logging(log_filename)
+
+    fhir_host.init_log()
+    input_file_dir = f"{out}/{study_name}/transformed"
+    path_to_cache_storage_directory = cache_directory(input_file_dir, env, study_id, purge_ids)
+
+    if tables is None:
+        tables = read_transformed(input_file_dir)
+    basic_reports = build_basic_reports(tables, input_file_dir)
+
+    uid_cache = UidCache(path_to_cache_storage_directory, fhir_host.target_service_url, study_id)
+    directory = import_options.pop('directory', None) or f"{out}/{study_id}-{env}-import"
+    importer_args = {k: import_options.pop(k) for k in ['poll_interval', 'timeout'] if k in import_options}
+    try:
+        outcome = BulkImporter(path_to_my_target_service_plugin, uid_cache, session, study_id, **importer_args).run(
+                    class_names, basic_reports, directory, **import_options)
+    finally:
+        uid_cache.close()
+    return outcome
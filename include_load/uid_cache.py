@@ -0,0 +1,72 @@
+"""Local cache of the server assigned IDs for each loaded entity
+
+This uses the same file and layout LoadStage uses for it's own UID cache (a
+SqliteDict table per entity type inside the LoadStage cache directory, keyed
+by the entity's unique key), so entities loaded by the alternative loaders
+here are recognized by LoadStage on later runs and vice versa.
+
+Each SqliteDict table has it's own connection to the same file, and SQLite
+only allows one of those to be writing at a time. So new IDs are held in
+memory until commit(), which writes them out one table after the other. That
+way several classes can be loaded at once without tripping over each other.
+"""
+
+from pathlib import Path
+from threading import Lock
+from urllib.parse import urlparse
+
+from sqlitedict import SqliteDict
+
+def uid_cache_filename(cache_dir, target_url, study_id):
+    netloc = urlparse(target_url).netloc.replace(":", "_")
+    return Path(cache_dir) / "LoadStage" / f"{netloc}_{study_id}_uid_cache.db"
+
+class UidCache:
+    def __init__(self, cache_dir, target_url, study_id):
+        self.filename = uid_cache_filename(cache_dir, target_url, study_id)
+        self.filename.parent.mkdir(parents=True, exist_ok=True)
+        self.tables = {}
+        self.pending = {}           # entity_type => key => target_id
+        self.lock = Lock()
+
+    def table_unlocked(self, entity_type):
+        if entity_type not in self.tables:
+            self.tables[entity_type] = SqliteDict(str(self.filename),
+                        tablename=entity_type,
+                        autocommit=False)
+        return self.tables[entity_type]
+
+    def table(self, entity_type):
+        with self.lock:
+            return self.table_unlocked(entity_type)
+
+    def get(self, entity_type, key):
+        key = str(key)
+        with self.lock:
+            pending = self.pending.get(entity_type)
+            if pending is not None and key in pending:
+                return pending[key]
+        return self.table(entity_type).get(key)
+
+    def set(self, entity_type, key, target_id):
+        with self.lock:
+            self.pending.setdefault(entity_type, {})[str(key)] = target_id
+
+    def flush(self):
+        for entity_type, pending in self.pending.items():
+            if len(pending) > 0:
+                table = self.table_unlocked(entity_type)
+                table.update(pending)
+                table.commit()
+        self.pending = {}
+
+    def commit(self):
+        with self.lock:
+            self.flush()
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            for table in self.tables.values():
+                table.close()
+            self.tables = {}
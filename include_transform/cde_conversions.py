@@ -10,12 +10,27 @@ the colnames were not changed
 
 MCD DD ties a common var to HPO, Mondo and ICD where possible
 Merge links a specific var from a given dataset (such as HTP) and the varname in the MCD
+
+Once parsed, the lookups are compiled down to an immutable tuple of matches for
+each dataset variable. If an index directory is provided, those are pickled to
+disk keyed by a hash of the merge/MCD contents so that subsequent runs using the
+same dictionaries can skip the parsing entirely.
 """
 
-from collections import defaultdict
+from collections import defaultdict, Counter
+from pathlib import Path
 import csv
+import hashlib
+import logging
+import os
+import pickle
 import pdb
 
+log = logging.getLogger(__name__)
+
+# Bump this whenever the layout of the pickled index changes
+INDEX_VERSION = 1
+
 class NoCodeFound:
     def __init__(self, source, label):
         super.__init__(f"No Code Found for {source}:{label}")
@@ -37,7 +52,7 @@ class DictEntry:
             assert(self.code not in DictEntry.all_codes)
             if self.code is None or self.code.strip() == "" or self.code in ['N/A']:
                 raise NoCodeFound(label, varname)
-            DictEntry.all_codes[label][self.code] = self
+            DictEntry.register(label, self)
         else:
             # We have a header with 10 (I guess) identically named columns. 
             # Can't use csv dict reader for that, since it seems to overwrite
@@ -57,36 +72,137 @@ class DictEntry:
                     writer.write(f"* #{code.code} \"{code.label}\"\n")
             writer.write("\n\n")
 
+    @classmethod
+    def register(cls, label, entry):
+        cls.all_codes[label][entry.code] = entry
+
+def index_key(merge, mcd_dd, merge_col):
+    """Hash of the dictionary contents (and column) used to build the index"""
+    hasher = hashlib.sha256(f"{INDEX_VERSION}:{merge_col}:".encode())
+    for filename in [merge, mcd_dd]:
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                hasher.update(block)
+        hasher.update(b"\0")
+    return hasher.hexdigest()
+
 class CdeVar:
     def get_matches(self, code):
-        matches = []
-
-        if code in self.hpo:
-            #pdb.set_trace()
-            matches.append([
-                DictEntry.cs_urls["HPO"],
-                self.hpo[code].label, 
-                self.hpo[code].code
-            ])
-        if code in self.mondo:
-            matches.append([
-                DictEntry.cs_urls["Mondo"],
-                self.mondo[code].label,
-                self.mondo[code].code
-            ])
-        
+        matches = self.matches.get(code, ())
 
         if len(matches) == 0:
-            print(f"No match for code {code}")
+            if code not in self.unmatched:
+                log.debug("No match for code %s", code)
+            self.unmatched[code] += 1
             #pdb.set_trace()
         return matches
 
-    def __init__(self, merge, mcd_dd, merge_col):
+    def condition_rows(self, condition_desc, affected_status):
+        """The columns shared by every condition row written for the condition
+        as ((disease_id, code, description, system, name), (affected_status,
+        description)) for each of the rows. These are only worked out once
+        per (condition, affected status)"""
+        key = (condition_desc, affected_status)
+        rows = self.row_templates.get(key)
+        if rows is not None:
+            # Keep counting every time an unmatched code comes up
+            if condition_desc in self.unmatched:
+                self.unmatched[condition_desc] += 1
+            return rows
+
+        rows = []
+        condition_id = None
+        for condition_system, condition_name, condition_code in self.get_matches(condition_desc):
+            if condition_code is not None and condition_code.strip() != "":
+                if condition_id is None:
+                    condition_id = condition_code
+                rows.append(((condition_id, condition_code, condition_desc, condition_system, condition_name), 
+                            (affected_status, condition_desc)))
+        if len(rows) == 0:
+            rows.append(((None, None, condition_desc, None, condition_desc), (affected_status, condition_desc)))
+
+        rows = tuple(rows)
+        self.row_templates[key] = rows
+        return rows
+
+    def __init__(self, merge, mcd_dd, merge_col, index_dir=None):
+        # code => number of times get_matches came up empty for it
+        self.unmatched = Counter()
+        # (condition, affected status) => condition_rows
+        self.row_templates = {}
+        index_file = None
+        if index_dir is not None:
+            index_file = Path(index_dir) / f"cde-{index_key(merge, mcd_dd, merge_col)}.pickle"
+            if index_file.is_file():
+                self.load_index(index_file)
+                return
+
+        self.parse(merge, mcd_dd, merge_col)
+        self.compile()
+
+        if index_file is not None:
+            self.save_index(index_file)
+
+    def compile(self):
+        """Resolve each dataset variable to it's (system, label, code) matches"""
+        self.matches = {}
+        for ds_var in set(self.hpo) | set(self.mondo):
+            matches = []
+            if ds_var in self.hpo:
+                matches.append((DictEntry.cs_urls["HPO"], self.hpo[ds_var].label, self.hpo[ds_var].code))
+            if ds_var in self.mondo:
+                matches.append((DictEntry.cs_urls["Mondo"], self.mondo[ds_var].label, self.mondo[ds_var].code))
+            self.matches[ds_var] = tuple(matches)
+
+    def use_displays(self, displays):
+        """Name each match after the display the terminology has for it
+        ({(system, code): display}), keeping the dictionary's label for any
+        code without one"""
+        for ds_var, matches in self.matches.items():
+            self.matches[ds_var] = tuple((system, displays.get((system, code)) or label, code) 
+                        for system, label, code in matches)
+        # Any rows already worked out still carry the old names
+        self.row_templates = {}
+
+    def save_index(self, filename):
+        filename.parent.mkdir(parents=True, exist_ok=True)
+        # Write then rename, so concurrent runs never see a partial index
+        tmpname = filename.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmpname, 'wb') as f:
+            pickle.dump({
+                'cde': self.cde,
+                'hpo': self.hpo,
+                'mondo': self.mondo,
+                'icd': self.icd,
+                'registered': self.registered,
+                'matches': self.matches
+            }, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpname, filename)
+
+    def load_index(self, filename):
+        with open(filename, 'rb') as f:
+            index = pickle.load(f)
+
+        self.cde = index['cde']
+        self.hpo = index['hpo']
+        self.mondo = index['mondo']
+        self.icd = index['icd']
+        self.registered = index['registered']
+        self.matches = index['matches']
+
+        # The FSH fragments are dumped from the class level codes, so those 
+        # have to be registered in the same order parsing would have
+        for label, entry in self.registered:
+            DictEntry.register(label, entry)
+
+    def parse(self, merge, mcd_dd, merge_col):
         # All of these will point pheno=>relevant code if there is a valid match
         self.cde = dict()
         self.hpo = dict()
         self.mondo = dict()
         self.icd = dict()
+        # (label, DictEntry) in the order they were added to DictEntry.all_codes
+        self.registered = []
 
         #pdb.set_trace()
         # Get the vars we are interested in 
@@ -110,25 +226,25 @@ class CdeVar:
                 if cde_var in self.cde:
                     #pdb.set_trace()
                     ds_var = self.cde[cde_var]
-                    if ds_var and ds_var.strip() is not "":
+                    if ds_var and ds_var.strip() != "":
                         try:
                             #pdb.set_trace()
                             
                             self.hpo[ds_var] = DictEntry(row, 'HPO', cde_var)
-                        except:
+                            self.registered.append(('HPO', self.hpo[ds_var]))
+                        except Exception:
                             if row['HPO ID'] != "N/A":
-                                pdb.set_trace()
-                                pass
+                                log.exception("Unable to build the HPO entry for %s (%s)", cde_var, row['HPO ID'])
                             
                         try:
                             self.mondo[ds_var] = DictEntry(row, 'Mondo', cde_var)
-                        except:
-                            print(sorted(row.keys()))
+                            self.registered.append(('Mondo', self.mondo[ds_var]))
+                        except Exception:
+                            log.debug(sorted(row.keys()))
                             if row['Mondo ID'] != 'N/A':
-                                pdb.set_trace()
-                                pass
+                                log.exception("Unable to build the Mondo entry for %s (%s)", cde_var, row['Mondo ID'])
                 else:
-                    print(f"Skipping code {cde_var}")
+                    log.debug("Skipping code %s", cde_var)
         #pdb.set_trace()
 
     def write_cde_to_terms(self, filename):
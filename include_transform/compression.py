@@ -0,0 +1,85 @@
+"""Transparent compression for the transform's inputs and outputs
+
+The HTP exports tend to arrive gzip or zstd compressed. Rather than
+decompressing those to disk first, the inputs are decompressed as they are
+read. Compressed inputs are recognized by their leading bytes, so the file
+extension doesn't matter. Output compression is chosen by the extension
+(.gz, .bz2 or .zst).
+
+Reads and writes go through large buffers, since the (de)compressors work
+best on big blocks. zstd requires the zstandard package.
+"""
+
+import bz2
+import gzip
+import io
+from pathlib import Path
+
+# Bytes read or written at a time
+BUFFER_SIZE = 1024 * 1024
+
+# Leading bytes of each of the compressed formats
+magic_numbers = [
+    (b'\x1f\x8b', 'gzip'),
+    (b'BZh', 'bz2'),
+    (b'\x28\xb5\x2f\xfd', 'zstd')
+]
+
+# Extension => compression used when writing
+extensions = {
+    '.gz': 'gzip',
+    '.bz2': 'bz2',
+    '.zst': 'zstd',
+    '.zstd': 'zstd'
+}
+
+def detect(filename):
+    """The compression used for an existing file (None if it's not compressed)"""
+    with open(filename, 'rb') as f:
+        start = f.read(4)
+    for magic, compression in magic_numbers:
+        if start.startswith(magic):
+            return compression
+    return None
+
+def compression_for(filename):
+    """The compression the file should be written with, based on it's name"""
+    return extensions.get(Path(filename).suffix.lower())
+
+def open_binary(filename, mode='rb', compression=None, level=None):
+    """Open the file for reading or writing bytes, (de)compressing as needed.
+    Unless given, the compression is detected (reading) or taken from the
+    file's extension (writing)"""
+    reading = mode.startswith('r')
+    mode = 'rb' if reading else 'wb'
+    if compression is None:
+        compression = detect(filename) if reading else compression_for(filename)
+
+    if compression is None:
+        return open(filename, mode, buffering=BUFFER_SIZE)
+    if compression == 'gzip':
+        stream = gzip.open(filename, mode, compresslevel=level or 6)
+    elif compression == 'bz2':
+        stream = bz2.open(filename, mode, compresslevel=level or 9)
+    elif compression == 'zstd':
+        import zstandard
+
+        raw = open(filename, mode, buffering=BUFFER_SIZE)
+        if reading:
+            stream = zstandard.ZstdDecompressor().stream_reader(raw, read_size=BUFFER_SIZE, closefd=True)
+        else:
+            stream = zstandard.ZstdCompressor(level=level or 3).stream_writer(raw, write_size=BUFFER_SIZE, closefd=True)
+    else:
+        raise ValueError(f"Unknown compression, {compression}")
+
+    # Hand the compressors big blocks rather than a line at a time
+    if reading:
+        return io.BufferedReader(stream, buffer_size=BUFFER_SIZE)
+    return io.BufferedWriter(stream, buffer_size=BUFFER_SIZE)
+
+def open_text(filename, mode='rt', encoding=None, newline=None, compression=None, level=None):
+    """Text mode version of open_binary. Reading defaults to utf-8-sig, like
+    the rest of the transform's inputs"""
+    if encoding is None:
+        encoding = 'utf-8-sig' if mode.startswith('r') else 'utf-8'
+    return io.TextIOWrapper(open_binary(filename, mode, compression=compression, level=level), encoding=encoding, newline=newline)
@@ -1,4 +1,6 @@
 from cmg_transform import Transform
+from include_transform.records import interned
+from include_transform.compression import detect
 from ncpi_fhir_plugin.common import CONCEPT, constants
 import pdb
 """For include, (at least for the HTP samples I'm using for reference) this will
@@ -6,14 +8,30 @@ cover the Specimen, Encounter and the measurements: BMI, Height and Weight
 """
 invalid_values = set(["", "NA"])
 
+# (attribute, units, LOINC code, name, derived from, alt codes) for each 
+# of the measurements captured from the encounter row
+measurement_types = [
+    ('height_cm', 'cm', '8302-2', 'Body height', None, 'https://www.ohdsi.org^^3036277'),
+    ('weight_kg', 'kg', '29463-7', 'Body weight', None, 'https://www.ohdsi.org^^3025315'),
+    ('bmi', 'kg/m2', '39156-5', 'Body mass index (BMI) [Ratio]', '8302-2|29463-7', 'https://www.ohdsi.org^^3038553')
+]
+units_system = "http://unitsofmeasure.org"
+tissue_type = "UBERON:0000178"
+tissue_type_name = "whole blood"
+
+# Rows read at a time by the columnar writer
+DEFAULT_CHUNKSIZE = 200000
+
 class Encounter:
+    __slots__ = ('id', 'encounter_id', 'age_at_event', 'sample_id', 'weight_kg', 'height_cm', 'bmi')
+
     def __init__(self, row):
         #pdb.set_trace()
         self.id = Transform.CleanSubjectId(Transform.ExtractVar(row, 'participantid'))
         #self.encounter_id = Transform.ExtractID(row, 'event_name')
         if row.get("event_name") is not None:
             #pdb.set_trace()
-            self.encounter_id = row["event_name"].split(" ")[-1] #Transform.ExtractID(row, 'event_name')
+            self.encounter_id = interned(row["event_name"].split(" ")[-1]) #Transform.ExtractID(row, 'event_name')
         self.age_at_event = Transform.ExtractVar(row, 'age_at_visit')
         # "whole blood": "UBERON:0000178"
         self.sample_id = Transform.ExtractVar(row, 'labid')
@@ -45,58 +63,125 @@ class Encounter:
     # We'll have different rows for each subject
     def write_measurements(self, study, writer):
         global invalid_values
-        # Height
-        if self.height_cm is not None and self.height_cm.strip() not in invalid_values:
-            writer.writerow([
-                study,
-                self.id,
-                self.sample_id,
-                self.age_at_event,
-                self.encounter_id,
-                self.height_cm,
-                'cm',
-                "http://unitsofmeasure.org",
-                '8302-2',
-                'Body height',
-                None,
-                'https://www.ohdsi.org^^3036277',
-                None,
-                "UBERON:0000178",
-                "whole blood"
-            ])
-
-        if self.weight_kg is not None and self.weight_kg.strip() not in invalid_values:
-            writer.writerow([
-                study,
-                self.id,
-                self.sample_id,
-                self.age_at_event,
-                self.encounter_id,
-                self.weight_kg,
-                'kg',
-                "http://unitsofmeasure.org",
-                '29463-7',
-                'Body weight',
-                None,
-                'https://www.ohdsi.org^^3025315',
-                None,
-                "UBERON:0000178",
-                "whole blood"])
-
-        if self.bmi is not None and self.bmi.strip() not in invalid_values:
-            writer.writerow([
-                study, 
-                self.id,
-                self.sample_id,
-                self.age_at_event,
-                self.encounter_id,
-                self.bmi,
-                'kg/m2',
-                "http://unitsofmeasure.org",
-                '39156-5',
-                'Body mass index (BMI) [Ratio]',
-                '8302-2|29463-7',
-                'https://www.ohdsi.org^^3038553',
-                None,
-                "UBERON:0000178",
-                "whole blood"])
\ No newline at end of file
+        for attr, units, code, name, derived_from, alt_codes in measurement_types:
+            value = getattr(self, attr)
+            if value is not None and value.strip() not in invalid_values:
+                writer.writerow([
+                    study,
+                    self.id,
+                    self.sample_id,
+                    self.age_at_event,
+                    self.encounter_id,
+                    value,
+                    units,
+                    units_system,
+                    code,
+                    name,
+                    derived_from,
+                    alt_codes,
+                    None,
+                    tissue_type,
+                    tissue_type_name
+                ])
+
+def columnar_supported(consent):
+    """The columnar writer takes the values straight from the file, so it
+    can only be used when Transform.ExtractVar and CleanSubjectId would have
+    nothing to do: no field map, data map or invalid IDs for the consent
+    group (or left over from one loaded before it)"""
+    # The maps rename columns and rewrite values one cell at a time, and the
+    # invalid IDs are dropped as they're read, all inside Transform. Redoing
+    # that in bulk would mean a second copy of cmg_transform's rules that
+    # could quietly drift from it, so any of them sends us back to the
+    # row-wise writer
+    for key in ['field_map', 'data_map', 'invalid-ids']:
+        if key in consent:
+            return False
+    for loaded in ['_field_map', '_data_map', '_data_transform', '_invalid_ids']:
+        if getattr(Transform, loaded, None):
+            return False
+    return True
+
+def write_measurements_columnar(filename, study, writer, delimiter="\t", chunksize=DEFAULT_CHUNKSIZE, only=None):
+    """Columnar equivalent of building an Encounter for each row and calling
+    write_measurements. 
+
+    The encounter file is read in chunks and the height/weight/bmi columns are
+    melted into the long measurement format in bulk. Rows are written in the 
+    same order as the row-wise path (by encounter and then height, weight, 
+    bmi) so the resulting file is identical.
+
+    Values are taken directly from the file, so this doesn't honor any of the
+    field or data maps (or invalid IDs) that Transform.ExtractVar would apply.
+    Check columnar_supported first.
+
+    If only is provided, measurements are restricted to those participants.
+
+    Returns the number of encounter rows read."""
+    import pandas as pd
+
+    required = ['participantid', 'event_name']
+    optional = ['age_at_visit', 'labid'] + [m[0] for m in measurement_types]
+    wanted = set(required + optional)
+
+    chunks = pd.read_csv(filename, 
+                sep=delimiter, 
+                quotechar='"',
+                dtype=str, 
+                keep_default_na=False, 
+                encoding='utf-8-sig', 
+                compression=detect(filename),
+                usecols=lambda col: col in wanted,
+                chunksize=chunksize)
+    clean_ids = {}
+    rows_read = 0
+    for chunk in chunks:
+        rows_read += len(chunk)
+        for col in required:
+            if col not in chunk.columns:
+                raise KeyError(col)
+        for col in optional:
+            if col not in chunk.columns:
+                chunk[col] = None
+
+        for pid in chunk['participantid'].unique():
+            if pid not in clean_ids:
+                clean_ids[pid] = Transform.CleanSubjectId(pid)
+
+        base = pd.DataFrame({
+            'study': study,
+            'id': chunk['participantid'].map(clean_ids),
+            'sample_id': chunk['labid'],
+            'age_at_event': chunk['age_at_visit'],
+            'encounter_id': chunk['event_name'].str.split(" ").str[-1]
+        }, index=chunk.index)
+        selected = pd.Series(True, index=chunk.index)
+        if only is not None:
+            selected = base['id'].isin(only)
+
+        parts = []
+        for order, (attr, units, code, name, derived_from, alt_codes) in enumerate(measurement_types):
+            values = chunk[attr]
+            keep = selected & values.notna() & ~values.str.strip().isin(invalid_values)
+            if keep.any():
+                parts.append(base[keep].assign(
+                    value=values[keep],
+                    units=units,
+                    units_system=units_system,
+                    code=code,
+                    name=name,
+                    derived_from=derived_from,
+                    alt_codes=alt_codes,
+                    desc=None,
+                    tissue_type=tissue_type,
+                    tissue_type_name=tissue_type_name,
+                    _row=chunk.index.to_numpy()[keep.to_numpy()],
+                    _order=order))
+
+        if len(parts) > 0:
+            measurements = pd.concat(parts).sort_values(['_row', '_order'], kind='stable')
+            measurements = measurements.drop(columns=['_row', '_order'])
+            # Keep None as None so csv writes them as empty strings like before
+            measurements = measurements.astype(object).where(measurements.notna(), None)
+            writer.writerows(measurements.itertuples(index=False, name=None))
+    return rows_read
@@ -0,0 +1,159 @@
+"""Track what has changed for each participant between transform runs
+
+Every participant is summarized by a single content hash covering their row
+in the participant file along with all of their condition, ds_condition and
+encounter rows. Those hashes are kept in a small sqlite database in the study's
+output directory so that the next run can tell which participants were added,
+modified or removed upstream and only re-emit those.
+
+The hashes also cover the CDE dictionaries (see cde_conversions.index_key)
+and HASH_VERSION, so a dictionary change, or a change to how the rows are
+hashed, marks every participant as modified.
+
+A run which has only some participants to re-emit writes tables holding just
+those participants (the delta), not the whole study. Those tables, along with
+removed.tsv, are what gets loaded on top of what's already on the server.
+Rows for participants who aren't in the participant file are left out of the
+hashes, just as the transform skips them.
+
+The input files are grouped by participant using the same external sort the
+streaming transform uses, so memory stays bounded regardless of cohort size.
+"""
+
+import csv
+import hashlib
+import heapq
+import json
+import sqlite3
+from itertools import groupby
+from operator import itemgetter
+from pathlib import Path
+
+from cmg_transform import Transform
+from include_transform.compression import open_text
+from include_transform.patient import Patient
+from include_transform.streaming import external_sort, DEFAULT_CHUNK_SIZE
+from include_transform.wide import ConsentSections
+
+# Bump this whenever the hashed content changes, so the next run treats
+# everyone as modified rather than comparing against incompatible hashes
+HASH_VERSION = 2
+
+# The tags used to keep the input files apart inside the hash
+tags = {
+    'participant': 'P',
+    'condition': 'C',
+    'ds_condition': 'D',
+    'encounter': 'E'
+}
+
+def _keyed_rows(records):
+    for section, line in records:
+        if section == 'participant':
+            pid = Patient(line).id
+        elif section == 'encounter':
+            pid = Transform.CleanSubjectId(Transform.ExtractVar(line, 'participantid'))
+        else:
+            pid = line['participantid']
+        yield (pid, (tags[section], json.dumps(line, sort_keys=True)))
+
+def _encounter_records(consent, delim):
+    with open_text(consent['encounter']) as file:
+        for line in Transform.GetReader(file, delimiter=delim):
+            yield 'encounter', line
+
+def hash_participants(consent, delim, dictionary_key="", chunk_size=DEFAULT_CHUNK_SIZE, tmpdir=None):
+    """Yield (participant_id, hash) in participant order for a consent group
+
+    dictionary_key identifies the CDE dictionaries the rows will be
+    transformed with and is folded into every hash"""
+    prefix = f"{HASH_VERSION}:{dictionary_key}\n".encode()
+    streams = [
+        external_sort(_keyed_rows(ConsentSections(consent, delim).records()), chunk_size, tmpdir),
+        external_sort(_keyed_rows(_encounter_records(consent, delim)), chunk_size, tmpdir)
+    ]
+
+    # Ties are broken by stream order (and the sorts are stable), so each 
+    # participant's rows are hashed in the order they were read, followed by
+    # their encounters
+    for pid, rows in groupby(heapq.merge(*streams, key=itemgetter(0)), key=itemgetter(0)):
+        hasher = hashlib.sha256(prefix)
+        has_participant = False
+        for _, (tag, row) in rows:
+            has_participant = has_participant or tag == 'P'
+            hasher.update(tag.encode())
+            hasher.update(row.encode())
+            hasher.update(b"\n")
+        # Condition or encounter rows without a participant row never
+        # make it into the outputs, so they aren't changes either
+        if has_participant:
+            yield pid, hasher.hexdigest()
+
+class ParticipantHashes:
+    def __init__(self, filename):
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS participant_hash(
+            participant_id TEXT PRIMARY KEY,
+            consent_group TEXT,
+            hash TEXT)""")
+        self.db.execute("DROP TABLE IF EXISTS pending_hash")
+        self.db.execute("""CREATE TABLE pending_hash(
+            participant_id TEXT PRIMARY KEY,
+            consent_group TEXT,
+            hash TEXT)""")
+        self.db.commit()
+
+    def prior_run_exists(self):
+        return self.db.execute("SELECT 1 FROM participant_hash LIMIT 1").fetchone() is not None
+
+    def add(self, consent_group, hashes):
+        """hashes is an iterable of (participant_id, hash) for this run"""
+        self.db.executemany("INSERT OR REPLACE INTO pending_hash VALUES (?, ?, ?)",
+                ((pid, consent_group, digest) for pid, digest in hashes))
+
+    def added(self):
+        return self.db.execute("""SELECT p.participant_id, p.consent_group
+            FROM pending_hash p LEFT JOIN participant_hash h USING (participant_id)
+            WHERE h.participant_id IS NULL
+            ORDER BY p.participant_id""")
+
+    def modified(self):
+        return self.db.execute("""SELECT p.participant_id, p.consent_group
+            FROM pending_hash p JOIN participant_hash h USING (participant_id)
+            WHERE p.hash != h.hash OR p.consent_group IS NOT h.consent_group
+            ORDER BY p.participant_id""")
+
+    def removed(self):
+        return self.db.execute("""SELECT h.participant_id, h.consent_group
+            FROM participant_hash h LEFT JOIN pending_hash p USING (participant_id)
+            WHERE p.participant_id IS NULL
+            ORDER BY h.participant_id""")
+
+    def write_changeset(self, dirname):
+        """Write added/modified/removed.tsv into dirname and return the ids
+        of the participants which need to be re-emitted"""
+        dirname = Path(dirname)
+        dirname.mkdir(parents=True, exist_ok=True)
+
+        changed = set()
+        for change, query in [('added', self.added), ('modified', self.modified), ('removed', self.removed)]:
+            with open(dirname / f"{change}.tsv", 'wt') as f:
+                writer = csv.writer(f, delimiter='\t', quotechar='"')
+                writer.writerow(['participant_id', 'consent_group'])
+                for pid, consent_group in query():
+                    writer.writerow([pid, consent_group])
+                    if change != 'removed':
+                        changed.add(pid)
+        return changed
+
+    def commit(self):
+        """Make this run's hashes the baseline for the next run. This should
+        only happen once the outputs have been written successfully."""
+        self.db.execute("DELETE FROM participant_hash")
+        self.db.execute("INSERT INTO participant_hash SELECT * FROM pending_hash")
+        self.db.execute("DROP TABLE pending_hash")
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,218 @@
+"""Timings and counts gathered while transforming a study
+
+The transform reports:
+    * rows, wall time and peak RSS for each input file it reads
+    * rows and time spent writing each of the transformed tables
+    * wall time for each stage (building the CdeVar, Run(), etc)
+    * counters such as the number of remote term lookups and the CDE codes
+      for which no match could be found
+
+These can be dumped as JSON or as a Prometheus textfile (for the node
+exporter's textfile collector). A disabled TransformMetrics hands back the
+iterables and writers it's given untouched, so it costs nothing when no
+report was asked for.
+"""
+
+import json
+import resource
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+def peak_rss_bytes():
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class MeteredWriter:
+    """Counts the rows passed along to writer and the time spent writing them"""
+    def __init__(self, writer, stats):
+        self.writer = writer
+        self.stats = stats
+
+    def writerow(self, row):
+        start = time.perf_counter()
+        self.writer.writerow(row)
+        self.stats['seconds'] += time.perf_counter() - start
+        self.stats['rows'] += 1
+
+    def writerows(self, rows):
+        rows = list(rows)
+        start = time.perf_counter()
+        self.writer.writerows(rows)
+        self.stats['seconds'] += time.perf_counter() - start
+        self.stats['rows'] += len(rows)
+
+class TransformMetrics:
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.inputs = {}            # filename => {kind, rows, seconds, peak_rss_bytes}
+        self.outputs = {}           # table => {rows, seconds}
+        self.stages = {}            # stage => {seconds, peak_rss_bytes}
+        self.counters = Counter()
+        self.unmatched = Counter()  # code => times it went unmatched
+
+    def input_stats(self, kind, filename):
+        return self.inputs.setdefault(str(filename), {'kind': kind, 'rows': 0, 'seconds': 0.0, 'peak_rss_bytes': 0})
+
+    def read(self, kind, filename, rows):
+        """Pass the rows along, counting them and timing how long it takes to
+        work through all of them"""
+        if not self.enabled:
+            yield from rows
+            return
+
+        stats = self.input_stats(kind, filename)
+        start = time.perf_counter()
+        try:
+            for row in rows:
+                stats['rows'] += 1
+                yield row
+        finally:
+            stats['seconds'] += time.perf_counter() - start
+            stats['peak_rss_bytes'] = peak_rss_bytes()
+
+    def read_records(self, filenames, records):
+        """read() for a single pass over several inputs at once. records are
+        (kind, row) and filenames maps each kind to it's input. The time spent
+        reading and working through each row is counted against it's input"""
+        if not self.enabled:
+            yield from records
+            return
+
+        stats = {kind: self.input_stats(kind, filename) for kind, filename in filenames.items()}
+        last = time.perf_counter()
+        try:
+            for kind, row in records:
+                stats[kind]['rows'] += 1
+                yield kind, row
+                now = time.perf_counter()
+                stats[kind]['seconds'] += now - last
+                last = now
+        finally:
+            for input_stats in stats.values():
+                input_stats['peak_rss_bytes'] = peak_rss_bytes()
+
+    @contextmanager
+    def input(self, kind, filename):
+        """For inputs that are read in bulk. Add to ['rows'] of the yielded dict"""
+        if not self.enabled:
+            yield {'rows': 0}
+            return
+
+        stats = self.input_stats(kind, filename)
+        start = time.perf_counter()
+        try:
+            yield stats
+        finally:
+            stats['seconds'] += time.perf_counter() - start
+            stats['peak_rss_bytes'] = peak_rss_bytes()
+
+    def writer(self, table, writer):
+        if not self.enabled:
+            return writer
+        stats = self.outputs.setdefault(table, {'rows': 0, 'seconds': 0.0})
+        return MeteredWriter(writer, stats)
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stats = self.stages.setdefault(name, {'seconds': 0.0, 'peak_rss_bytes': 0})
+            stats['seconds'] += time.perf_counter() - start
+            stats['peak_rss_bytes'] = peak_rss_bytes()
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] += n
+
+    def add_unmatched(self, unmatched):
+        if self.enabled:
+            self.unmatched.update(unmatched)
+
+    def as_dict(self):
+        return {
+            'inputs': {filename: dict(stats, rows_per_sec=rate(stats)) for filename, stats in self.inputs.items()},
+            'outputs': {table: dict(stats, rows_per_sec=rate(stats)) for table, stats in self.outputs.items()},
+            'stages': self.stages,
+            'counters': dict(self.counters),
+            'unmatched_codes': {
+                'total': sum(self.unmatched.values()),
+                'distinct': len(self.unmatched),
+                'codes': dict(self.unmatched.most_common())
+            },
+            'peak_rss_bytes': peak_rss_bytes()
+        }
+
+    def merge(self, other):
+        """Fold in the as_dict() from another process (such as a shard)"""
+        for filename, stats in other['inputs'].items():
+            mine = self.input_stats(stats['kind'], filename)
+            mine['rows'] += stats['rows']
+            mine['seconds'] += stats['seconds']
+            mine['peak_rss_bytes'] = max(mine['peak_rss_bytes'], stats['peak_rss_bytes'])
+        for table, stats in other['outputs'].items():
+            mine = self.outputs.setdefault(table, {'rows': 0, 'seconds': 0.0})
+            mine['rows'] += stats['rows']
+            mine['seconds'] += stats['seconds']
+        self.counters.update(other['counters'])
+        self.unmatched.update(other['unmatched_codes']['codes'])
+
+    def write_json(self, filename):
+        with open(filename, 'wt') as f:
+            json.dump(self.as_dict(), f, indent=2)
+
+    def write_prometheus(self, filename, study):
+        """Write the metrics in the Prometheus text exposition format"""
+        metrics = self.as_dict()
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append(f"# HELP include_transform_{name} {help}")
+            lines.append(f"# TYPE include_transform_{name} {kind}")
+            for labels, value in samples:
+                labels = ",".join(f'{k}="{escape(v)}"' for k, v in dict(labels, study=study).items())
+                lines.append(f"include_transform_{name}{{{labels}}} {value}")
+
+        inputs = metrics['inputs'].items()
+        metric("input_rows_total", "counter", "Rows read from each input file",
+                    [({'kind': stats['kind'], 'file': filename}, stats['rows']) for filename, stats in inputs])
+        metric("input_seconds", "gauge", "Wall time spent working through each input file",
+                    [({'kind': stats['kind'], 'file': filename}, stats['seconds']) for filename, stats in inputs])
+        metric("input_peak_rss_bytes", "gauge", "Peak RSS once each input file was done",
+                    [({'kind': stats['kind'], 'file': filename}, stats['peak_rss_bytes']) for filename, stats in inputs])
+
+        outputs = metrics['outputs'].items()
+        metric("output_rows_total", "counter", "Rows written to each transformed table",
+                    [({'table': table}, stats['rows']) for table, stats in outputs])
+        metric("output_seconds", "gauge", "Time spent writing rows to each transformed table",
+                    [({'table': table}, stats['seconds']) for table, stats in outputs])
+
+        metric("stage_seconds", "gauge", "Wall time for each stage of the transform",
+                    [({'stage': stage}, stats['seconds']) for stage, stats in metrics['stages'].items()])
+        for name, value in metrics['counters'].items():
+            metric(f"{name}_total", "counter", f"Count of {name.replace('_', ' ')}", [({}, value)])
+        metric("unmatched_codes_total", "counter", "Condition codes with no match in the CDE dictionaries",
+                    [({}, metrics['unmatched_codes']['total'])])
+        metric("unmatched_codes_distinct", "gauge", "Distinct condition codes with no match in the CDE dictionaries",
+                    [({}, metrics['unmatched_codes']['distinct'])])
+        metric("peak_rss_bytes", "gauge", "Peak RSS of the transform", [({}, metrics['peak_rss_bytes'])])
+
+        with open(filename, 'wt') as f:
+            f.write("\n".join(lines) + "\n")
+
+# Stands in wherever no metrics were asked for
+no_metrics = TransformMetrics(enabled=False)
+
+def rate(stats):
+    if stats['seconds'] > 0:
+        return stats['rows'] / stats['seconds']
+    return None
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
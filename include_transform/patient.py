@@ -3,44 +3,89 @@
 
 We are also capturing the condition strings in conditions_present and 
 conditions_absent arrays in order to populate the input for the basic
-condition objects
+condition objects. Those are packed into arrays of numbers from the shared
+condition_codes table, and the values shared by many participants (sex,
+race, statuses and the like) are interned, so that a large cohort fits 
+comfortably in memory. IDs are unique to a participant (or family), so
+there is nothing to gain by interning those.
 """
 
 from ncpi_fhir_plugin.common import CONCEPT, constants, GENDERFICATION
 from cmg_transform import Transform
+from include_transform.records import interned, condition_codes
 
+import logging
 import sys
 import pdb
 
+log = logging.getLogger(__name__)
+
 class Patient:
+    __slots__ = ('id', 'family_id', 'sex', 'cohort_type', 'race', 'eth', 'abstraction_status', 'phenotype_description',
+                'karyoptype', 'diagnosis', 'official_diag', 'age_of_onset', 'present', 'absent')
+
     def __init__(self, row):
         self.id = Transform.CleanSubjectId(Transform.ExtractVar(row, 'participantid'))
         self.family_id = Transform.ExtractVar(row, 'familyid')
-        self.sex = Transform.ExtractVar(row, 'sex', constants.GENDER)
-        self.cohort_type = Transform.ExtractVar(row, 'cohort_type')
-        self.race = Transform.ExtractVar(row, 'race', None)
+        self.sex = interned(Transform.ExtractVar(row, 'sex', constants.GENDER))
+        self.cohort_type = interned(Transform.ExtractVar(row, 'cohort_type'))
+        self.race = interned(Transform.ExtractVar(row, 'race', None))
         #pdb.set_trace()
-        self.eth = Transform.ExtractVar(row, 'ethnicity', constants.ETHNICITY)
-        self.abstraction_status = Transform.ExtractVar(row, 'mrabstractionstatus')
-        self.phenotype_description = Transform.ExtractVar(row, 'cohort_type')
+        self.eth = interned(Transform.ExtractVar(row, 'ethnicity', constants.ETHNICITY))
+        self.abstraction_status = interned(Transform.ExtractVar(row, 'mrabstractionstatus'))
+        self.phenotype_description = self.cohort_type
 
-        self.conditions_present = []
-        self.conditions_absent = []
+        # Numbers from condition_codes
+        self.present = condition_codes.packed()
+        self.absent = condition_codes.packed()
         self.age_of_onset = None
 
+    @property
+    def conditions_present(self):
+        return condition_codes.decode(self.present)
+
+    @property
+    def conditions_absent(self):
+        return condition_codes.decode(self.absent)
+
+    def add_condition(self, code, present=True):
+        if present:
+            self.present.append(condition_codes.encode(code))
+        else:
+            self.absent.append(condition_codes.encode(code))
+
+    def carry_conditions(self, other):
+        """Keep the conditions already loaded for other, an earlier row for
+        the same participant that this one replaces"""
+        self.present.extend(other.present)
+        self.absent.extend(other.absent)
+
+    def __getstate__(self):
+        # The code numbers only mean something to this process's table
+        state = {slot: getattr(self, slot) for slot in self.__slots__ if hasattr(self, slot)}
+        state['present'] = self.conditions_present
+        state['absent'] = self.conditions_absent
+        return state
+
+    def __setstate__(self, state):
+        for slot, value in state.items():
+            setattr(self, slot, value)
+        self.present = condition_codes.packed(state['present'])
+        self.absent = condition_codes.packed(state['absent'])
+
     def load_ds_condition(self, row):
         "SNOMED:734840008 - body structure for Karyotype"
         "LOINC:LP28493-2 Karyotype"
-        self.karyoptype = Transform.ExtractVar(row, 'karyotype')
-        self.diagnosis = Transform.ExtractVar(row, 'ds_diagnosis')
-        self.official_diag = Transform.ExtractVar(row, 'officialdsdiagnosis')
+        self.karyoptype = interned(Transform.ExtractVar(row, 'karyotype'))
+        self.diagnosis = interned(Transform.ExtractVar(row, 'ds_diagnosis'))
+        self.official_diag = interned(Transform.ExtractVar(row, 'officialdsdiagnosis'))
 
     # We'll just cache the present/absent bits accordingly
     def load_condition(self, row):
         if row['condition_status'] == "TRUE":
-            self.conditions_present.append(row['condition_code'])
+            self.add_condition(row['condition_code'], True)
         elif row['condition_status'] == 'FALSE':
-            self.conditions_absent.append(row['condition_code'])
+            self.add_condition(row['condition_code'], False)
 
     @classmethod
     def write_subject_header(self, writer):
@@ -84,7 +129,7 @@ class Patient:
     def write_disease(self, study_name, writer):
         ds_value = ""
 
-        print(f"Cohort: {self.cohort_type}")
+        log.debug("Cohort: %s", self.cohort_type)
         #pdb.set_trace()
         if self.cohort_type == 'Control':
             ds_value = 'Absent'
@@ -190,33 +235,18 @@ class Patient:
             ])
 
     def write_conditions(self, study_name, writer, cde_conversions):
-        for condition_desc in self.conditions_present:
-            aff_status = constants.PHENOTYPE.OBSERVED.PRESENT
-            codes_written = 0
-            condition_id = None
-            for code in cde_conversions.get_matches(condition_desc):
-                condition_system, condition_name, condition_code = code
-                if condition_code is not None and condition_code.strip() != "":
-                    if codes_written == 0:
-                        condition_id = condition_code
-                    self.write_condition_row(study_name, writer, condition_id, condition_code, condition_desc, condition_system, condition_name, aff_status)
-                    codes_written += 1
-            if codes_written == 0:
-                self.write_condition_row(study_name, writer, None, None, condition_desc, None, condition_desc, aff_status)
-
-        for condition_desc in self.conditions_absent:
-            aff_status = constants.PHENOTYPE.OBSERVED.ABSENT
-            codes_written = 0
-            condition_id = None
-            for code in cde_conversions.get_matches(condition_desc):
-                condition_system, condition_name, condition_code = code
-                if condition_code is not None and condition_code.strip() != "":
-                    if codes_written == 0:
-                        condition_id = condition_code
-                    self.write_condition_row(study_name, writer, condition_id, condition_code, condition_desc, condition_system, condition_name, aff_status)
-                    codes_written += 1
-            if codes_written == 0:
-                self.write_condition_row(study_name, writer, None, None, condition_desc, None, condition_desc, aff_status)
+        # Everything but the patient's own columns comes prebuilt from the CDE
+        prefix = (self.family_id, self.id, study_name)
+        onset = (self.age_of_onset,)
+        suffix = (self.phenotype_description,)
+
+        rows = []
+        for conditions, aff_status in [(self.conditions_present, constants.PHENOTYPE.OBSERVED.PRESENT),
+                                       (self.conditions_absent, constants.PHENOTYPE.OBSERVED.ABSENT)]:
+            for condition_desc in conditions:
+                for disease, status in cde_conversions.condition_rows(condition_desc, aff_status):
+                    rows.append(prefix + disease + onset + status + suffix)
+        writer.writerows(rows)
 
     def write_condition_row(self, study_name, writer, disease_id, disease_code, disease_description, disease_system, disease_name, affected_status):
         writer.writerow([
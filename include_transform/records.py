@@ -0,0 +1,47 @@
+"""Helpers for keeping the Patient and Encounter records compact
+
+A large cohort is mostly the same handful of strings over and over (sex,
+race, cohort type, condition codes and so on), each read from the file as
+it's own string object. Those values are interned so every participant
+shares a single copy of each, and the condition codes are stored as integers
+into a table of codes shared by every record in the process. Only intern
+values that repeat: a unique value, such as a participant or sample ID, 
+gains nothing and only pays for the trip through the intern table.
+"""
+
+import sys
+from array import array
+
+def interned(value):
+    """Share a single copy of the value with every other record"""
+    if type(value) is str:
+        return sys.intern(value)
+    return value
+
+class CodeTable:
+    """Maps each distinct code to a small integer and back again"""
+    def __init__(self):
+        self.codes = []
+        self.index = {}
+
+    def encode(self, code):
+        number = self.index.get(code)
+        if number is None:
+            number = len(self.codes)
+            self.index[code] = number
+            self.codes.append(interned(code))
+        return number
+
+    def decode(self, numbers):
+        codes = self.codes
+        return [codes[number] for number in numbers]
+
+    def packed(self, codes=()):
+        """An array of the codes' numbers (4 bytes each)"""
+        return array('I', [self.encode(code) for code in codes])
+
+    def __len__(self):
+        return len(self.codes)
+
+# Shared by every Patient's conditions
+condition_codes = CodeTable()
@@ -0,0 +1,52 @@
+"""Serialise the writes that dataset workers make to shared SQLite databases
+
+When several datasets are transformed at once (-j), every worker process
+writes to the same Variant cache. SQLite only allows a single writer at a
+time, so a transaction left open in one worker leaves the others failing
+with 'database is locked'.
+
+The wrapper here turns each write to the cache into a short transaction,
+taken and committed while holding a lock shared by all of the workers. Reads
+go straight through.
+"""
+
+class LockedCache:
+    """A mapping (such as a SqliteDict) whose writes are committed one at a
+    time under the lock"""
+    def __init__(self, cache, lock):
+        self._cache = cache
+        self._lock = lock
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._cache[key] = value
+            self._cache.commit()
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self._cache[key]
+            self._cache.commit()
+
+    def update(self, *args, **kwargs):
+        with self._lock:
+            self._cache.update(*args, **kwargs)
+            self._cache.commit()
+
+    def commit(self, *args, **kwargs):
+        with self._lock:
+            self._cache.commit(*args, **kwargs)
+
+    def __getitem__(self, key):
+        return self._cache[key]
+
+    def __contains__(self, key):
+        return key in self._cache
+
+    def __iter__(self):
+        return iter(self._cache)
+
+    def __len__(self):
+        return len(self._cache)
+
+    def __getattr__(self, name):
+        return getattr(self._cache, name)
@@ -0,0 +1,67 @@
+"""External sort of the per-participant input rows
+
+Rather than holding every Patient (along with each of their condition strings)
+in memory until the entire condition file has been read, the participant,
+condition and ds_condition rows are sorted together on participantid using
+bounded, on-disk runs and then walked one participant at a time.
+
+Keys are compared using normal python string ordering, so participants come
+out in the same order as sorted(subjects.keys()) in the in-memory path. Sorts
+are stable, so rows sharing a key retain their original file order.
+"""
+
+import heapq
+import pickle
+import tempfile
+from itertools import groupby
+from operator import itemgetter
+
+# Number of rows held in memory before a sorted run is spilled to disk
+DEFAULT_CHUNK_SIZE = 100000
+
+def _write_run(pairs, tmpdir):
+    run = tempfile.TemporaryFile(dir=tmpdir)
+    for pair in pairs:
+        pickle.dump(pair, run, protocol=pickle.HIGHEST_PROTOCOL)
+    run.seek(0)
+    return run
+
+def _read_run(run):
+    try:
+        while True:
+            yield pickle.load(run)
+    except EOFError:
+        pass
+    finally:
+        run.close()
+
+def external_sort(pairs, chunk_size=DEFAULT_CHUNK_SIZE, tmpdir=None):
+    """Yield the (key, value) pairs in key order.
+
+    At most chunk_size pairs are held in memory at a time. Anything larger
+    than that is spilled into sorted runs on disk which are then merged."""
+    runs = []
+    chunk = []
+    for pair in pairs:
+        chunk.append(pair)
+        if len(chunk) >= chunk_size:
+            chunk.sort(key=itemgetter(0))
+            runs.append(_write_run(chunk, tmpdir))
+            chunk = []
+
+    chunk.sort(key=itemgetter(0))
+    if len(runs) == 0:
+        yield from chunk
+        return
+
+    if len(chunk) > 0:
+        runs.append(_write_run(chunk, tmpdir))
+    chunk = None
+
+    # heapq.merge breaks ties by the order of the runs, which keeps it stable
+    yield from heapq.merge(*[_read_run(run) for run in runs], key=itemgetter(0))
+
+def group_by_key(sorted_pairs):
+    """Collapse sorted (key, value) pairs into (key, [values])"""
+    for key, group in groupby(sorted_pairs, key=itemgetter(0)):
+        yield key, [value for _, value in group]
@@ -0,0 +1,240 @@
+"""Generate synthetic, HTP shaped input files for testing and benchmarking
+
+The files follow the layout 01-transform.py expects from the (long format)
+HTP exports: participant, condition, ds_condition and encounter files for
+each consent group, a DRS manifest, plus the merge and MCD dictionaries used
+to build the CdeVar. A dataset config pointing at all of it is written
+alongside, so it can be handed straight to 01-transform.py -d.
+
+With wide set, the participant, condition and ds_condition files are
+replaced by a single official style (wide) CSV per consent group, with a
+column for each condition variable (see include_transform.wide).
+
+Everything is written a row at a time, so the size of the dataset is limited
+by disk rather than memory, and a given seed always produces the same files.
+"""
+
+import csv
+import random
+import uuid
+from pathlib import Path
+
+import yaml
+
+# (HPO ID, HPO label, Mondo ID, Mondo label). The Mondo columns are N/A where
+# there isn't a sensible disease to go with the phenotype
+phenotypes = [
+    ("HP:0001631", "Atrial septal defect", "MONDO:0006664", "atrial septal defect"),
+    ("HP:0001629", "Ventricular septal defect", "MONDO:0002070", "ventricular septal defect"),
+    ("HP:0011994", "Abnormality of atrial septum morphology", None, None),
+    ("HP:0000365", "Hearing impairment", "MONDO:0005365", "hearing loss disorder"),
+    ("HP:0000821", "Hypothyroidism", "MONDO:0005420", "hypothyroidism"),
+    ("HP:0000836", "Hyperthyroidism", "MONDO:0004425", "hyperthyroidism"),
+    ("HP:0002719", "Recurrent infections", None, None),
+    ("HP:0000486", "Strabismus", "MONDO:0001280", "strabismus"),
+    ("HP:0000501", "Glaucoma", "MONDO:0005041", "glaucoma"),
+    ("HP:0000518", "Cataract", "MONDO:0005129", "cataract"),
+    ("HP:0002910", "Elevated hepatic transaminase", None, None),
+    ("HP:0001263", "Global developmental delay", None, None),
+    ("HP:0000717", "Autism", "MONDO:0005260", "autism"),
+    ("HP:0100753", "Schizophrenia", "MONDO:0005090", "schizophrenia"),
+    ("HP:0000716", "Depressivity", "MONDO:0002050", "depressive disorder"),
+    ("HP:0002870", "Obstructive sleep apnea", "MONDO:0007147", "obstructive sleep apnea syndrome"),
+    ("HP:0001250", "Seizure", "MONDO:0005027", "epilepsy"),
+    ("HP:0002360", "Sleep disturbance", None, None),
+    ("HP:0001513", "Obesity", "MONDO:0011122", "obesity disorder"),
+    ("HP:0000819", "Diabetes mellitus", "MONDO:0005015", "diabetes mellitus"),
+    ("HP:0001909", "Leukemia", "MONDO:0005059", "leukemia"),
+    ("HP:0002020", "Gastroesophageal reflux", "MONDO:0007186", "gastroesophageal reflux disease"),
+    ("HP:0002251", "Aganglionic megacolon", "MONDO:0018309", "Hirschsprung disease"),
+    ("HP:0002608", "Celiac disease", "MONDO:0005130", "celiac disease"),
+    ("HP:0001376", "Limitation of joint mobility", None, None),
+    ("HP:0001388", "Joint laxity", None, None),
+    ("HP:0002650", "Scoliosis", "MONDO:0005392", "scoliosis"),
+    ("HP:0000975", "Hyperhidrosis", "MONDO:0005247", "hyperhidrosis disorder"),
+    ("HP:0008064", "Ichthyosis", "MONDO:0019269", "inherited ichthyosis"),
+    ("HP:0002212", "Curly hair", None, None)
+]
+
+sexes = ["Female", "Male"]
+races = ["White", "Black or African American", "Asian", "American Indian or Alaska Native", "More than one race", "NA"]
+ethnicities = ["Not Hispanic or Latino", "Hispanic or Latino", "NA"]
+cohorts = ["Down syndrome", "Control"]
+karyotypes = ["Trisomy 21", "Mosaic", "Translocation"]
+
+participant_header = ['participantid', 'familyid', 'sex', 'cohort_type', 'race', 'ethnicity', 'mrabstractionstatus']
+condition_header = ['participantid', 'condition_code', 'condition_status']
+ds_condition_header = ['participantid', 'karyotype', 'ds_diagnosis', 'officialdsdiagnosis']
+encounter_header = ['participantid', 'event_name', 'age_at_visit', 'labid', 'height_cm', 'weight_kg', 'bmi']
+drs_header = ['participantid', 'filenames', 'object_id']
+
+def condition_vars(count):
+    """(HTP variable, CDE variable, phenotype) for count condition variables.
+    The phenotypes are reused as needed and every tenth variable is left out
+    of the dictionaries entirely, so some codes never find a match"""
+    conditions = []
+    for index in range(count):
+        phenotype = phenotypes[index % len(phenotypes)]
+        name = phenotype[1].lower().replace(" ", "_")
+        cde_var = None
+        if index % 10 != 9:
+            cde_var = f"cde_{name}_{index}"
+        conditions.append((f"{name}_{index}", cde_var, phenotype))
+    return conditions
+
+def write_dictionaries(dirname, conditions, merge_col='HTP'):
+    merge = Path(dirname) / "merge.csv"
+    mcd = Path(dirname) / "mcd.csv"
+
+    with open(merge, 'wt', newline='') as f:
+        writer = csv.writer(f, delimiter=',', quotechar='"')
+        writer.writerow(['CDE Variable', merge_col])
+        for htp_var, cde_var, phenotype in conditions:
+            if cde_var is not None:
+                writer.writerow([cde_var, htp_var])
+
+    with open(mcd, 'wt', newline='') as f:
+        writer = csv.writer(f, delimiter=',', quotechar='"')
+        writer.writerow(['Variable / Field Name', 'HPO ID', 'HPO Label', 'Mondo ID', 'Mondo Label'])
+        for htp_var, cde_var, (hpo, hpo_label, mondo, mondo_label) in conditions:
+            if cde_var is not None:
+                # The CdeVar expects the codes as they appear in the MCD (HP_0000001)
+                writer.writerow([cde_var,
+                        hpo.replace(":", "_"),
+                        hpo_label,
+                        mondo.replace(":", "_") if mondo else "N/A",
+                        mondo_label or ""])
+    return merge, mcd
+
+def measurement(rand, low, high):
+    """Numbers as they come in the exports, sometimes missing in one way or another"""
+    roll = rand.random()
+    if roll < 0.05:
+        return "NA"
+    if roll < 0.08:
+        return ""
+    return f"{rand.uniform(low, high):.1f}"
+
+def write_consent_group(dirname, name, first, count, conditions, conditions_per, visits, rand, wide=False):
+    """Write the input files for participants first..first+count and return
+    the consent group's config"""
+    dirname = Path(dirname)
+    if wide:
+        files = {'wide': dirname / f"{name}_htp.csv"}
+    else:
+        files = {
+            'participant': dirname / f"{name}_participant.tsv",
+            'condition': dirname / f"{name}_condition.tsv",
+            'ds_condition': dirname / f"{name}_ds_condition.tsv"
+        }
+    files['encounter'] = dirname / f"{name}_encounter.tsv"
+    files['drs'] = dirname / f"{name}_drs.tsv"
+    condition_columns = [htp_var for htp_var, cde_var, phenotype in conditions]
+
+    handles = {key: open(filename, 'wt', newline='') for key, filename in files.items()}
+    try:
+        writers = {key: csv.writer(f, delimiter='\t', quotechar='"') for key, f in handles.items()}
+        if wide:
+            writers['wide'] = csv.writer(handles['wide'], delimiter=',', quotechar='"')
+            writers['wide'].writerow(participant_header + ds_condition_header[1:] + condition_columns)
+        else:
+            writers['participant'].writerow(participant_header)
+            writers['condition'].writerow(condition_header)
+            writers['ds_condition'].writerow(ds_condition_header)
+        writers['encounter'].writerow(encounter_header)
+        writers['drs'].writerow(drs_header)
+
+        per_participant = min(conditions_per, len(conditions))
+        for index in range(first, first + count):
+            pid = f"HTP{index:08d}"
+            cohort = rand.choice(cohorts)
+            participant = [
+                pid,
+                f"FAM{index // 3:08d}",
+                rand.choice(sexes),
+                cohort,
+                rand.choice(races),
+                rand.choice(ethnicities),
+                rand.choice(["Yes", "No"])
+            ]
+
+            statuses = {}
+            for htp_var, cde_var, phenotype in rand.sample(conditions, per_participant):
+                statuses[htp_var] = rand.choice(["TRUE", "FALSE", "FALSE", "NA"])
+
+            if cohort == "Down syndrome":
+                karyotype = rand.choice(karyotypes)
+                ds_condition = [pid, karyotype, "Down syndrome", rand.choice(["Down syndrome", "NA"])]
+            else:
+                ds_condition = [pid, "NA", "NA", "NA"]
+
+            if wide:
+                writers['wide'].writerow(participant + ds_condition[1:] + [statuses.get(col, "") for col in condition_columns])
+            else:
+                writers['participant'].writerow(participant)
+                for htp_var, status in statuses.items():
+                    writers['condition'].writerow([pid, htp_var, status])
+                writers['ds_condition'].writerow(ds_condition)
+
+            age = rand.randint(0, 365 * 20)
+            for visit in range(visits):
+                age += rand.randint(30, 365 * 2)
+                writers['encounter'].writerow([
+                    pid,
+                    f"Visit {visit}",
+                    age,
+                    f"LAB{index:08d}{visit:02d}",
+                    measurement(rand, 80, 190),
+                    measurement(rand, 10, 120),
+                    measurement(rand, 14, 40)
+                ])
+
+            files_for = [f"{pid}.cram", f"{pid}.cram.crai"]
+            object_ids = [str(uuid.UUID(int=rand.getrandbits(128))) for fn in files_for]
+            writers['drs'].writerow([pid, ",".join(files_for), ",".join(object_ids)])
+    finally:
+        for f in handles.values():
+            f.close()
+
+    config = {key: str(filename) for key, filename in files.items()}
+    if wide:
+        # Some of the condition variables aren't in the dictionaries at all
+        config['condition_columns'] = condition_columns
+    config['seq_center'] = "Synthetic Sequencing Center"
+    return config
+
+def generate_dataset(dirname, participants, conditions_per=5, visits=2, consent_groups=1, condition_count=100, seed=0, study_name=None,
+            wide=False):
+    """Write a synthetic HTP dataset into dirname. Returns the filename of the
+    dataset config"""
+    dirname = Path(dirname)
+    dirname.mkdir(parents=True, exist_ok=True)
+    rand = random.Random(seed)
+
+    conditions = condition_vars(condition_count)
+    merge, mcd = write_dictionaries(dirname, conditions)
+
+    if study_name is None:
+        study_name = f"Synthetic HTP {participants}"
+    dataset = {
+        'study_name': study_name,
+        'study_title': f"{study_name} (generated with seed {seed})",
+        'study_id': f"SYN{participants}",
+        'dict_merge': str(merge),
+        'mcd': str(mcd),
+        'merge_col': 'HTP',
+        'consent-groups': {}
+    }
+
+    # Participants are split as evenly as possible across the consent groups
+    first = 0
+    for group in range(consent_groups):
+        count = participants // consent_groups + (1 if group < participants % consent_groups else 0)
+        name = f"group{group + 1}"
+        dataset['consent-groups'][name] = write_consent_group(dirname, name, first, count, conditions, conditions_per, visits, rand, wide=wide)
+        first += count
+
+    config = dirname / "dataset.yaml"
+    with open(config, 'wt') as f:
+        yaml.safe_dump(dataset, f, sort_keys=False)
+    return config
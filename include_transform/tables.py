@@ -0,0 +1,230 @@
+"""The set of transformed tables produced for a study
+
+Run() writes rows through writers obtained from a TableSet rather than opening
+the TSV files directly. That allows the same transform to write the usual TSV
+files, keep the tables in memory to be handed straight to the loader, or both.
+
+Memory tables store rows exactly as the TSV files would read back in (None
+becomes an empty string and everything else is a string), so the resulting
+DataFrames match what read_df would have produced from the files.
+
+The TSV files can be compressed (gzip, bzip2 or zstd) as they're written,
+using the tsv.gz, tsv.bz2 or tsv.zst formats.
+
+The files can also be written as Parquet or Arrow IPC rather than TSV. Those
+use a fixed schema for each table where every column is a string (again, with
+empty strings for missing values), so they read back in as exactly the values
+the TSV would have held. IDs such as labid are never mistaken for numbers and
+values like 12.50 or 010 keep their original text.
+
+Only one format of each table is kept: opening a table for writing removes
+the other formats' files for it, so a stale copy left by an earlier run can
+never be read in place of the new one.
+"""
+
+import csv
+import shutil
+from pathlib import Path
+
+from cmg_transform.consent import ConsentGroup
+from include_transform.patient import Patient
+from include_transform.encounter import Encounter
+from include_transform.metrics import no_metrics
+from include_transform.compression import open_text
+
+# table name => (filename, function which writes the header)
+transformed_tables = {
+    'participant': ("participant.tsv", Patient.write_subject_header),
+    'condition': ("conditions.tsv", Patient.write_condition_header),
+    'disease': ("diseases.tsv", Patient.write_disease_header),
+    'encounter': ("encounters.tsv", Encounter.write_measurements_header),
+    'observation': ("observations.tsv", Patient.write_observation_header),
+    'consent': ("consent_groups.tsv", ConsentGroup.write_default_header)
+}
+
+class MemoryTable:
+    """Collects the rows written to it, including the header"""
+    def __init__(self):
+        self.rows = []
+
+    def writerow(self, row):
+        self.rows.append(['' if value is None else str(value) for value in row])
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def to_frame(self):
+        import pandas as pd
+
+        return pd.DataFrame(self.rows[1:], columns=self.rows[0])
+
+# Suffixes used for each of the supported file formats
+file_formats = {
+    'tsv': '.tsv',
+    'tsv.gz': '.tsv.gz',
+    'tsv.bz2': '.tsv.bz2',
+    'tsv.zst': '.tsv.zst',
+    'parquet': '.parquet',
+    'arrow': '.arrow'
+}
+
+# The (possibly compressed) TSV formats
+tsv_formats = ['tsv', 'tsv.gz', 'tsv.bz2', 'tsv.zst']
+
+# Rows buffered before writing a record batch to the columnar files
+DEFAULT_BATCH_SIZE = 65536
+
+def table_filename(name, file_format='tsv'):
+    filename, write_header = transformed_tables[name]
+    return str(Path(filename).with_suffix(file_formats[file_format]))
+
+class ColumnarTable:
+    """Writes rows to a Parquet or Arrow IPC file in record batches. The first
+    row written is taken as the header."""
+    def __init__(self, filename, file_format, batch_size=DEFAULT_BATCH_SIZE):
+        self.filename = filename
+        self.file_format = file_format
+        self.batch_size = batch_size
+        self.schema = None
+        self.writer = None
+        self.rows = []
+
+    def writerow(self, row):
+        if self.schema is None:
+            self.open([str(col) for col in row])
+        else:
+            self.rows.append(row)
+            if len(self.rows) >= self.batch_size:
+                self.flush()
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def open(self, columns):
+        import pyarrow as pa
+
+        self.schema = pa.schema([(col, pa.string()) for col in columns])
+        if self.file_format == 'parquet':
+            import pyarrow.parquet as pq
+            self.writer = pq.ParquetWriter(self.filename, self.schema)
+        else:
+            self.writer = pa.ipc.new_file(self.filename, self.schema)
+
+    def flush(self):
+        import pyarrow as pa
+
+        columns = [[] for col in self.schema]
+        for row in self.rows:
+            for index, value in enumerate(row):
+                columns[index].append('' if value is None else str(value))
+        batch = pa.record_batch([pa.array(col, type=pa.string()) for col in columns], schema=self.schema)
+        self.writer.write_batch(batch)
+        self.rows = []
+
+    def close(self):
+        if self.writer is not None:
+            if len(self.rows) > 0:
+                self.flush()
+            self.writer.close()
+            self.writer = None
+
+class _Tee:
+    def __init__(self, writers):
+        self.writers = writers
+
+    def writerow(self, row):
+        for writer in self.writers:
+            writer.writerow(row)
+
+    def writerows(self, rows):
+        rows = list(rows)
+        for writer in self.writers:
+            writer.writerows(rows)
+
+class TableSet:
+    def __init__(self, output, write_files=True, keep_in_memory=False, file_format='tsv', metrics=no_metrics):
+        assert write_files or keep_in_memory, "Tables must be written somewhere"
+        assert file_format in file_formats, f"Unknown file format, {file_format}"
+        self.output = output
+        self.write_files = write_files
+        self.keep_in_memory = keep_in_memory
+        self.file_format = file_format
+        self.metrics = metrics
+        self.files = {}
+        self.memory = {}
+        self.writers = {}
+        # The same writers, counted and timed when metrics are being collected
+        self.metered = {}
+
+        for name in transformed_tables:
+            self.open(name)
+
+    def open(self, name):
+        filename, write_header = transformed_tables[name]
+        writers = []
+        if self.write_files:
+            self.remove_stale(name)
+            filename = self.output / table_filename(name, self.file_format)
+            if self.file_format in tsv_formats:
+                self.files[name] = open_text(filename, 'wt')
+                writers.append(csv.writer(self.files[name], delimiter='\t', quotechar='"'))
+            else:
+                self.files[name] = ColumnarTable(filename, self.file_format)
+                writers.append(self.files[name])
+        if self.keep_in_memory:
+            self.memory[name] = MemoryTable()
+            writers.append(self.memory[name])
+
+        if len(writers) == 1:
+            writer = writers[0]
+        else:
+            writer = _Tee(writers)
+        write_header(writer)
+        self.writers[name] = writer
+        self.metered[name] = self.metrics.writer(name, writer)
+        return self.metered[name]
+
+    def remove_stale(self, name):
+        """Remove the table's files in any of the other formats"""
+        for file_format in file_formats:
+            if file_format != self.file_format:
+                stale = Path(self.output) / table_filename(name, file_format)
+                if stale.is_file():
+                    print(f"Removing {stale}, left over from an earlier run")
+                    stale.unlink()
+
+    def writer(self, name):
+        return self.metered[name]
+
+    def append_shard(self, name, filename):
+        """Append the contents of another TSV version of this table (minus
+        it's header). The shard's rows were already counted when it was 
+        written, so they bypass the metrics"""
+        if self.file_format in tsv_formats and not self.keep_in_memory:
+            # Nothing needs to be parsed, so just copy the bytes over
+            with open(filename, 'rb') as f:
+                f.readline()
+                self.files[name].flush()
+                shutil.copyfileobj(f, self.files[name].buffer, 1024 * 1024)
+        else:
+            with open(filename, 'rt', newline='') as f:
+                reader = csv.reader(f, delimiter='\t', quotechar='"')
+                next(reader, None)
+                self.writers[name].writerows(reader)
+
+    def frames(self):
+        """Return the tables as DataFrames (only valid if kept in memory)"""
+        return {name: table.to_frame() for name, table in self.memory.items()}
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,277 @@
+"""Resolve the terminology codes a study needs before it's transformed
+
+cmg_transform's term_lookup asks the remote API about each term as it comes
+up, one at a time, and only writes it's cache out at the very end of the run
+(so a crash loses every lookup done so far). Instead, the resolver here is
+handed every distinct code the transform will emit up front (the HPO and
+Mondo codes from the CdeVar along with the few fixed codes used for the
+encounters) and:
+
+    * answers what it can from a local SQLite cache
+    * looks the rest up, a term per request (the API has no way to ask about
+      several at once), with up to workers of them at once when the source
+      allows it
+    * commits the results to the cache every batch_size terms, so an
+      interrupted run keeps everything it had already learned
+
+The lookups go through term_lookup.pull_details itself (TermLookupSource),
+so by the time the transform asks about a term, term_lookup already has the
+answer in memory and the API is never asked twice. term_lookup keeps it's
+cache and call count in module globals, so those calls are made one at a
+time. The displays that come back are also handed to the CdeVar, which
+names the condition rows after them. term_lookup's in memory
+cache is also kept in the SQLite cache, and seeded from it before the
+transform, so terms the SQLite cache knows about don't go back to the API
+just because term_lookup's own cache file has gone missing.
+
+Cached terms expire after a TTL and the cache is trimmed back to a maximum
+number of entries when it's closed (the least recently used terms, and the
+oldest of term_lookup's entries).
+
+Without a source the resolver is fully offline and only the cache is
+consulted. A StubTermSource answers from a local file instead of the API,
+which is handy for testing without network access.
+"""
+
+import csv
+import logging
+import pickle
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+from include_transform.cde_conversions import DictEntry
+from include_transform.encounter import tissue_type, tissue_type_name
+
+log = logging.getLogger(__name__)
+
+DEFAULT_TTL_DAYS = 30
+DEFAULT_MAX_ENTRIES = 100000
+DEFAULT_BATCH_SIZE = 50
+DEFAULT_WORKERS = 8
+
+uberon_system = "http://purl.obolibrary.org/obo/uberon.owl"
+
+# Code system => ontology ID used by the remote API
+ontologies = {
+    DictEntry.cs_urls["HPO"]: "hp",
+    DictEntry.cs_urls["Mondo"]: "mondo",
+    uberon_system: "uberon"
+}
+
+def transform_codes(cde):
+    """Returns {(system, code): label} for every code the transform can emit
+    for a study, labelled as they appear in the dictionaries"""
+    codes = {}
+    for matches in cde.matches.values():
+        for system, label, code in matches:
+            if code is not None and code.strip() != "":
+                codes[(system, code)] = label
+    codes[(uberon_system, tissue_type)] = tissue_type_name
+    return codes
+
+class TermCache:
+    def __init__(self, filename, ttl_days=DEFAULT_TTL_DAYS, max_entries=DEFAULT_MAX_ENTRIES):
+        self.filename = Path(filename)
+        self.filename.parent.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl_days * 24 * 60 * 60
+        self.max_entries = max_entries
+
+        # Parallel datasets each open the cache from their own process
+        self.db = sqlite3.connect(str(self.filename), timeout=60)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS term(
+            system TEXT,
+            code TEXT,
+            display TEXT,
+            found INTEGER,
+            fetched REAL,
+            used REAL,
+            PRIMARY KEY(system, code))""")
+        # term_lookup's own cache entries, pickled
+        self.db.execute("""CREATE TABLE IF NOT EXISTS lookup(
+            key BLOB PRIMARY KEY,
+            value BLOB,
+            fetched REAL)""")
+        self.db.commit()
+
+    def lookup(self, keys, now=None):
+        """Returns {(system, code): display} for the keys with an unexpired
+        entry. Terms the source didn't know about are cached as None"""
+        now = time.time() if now is None else now
+        hits = {}
+        for system, code in keys:
+            row = self.db.execute("SELECT display, found FROM term WHERE system=? AND code=? AND fetched>?",
+                        (system, code, now - self.ttl)).fetchone()
+            if row is not None:
+                hits[(system, code)] = row[0] if row[1] else None
+        if len(hits) > 0:
+            self.db.executemany("UPDATE term SET used=? WHERE system=? AND code=?",
+                        [(now, system, code) for system, code in hits])
+            self.db.commit()
+        return hits
+
+    def store(self, results, now=None):
+        """results is {(system, code): display or None}. Committed right away"""
+        now = time.time() if now is None else now
+        self.db.executemany("INSERT OR REPLACE INTO term VALUES (?, ?, ?, ?, ?, ?)",
+                    [(system, code, display, display is not None, now, now) for (system, code), display in results.items()])
+        self.db.commit()
+
+    def seed(self, target, now=None):
+        """Add the unexpired term_lookup entries that target (term_lookup's
+        cache) doesn't already have. Returns the number added"""
+        now = time.time() if now is None else now
+        added = 0
+        for key, value in self.db.execute("SELECT key, value FROM lookup WHERE fetched>?", (now - self.ttl,)):
+            key = pickle.loads(key)
+            if key not in target:
+                target[key] = pickle.loads(value)
+                added += 1
+        return added
+
+    def save(self, source, now=None):
+        """Keep each of source's (term_lookup's cache) entries. Those already
+        kept hold on to the time they were first fetched"""
+        now = time.time() if now is None else now
+        self.db.executemany("INSERT OR IGNORE INTO lookup VALUES (?, ?, ?)",
+                    [(pickle.dumps(key), pickle.dumps(value), now) for key, value in list(source.items())])
+        self.db.commit()
+
+    def evict(self, now=None):
+        """Drop the expired terms and then the least recently used ones until
+        we are back down to max_entries. term_lookup's entries are held to
+        the same limit, dropping the oldest. Returns the number of terms
+        dropped"""
+        now = time.time() if now is None else now
+        self.db.execute("DELETE FROM lookup WHERE fetched<=?", (now - self.ttl,))
+        dropped = self.db.execute("DELETE FROM term WHERE fetched<=?", (now - self.ttl,)).rowcount
+        count = self.db.execute("SELECT COUNT(*) FROM term").fetchone()[0]
+        if count > self.max_entries:
+            dropped += self.db.execute("""DELETE FROM term WHERE rowid IN
+                (SELECT rowid FROM term ORDER BY used LIMIT ?)""", (count - self.max_entries,)).rowcount
+        count = self.db.execute("SELECT COUNT(*) FROM lookup").fetchone()[0]
+        if count > self.max_entries:
+            self.db.execute("""DELETE FROM lookup WHERE rowid IN
+                (SELECT rowid FROM lookup ORDER BY fetched LIMIT ?)""", (count - self.max_entries,))
+        self.db.commit()
+        return dropped
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM term").fetchone()[0]
+
+    def close(self):
+        self.evict()
+        self.db.close()
+
+def display_of(details):
+    """The display from whatever pull_details handed back"""
+    if details is None or isinstance(details, str):
+        return details
+    if isinstance(details, dict):
+        for name in ['display', 'label', 'name']:
+            if details.get(name):
+                return details[name]
+        return None
+    return getattr(details, 'display', None)
+
+class TermLookupSource:
+    """Looks terms up with term_lookup.pull_details, which leaves them in
+    term_lookup's cache for the transform to find. pull_details updates
+    term_lookup's module level cache and call count, so only one call is
+    made at a time whatever the number of workers"""
+    def __init__(self, term_lookup):
+        self.term_lookup = term_lookup
+        self.lock = threading.Lock()
+
+    def fetch(self, system, code):
+        """Returns the term's display, or None if the API doesn't know it.
+        Transport and server errors are raised, so the term isn't cached"""
+        with self.lock:
+            details = self.term_lookup.pull_details(system, code)
+        return display_of(details)
+
+class StubTermSource:
+    """Answers from a local file rather than the API. The file is a TSV with
+    system, code and display columns"""
+    def __init__(self, filename):
+        self.terms = {}
+        with open(filename, 'rt', encoding='utf-8-sig') as f:
+            for row in csv.DictReader(f, delimiter='\t', quotechar='"'):
+                self.terms[(row['system'], row['code'])] = row['display'] or None
+
+    def fetch(self, system, code):
+        return self.terms.get((system, code))
+
+class TermResolver:
+    def __init__(self, cache, source=None, batch_size=DEFAULT_BATCH_SIZE, workers=DEFAULT_WORKERS):
+        self.cache = cache
+        self.source = source
+        self.batch_size = batch_size
+        self.workers = workers
+        self.remote_calls = 0
+        self.cache_hits = 0
+        self.failed = 0
+
+    def resolve(self, keys):
+        """Returns {(system, code): display} for each of the distinct keys.
+        The display is None for terms the source didn't know about, and the
+        keys that couldn't be looked up at all (offline, or the source
+        failed) are left out"""
+        keys = sorted(set(keys))
+        resolved = self.cache.lookup(keys)
+        self.cache_hits += len(resolved)
+        misses = [key for key in keys if key not in resolved]
+
+        if len(misses) == 0 or self.source is None:
+            return resolved
+
+        pending = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            jobs = {executor.submit(self.source.fetch, *key): key for key in misses}
+            # The cache is only ever written from this thread
+            for job in as_completed(jobs):
+                key = jobs[job]
+                self.remote_calls += 1
+                try:
+                    pending[key] = job.result()
+                except Exception as e:
+                    log.warning("Unable to resolve %s %s (%s). It'll be tried again next time", key[0], key[1], e)
+                    self.failed += 1
+                    continue
+                if len(pending) >= self.batch_size:
+                    self.cache.store(pending)
+                    resolved.update(pending)
+                    pending = {}
+        if len(pending) > 0:
+            self.cache.store(pending)
+            resolved.update(pending)
+        return resolved
+
+    def close(self):
+        self.cache.close()
+
+def write_term_details(filename, codes, resolved):
+    """Write each code alongside it's label in the dictionaries and the
+    display the terminology has for it. Returns the codes that the
+    terminology doesn't recognize"""
+    unknown = []
+    with open(filename, 'wt') as f:
+        writer = csv.writer(f, delimiter=',', quotechar='"')
+        writer.writerow(['system', 'code', 'label', 'display', 'status'])
+        for (system, code), label in sorted(codes.items()):
+            if (system, code) not in resolved:
+                status = 'unresolved'
+                display = ''
+            elif resolved[(system, code)] is None:
+                status = 'unknown'
+                display = ''
+                unknown.append((system, code))
+            else:
+                display = resolved[(system, code)]
+                status = 'ok'
+            writer.writerow([system, code, label, display, status])
+    return unknown
@@ -0,0 +1,177 @@
+"""Read the official (wide) HTP CSVs directly
+
+The official exports have a single row per participant, with each of the
+conditions in a column of it's own. Originally, those were rolled into the
+long participant, condition and ds_condition files by an R script before
+01-transform.py could use them. Instead, a consent group can point straight
+at the wide file:
+
+    consent-groups:
+      GRU:
+        wide: htp_export.csv
+        encounter: htp_encounters.tsv
+        seq_center: ...
+
+Optional settings for the wide file:
+    wide_delim          Delimiter (default ,)
+    id_column           Participant ID column (default participantid)
+    condition_columns   The condition columns. By default, these are the
+                        columns named as HTP variables in the study's merge
+                        dictionary
+    condition_pattern   Regular expression matching the condition columns
+                        (instead of listing them)
+    condition_values    {'TRUE': [...], 'FALSE': [...]} values that mean
+                        present and absent (see present_values/absent_values)
+
+ConsentSections.records() reads all of a consent group's sections in a
+single pass, yielding (section, row) as it goes. The wide file is read in
+chunks, so neither the whole file nor a copy of it is ever held, and each
+chunk hands over it's participant, condition and ds_condition rows before
+the next chunk is read.
+
+The condition columns of each chunk are unpivoted in bulk into the same rows
+the long condition file would hold (participantid, condition_code,
+condition_status), ordered by participant and then column. Any other value
+(NA, blank, etc) is dropped, just as Patient.load_condition ignores anything
+but TRUE and FALSE. The remaining columns stand in for the participant and
+ds_condition rows.
+"""
+
+import re
+
+from cmg_transform import Transform
+from include_transform.compression import open_text, detect
+
+# Rows read at a time from the wide file
+DEFAULT_CHUNKSIZE = 50000
+
+present_values = ["TRUE", "True", "true", "1", "Yes", "yes", "Checked"]
+absent_values = ["FALSE", "False", "false", "0", "No", "no", "Unchecked"]
+
+# The sections of a consent group that can come from the wide file
+wide_sections = ['participant', 'condition', 'ds_condition']
+
+def is_wide(consent, section):
+    return section in wide_sections and section not in consent and 'wide' in consent
+
+def section_filename(consent, section):
+    """The file a section of the consent group is read from (for reporting)"""
+    if is_wide(consent, section):
+        return f"{consent['wide']} ({section})"
+    return consent[section]
+
+class ConsentSections:
+    """The rows of each section (participant, condition and ds_condition) of
+    a consent group, whether they come from their own files or the wide file"""
+    def __init__(self, consent, delim):
+        self.consent = consent
+        self.delim = delim
+
+    def filename(self, section):
+        return section_filename(self.consent, section)
+
+    def filenames(self):
+        return {section: self.filename(section) for section in wide_sections}
+
+    def records(self):
+        """Yield (section, row) for every row of the sections, reading each
+        file just once. A participant file of it's own comes first, then the
+        wide file (one chunk at a time) and then the rest of the files. So a
+        participant's row is always read before their condition rows, other
+        than for duplicate rows further down the wide file"""
+        own = [section for section in wide_sections if not is_wide(self.consent, section)]
+        wide = [section for section in wide_sections if is_wide(self.consent, section)]
+
+        if 'participant' in own:
+            yield from self.read('participant')
+        if len(wide) > 0:
+            yield from read_wide(self.consent, wide)
+        for section in own:
+            if section != 'participant':
+                yield from self.read(section)
+
+    def read(self, section):
+        with open_text(self.consent[section]) as file:
+            for line in Transform.GetReader(file, delimiter=self.delim):
+                yield section, line
+
+def use_dictionary_columns(dataset, dataset_vars):
+    """Returns a copy of dataset where the wide files without condition
+    columns of their own take them from the HTP variables in the merge
+    dictionary. dataset itself is left as it was"""
+    consent_groups = {}
+    for name, consent in dataset['consent-groups'].items():
+        if 'wide' in consent and 'condition_columns' not in consent and 'condition_pattern' not in consent:
+            consent = dict(consent, condition_columns=sorted(set(dataset_vars)))
+        consent_groups[name] = consent
+    return dict(dataset, **{'consent-groups': consent_groups})
+
+def condition_columns(consent, header):
+    """The condition columns in the order they appear in the file"""
+    id_column = consent.get('id_column', 'participantid')
+    if 'condition_pattern' in consent:
+        pattern = re.compile(consent['condition_pattern'])
+        return [col for col in header if col != id_column and pattern.search(col)]
+    wanted = set(consent.get('condition_columns', []))
+    return [col for col in header if col != id_column and col in wanted]
+
+def read_chunks(consent):
+    import pandas as pd
+
+    return pd.read_csv(consent['wide'],
+                sep=consent.get('wide_delim', ','),
+                quotechar='"',
+                dtype=str,
+                keep_default_na=False,
+                encoding='utf-8-sig',
+                compression=detect(consent['wide']),
+                chunksize=consent.get('wide_chunksize', DEFAULT_CHUNKSIZE))
+
+def read_wide(consent, sections):
+    """Yield (section, row) for the sections that come from the wide file.
+    Each chunk's participant rows come first, then it's condition rows and
+    then it's ds_condition rows (the same rows as the participants)"""
+    import numpy as np
+
+    # The rest of the transform expects the ID as participantid
+    id_column = consent.get('id_column', 'participantid')
+    values = consent.get('condition_values', {})
+    present = np.array(values.get('TRUE', present_values), dtype=object)
+    absent = np.array(values.get('FALSE', absent_values), dtype=object)
+
+    columns = None
+    for chunk in read_chunks(consent):
+        if columns is None:
+            header = list(chunk.columns)
+            columns = condition_columns(consent, header)
+            codes = np.array(columns, dtype=object)
+            usecols = [col for col in header if col not in set(columns)]
+
+        rows = []
+        if 'participant' in sections or 'ds_condition' in sections:
+            rows = chunk[usecols].rename(columns={id_column: 'participantid'}).to_dict('records')
+        if 'participant' in sections:
+            for row in rows:
+                yield 'participant', row
+        if 'condition' in sections and len(columns) > 0:
+            for row in unpivot_conditions(chunk, id_column, columns, codes, present, absent):
+                yield 'condition', row
+        if 'ds_condition' in sections:
+            for row in rows:
+                yield 'ds_condition', row
+
+def unpivot_conditions(chunk, id_column, columns, codes, present, absent):
+    """The long condition rows for a chunk of the wide file"""
+    import numpy as np
+
+    matrix = chunk[columns].to_numpy(dtype=object)
+    is_present = np.isin(matrix, present)
+    keep = is_present | np.isin(matrix, absent)
+
+    # nonzero walks the matrix row by row, so this is participant and
+    # then column order
+    rows, cols = np.nonzero(keep)
+    participants = chunk[id_column].to_numpy(dtype=object)[rows]
+    statuses = np.where(is_present[rows, cols], "TRUE", "FALSE")
+    for participant, code, status in zip(participants.tolist(), codes[cols].tolist(), statuses.tolist()):
+        yield {'participantid': participant, 'condition_code': code, 'condition_status': status}
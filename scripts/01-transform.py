@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import csv
+import logging
 
 from os import getenv
 
@@ -8,8 +9,13 @@ from yaml import safe_load
 from argparse import ArgumentParser, FileType
 from pathlib import Path
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from multiprocessing import get_context
+from shutil import rmtree
 import cmg_transform.tools
 from cmg_transform.tools.term_lookup import pull_details, write_cache, remote_calls
+from cmg_transform.tools import term_lookup
 
 from ncpi_fhir_plugin.common import CONCEPT, constants
 
@@ -17,16 +23,254 @@ from cmg_transform.tools.variant_details import Variant
 
 from cmg_transform import Transform, InvalidID
 from include_transform.patient import Patient
-from include_transform.encounter import Encounter
-from include_transform.cde_conversions import CdeVar
+from include_transform.encounter import Encounter, write_measurements_columnar, columnar_supported
+from include_transform.cde_conversions import CdeVar, DictEntry, index_key
+from include_transform.streaming import external_sort, group_by_key, DEFAULT_CHUNK_SIZE
+from include_transform.tables import TableSet, transformed_tables, file_formats
+from include_transform.incremental import ParticipantHashes, hash_participants
+from include_transform.metrics import TransformMetrics, no_metrics
+from include_transform.compression import open_text
+from include_transform.shared_db import LockedCache
+from include_transform.wide import ConsentSections, use_dictionary_columns
+from include_transform.terms import TermCache, TermResolver, TermLookupSource, StubTermSource, transform_codes, write_term_details, \
+            DEFAULT_TTL_DAYS, DEFAULT_MAX_ENTRIES, DEFAULT_BATCH_SIZE, DEFAULT_WORKERS
 from cmg_transform.consent import ConsentGroup
 
 from cmg_transform.change_logger import ChangeLog
 
 import pdb
 
+log = logging.getLogger(__name__)
+
+def StreamConsentGroup(sections, study_name, cde, study_group, consent_group, seq_center, 
+            wparticipant, wcondition, wdisease, wobservation, 
+            chunk_size=DEFAULT_CHUNK_SIZE, tmpdir=None, only=None, metrics=no_metrics):
+    """Emit the participant, condition, disease and observation rows for a 
+    single consent group one participant at a time. 
+
+    The rows of all three sections (tagged with their section) are sorted 
+    externally on participantid in a single pass, so only a single 
+    participant's data is ever held in memory (beyond the bounded sort 
+    buffers). 
+
+    The rows are read from sections, the consent group's ConsentSections.
+
+    If only is provided, rows are only written for those participants."""
+    print(f"The Patient: {sections.filename('participant')}")
+    print(f"The condition file: {sections.filename('condition')}")
+    print(f"DS Condition File: {sections.filename('ds_condition')}")
+
+    def records():
+        for section, line in metrics.read_records(sections.filenames(), sections.records()):
+            Transform._linenumber += 1
+            if section == 'participant':
+                p = Patient(line)
+                yield (p.id, (section, p))
+            else:
+                yield (line['participantid'], (section, line))
+
+    skipped = UnmatchedRows(sections.filename('participant'))
+    for pid, values in group_by_key(external_sort(records(), chunk_size, tmpdir)):
+        rows = defaultdict(list)
+        for section, value in values:
+            rows[section].append(value)
+
+        if len(rows['participant']) == 0:
+            for kind in ['condition', 'ds_condition']:
+                if len(rows[kind]) > 0:
+                    skipped.add(kind, pid, len(rows[kind]))
+            continue
+
+        # Duplicate participant rows behave as they would in the dict: last one wins
+        patient = rows['participant'][-1]
+        study_group.add_patient(pid, seq_center)
+        if consent_group:
+            consent_group.add_patient(pid, seq_center)
+        if only is not None and pid not in only:
+            continue
+
+        patient.write_subject_data(study_name, wparticipant)
+
+        for line in rows['condition']:
+            patient.load_condition(line)
+        for line in rows['ds_condition']:
+            patient.load_ds_condition(line)
+
+        patient.write_conditions(study_name, wcondition, cde)
+        patient.write_disease(study_name, wdisease)
+        patient.write_observations(study_name, wobservation)
+    skipped.report()
+
+class UnmatchedRows:
+    """Keeps track of the condition and ds_condition rows for participants 
+    that aren't in the consent group's participant file. Those rows can't be
+    attached to anyone, so they are skipped (with a warning for each such
+    participant) and summed up once the group is done"""
+    def __init__(self, participant_file):
+        self.participant_file = participant_file
+        self.counts = defaultdict(int)          # kind => rows skipped
+        self.participants = set()
+
+    def add(self, kind, participant_id, rows=1):
+        if participant_id not in self.participants:
+            self.participants.add(participant_id)
+            log.warning("%s rows for %s were skipped, since they aren't in %s", kind, participant_id, self.participant_file)
+        self.counts[kind] += rows
+
+    def report(self):
+        for kind, rows in self.counts.items():
+            print(f"Skipped {rows} {kind} rows for participants not found in {self.participant_file}")
+
+class PatientRecorder:
+    """Stands in for the study level ConsentGroup inside a worker process
+
+    The study group spans every consent group, so workers just record who 
+    they added and the parent replays those into the real study group."""
+    def __init__(self):
+        self.patients = []
+
+    def add_patient(self, patient_id, seq_center):
+        self.patients.append((patient_id, seq_center))
+
+def LoadConsentConfig(consent):
+    if 'field_map' in consent:
+        Transform.LoadFieldMap(consent['field_map'])
+        log.info("Field map: %s", Transform._field_map)
+
+    if 'data_map' in consent:
+        Transform.LoadDataMap(consent['data_map'])
+        log.info("Data map: %s", Transform._data_map)
+        log.info("Data transform: %s", Transform._data_transform)
+        #pdb.set_trace()
+
+    if 'invalid-ids' in consent:
+        Transform.LoadInvalidIDs(consent['invalid-ids'])
+        log.info("Invalid IDs: %s", Transform._invalid_ids)
+
+def TransformConsentGroup(study_name, dataset, consent_name, cde, study_group, tables, 
+            delim, stream=False, chunk_size=DEFAULT_CHUNK_SIZE, tmpdir=None, columnar=False, only=None, metrics=no_metrics):
+    """Transform a single consent group into the TableSet, tables. 
+
+    If only is provided, participant level rows are restricted to those 
+    participant IDs (consent groups are always written in full)"""
+    study_title = dataset['study_title']
+    study_id = dataset['study_id']
+
+    wparticipant = tables.writer('participant')
+    wcondition = tables.writer('condition')
+    wdisease = tables.writer('disease')
+    wenc = tables.writer('encounter')
+    wobservation = tables.writer('observation')
+
+    consent = dataset['consent-groups'][consent_name]
+    # We need a way to point back to the family when we parse our specimen file
+    family_lkup = {}
+
+    seq_center = consent['seq_center']
+    # There is currently no reference to the proband from parent rows, so we 
+    # need to define that. 
+    proband_relationships = defaultdict(dict)           # parent_id => "relationship" => proband_id 
+
+    LoadConsentConfig(consent)
+
+    consent_group = None
+    if len(dataset['consent-groups']) > 1:
+        consent_group = ConsentGroup(study_name, study_title=study_title, study_id=study_id, group_name=consent_name, consent_name=consent_name)
+
+    # All three sections (including the wide file, if there is one) are read
+    # in a single pass
+    sections = ConsentSections(consent, delim)
+    if stream:
+        StreamConsentGroup(sections, study_name, cde, study_group, consent_group, seq_center,
+                wparticipant, wcondition, wdisease, wobservation, 
+                chunk_size=chunk_size, tmpdir=tmpdir, only=only, metrics=metrics)
+    else:
+        # Only this group's participants are kept, so each subject's rows are 
+        # written exactly once no matter how many consent groups there are
+        subjects = {}
+        participant_file = sections.filename('participant')
+        print(f"The Patient: {participant_file}")
+        # For conditions, we'll read in both condition and ds_condition and then 
+        # write those to a single file
+        print(f"The condition file: {sections.filename('condition')}")
+        print(f"DS Condition File: {sections.filename('ds_condition')}")
+
+        skipped = UnmatchedRows(participant_file)
+        for section, line in metrics.read_records(sections.filenames(), sections.records()):
+            Transform._linenumber += 1
+            if section == 'participant':
+                #print(f"-- {line}")
+                p = Patient(line)
+                if p.id in subjects:
+                    p.carry_conditions(subjects[p.id])
+                subjects[p.id] = p
+                continue
+
+            if line['participantid'] not in subjects:
+                skipped.add(section, line['participantid'])
+                continue
+            if section == 'condition':
+                subjects[line['participantid']].load_condition(line)
+            else:
+                subjects[line['participantid']].load_ds_condition(line)
+        skipped.report()
+
+        log.debug("Subjects: %s", subjects.keys())
+        for p in  sorted(subjects.keys()):
+            study_group.add_patient(p, seq_center)
+            if consent_group:
+                consent_group.add_patient(p, seq_center)
+            if only is None or p in only:
+                subjects[p].write_subject_data(study_name, wparticipant)
+                subjects[p].write_conditions(study_name, wcondition, cde)
+                subjects[p].write_disease(study_name, wdisease)
+                subjects[p].write_observations(study_name, wobservation)
+
+    # Finally, encounters are a bit different and should be self contained
+    if columnar and not columnar_supported(consent):
+        print(f"{consent_name} has field/data maps or invalid IDs, which the columnar encounter writer can't apply. Using the row-wise writer instead")
+        columnar = False
+    if columnar:
+        print(f"Encounter File (columnar): {consent['encounter']}")
+        with metrics.input('encounter', consent['encounter']) as stats:
+            stats['rows'] += write_measurements_columnar(consent['encounter'], study_name, wenc, delimiter=delim, only=only)
+    else:
+        with open_text(consent['encounter']) as file:
+            reader = Transform.GetReader(file, delimiter=delim)
+
+            print(f"Encounter File: {consent['encounter']}")    
+            for line in metrics.read('encounter', consent['encounter'], reader):
+                enc = Encounter(line)
+                if only is None or enc.id in only:
+                    enc.write_measurements(study_name, wenc)
+
+
+    if consent_group is not None:
+        consent_group.write_data(tables.writer('consent'))
+
+def TransformShard(shard_dir, study_name, dataset, consent_name, cde, delim, 
+            stream=False, chunk_size=DEFAULT_CHUNK_SIZE, tmpdir=None, columnar=False, only=None, collect_metrics=False):
+    """Worker entry point: transform a single consent group into its own shard
+
+    Returns the patients added to the study group along with the shard's 
+    metrics (if collected) and unmatched CDE codes"""
+    shard_dir.mkdir(parents=True, exist_ok=True)
+    recorder = PatientRecorder()
+    metrics = TransformMetrics(enabled=collect_metrics)
+
+    with TableSet(shard_dir, metrics=metrics) as tables:
+        TransformConsentGroup(study_name, dataset, consent_name, cde, recorder, tables,
+                delim, stream=stream, chunk_size=chunk_size, tmpdir=tmpdir, columnar=columnar, only=only, metrics=metrics)
+    return recorder.patients, metrics.as_dict() if collect_metrics else None, cde.unmatched
+
+def Run(output, study_name, dataset, cde, delim=None, stream=False, chunk_size=DEFAULT_CHUNK_SIZE, tmpdir=None, workers=1, columnar=False, only=None, tables=None, metrics=no_metrics):
+    """Transform the dataset into the TableSet, tables (by default, the TSV
+    files inside output)"""
+    if tables is None:
+        with TableSet(output, metrics=metrics) as tables:
+            return Run(output, study_name, dataset, cde, delim=delim, stream=stream, chunk_size=chunk_size, tmpdir=tmpdir, 
+                        workers=workers, columnar=columnar, only=only, tables=tables, metrics=metrics)
 
-def Run(output, study_name, dataset, cde, delim=None):
     if "delim" not in dataset:
         delim = "\t"
     else:
@@ -40,136 +284,237 @@ def Run(output, study_name, dataset, cde, delim=None):
         consent_name = study_id
     study_group = ConsentGroup(study_name, study_title=study_title, study_id=study_id, group_name=study_title, consent_name=consent_name)
 
-    # We'll dump consents for each group as they are parsed then the entire study
-    fconsent = open(output /"consent_groups.tsv", 'wt')
-    wconsent = csv.writer(fconsent, delimiter='\t', quotechar='"')
-    ConsentGroup.write_default_header(wconsent)
-
     #pdb.set_trace()
 
-    with open(output / "participant.tsv", 'wt') as partf, \
-            open(output / "conditions.tsv", 'wt') as condf, \
-            open(output / "diseases.tsv", 'wt') as disf, \
-            open(output / "encounters.tsv", 'wt') as encf, \
-            open(output / "observations.tsv", 'wt') as obsf:
-
-        # We need to be able find them later to add conditions and whatnot
-        subjects = {}
-
-        wparticipant = csv.writer(partf, delimiter='\t', quotechar='"')
-        Patient.write_subject_header(wparticipant)
-
-        wcondition = csv.writer(condf, delimiter='\t', quotechar='"')
-        Patient.write_condition_header(wcondition)   
-
-        wdisease = csv.writer(disf, delimiter='\t', quotechar='"')
-        Patient.write_disease_header(wdisease)   
-
-        wenc = csv.writer(encf, delimiter='\t', quotechar='"')
-        Encounter.write_measurements_header(wenc)
-
-        wobservation = csv.writer(obsf, delimiter='\t', quotechar='"') 
-        Patient.write_observation_header(wobservation)   
-
-        for consent_name in dataset['consent-groups'].keys():
-            consent = dataset['consent-groups'][consent_name]
-            # We need a way to point back to the family when we parse our specimen file
-            family_lkup = {}
-
-            seq_center = consent['seq_center']
-            # There is currently no reference to the proband from parent rows, so we 
-            # need to define that. 
-            proband_relationships = defaultdict(dict)           # parent_id => "relationship" => proband_id 
-
-            if 'field_map' in consent:
-                Transform.LoadFieldMap(consent['field_map'])
-                print(Transform._field_map)
-
-            if 'data_map' in consent:
-                Transform.LoadDataMap(consent['data_map'])
-                print(Transform._data_map)
-                print(Transform._data_transform)
-                #pdb.set_trace()
-
-            if 'invalid-ids' in consent:
-                Transform.LoadInvalidIDs(consent['invalid-ids'])
-                print(Transform._invalid_ids)
-
-            consent_group = None
-            if len(dataset['consent-groups']) > 1:
-                consent_group = ConsentGroup(study_name, study_title=study_title, study_id=study_id, group_name=consent_name, consent_name=consent_name)
-
-            drs_ids = {}
-            if 'drs' in consent:
-                with open(consent['drs'], 'rt') as file:
-                    reader = csv.DictReader(file, delimiter='\t', quotechar='"')
-
-                    for row in reader:
-                        locals = dict(zip(row['filenames'].split(","), row['object_id'].split(",")))
-                        for fn in locals.keys():
-                            drs_ids[fn] = locals[fn]
-
-            with open(consent['participant'], 'rt', encoding='utf-8-sig') as file:
-                reader = Transform.GetReader(file, delimiter=delim)
-
-                print(f"The Patient: {consent['participant']}")
-
-                for line in reader:
-                    Transform._linenumber += 1
-                    #print(f"-- {line}")
-                    p = Patient(line)
-                    subjects[p.id] = p
-
-                for p in  sorted(subjects.keys()):
-                    subjects[p].write_subject_data(study_name, wparticipant)
-                    study_group.add_patient(p, seq_center)
-                    if consent_group:
-                        consent_group.add_patient(p, seq_center)
-
-            # For conditions, we'll read in both condition and ds_condition and then 
-            # write those to a single file
-            with open(consent['condition'], 'rt', encoding='utf-8-sig') as file:
-                reader = Transform.GetReader(file, delimiter=delim)
-
-                print(f"The condition file: {consent['condition']}")
-                for line in reader:
-                    print(line.keys())
-                    subjects[line['participantid']].load_condition(line)
-                    Transform._linenumber += 1
-                
-            with open(consent['ds_condition'], 'rt', encoding='utf-8-sig') as file:
-                reader = Transform.GetReader(file, delimiter=delim)
-
-                print(f"DS Condition File: {consent['ds_condition']}")
-
-                print(subjects.keys())
-                for line in reader:
-                    subjects[line['participantid']].load_ds_condition(line)
-                    Transform._linenumber += 1
-
-            for p in  sorted(subjects.keys()):
-                subjects[p].write_conditions(study_name, wcondition, cde)
-                subjects[p].write_disease(study_name, wdisease)
-
-            # Finally, encounters are a bit different and should be self contained
-            with open(consent['encounter'], 'rt', encoding='utf-8-sig') as file:
-                reader = Transform.GetReader(file, delimiter=delim)
+    if workers > 1 and len(dataset['consent-groups']) > 1:
+        # Each consent group is transformed into it's own shard, which are then
+        # stitched back together in the order they appear in the config
+        shard_root = output / "shards"
+        shard_dirs = []
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            jobs = []
+            for index, consent_name in enumerate(dataset['consent-groups'].keys()):
+                shard_dir = shard_root / f"{index:04}"
+                shard_dirs.append(shard_dir)
+                jobs.append(executor.submit(TransformShard, shard_dir, study_name, dataset, consent_name, cde, delim,
+                        stream=stream, chunk_size=chunk_size, tmpdir=tmpdir, columnar=columnar, only=only,
+                        collect_metrics=metrics.enabled))
+
+            for job in jobs:
+                patients, shard_metrics, unmatched = job.result()
+                for patient_id, seq_center in patients:
+                    study_group.add_patient(patient_id, seq_center)
+                if shard_metrics is not None:
+                    metrics.merge(shard_metrics)
+                # The CdeVar in the parent never saw these codes
+                cde.unmatched.update(unmatched)
+
+        for name, (filename, write_header) in transformed_tables.items():
+            for shard_dir in shard_dirs:
+                tables.append_shard(name, shard_dir / filename)
+
+        # The study wide group spans all shards, so it gets tacked on at the end
+        study_group.write_data(tables.writer('consent'))
+        rmtree(shard_root)
+        return
 
-                print(f"Encounter File: {consent['encounter']}")    
-                for line in reader:
-                    enc = Encounter(line)
-                    enc.write_measurements(study_name, wenc)
-
-            with open(output / "observations.tsv", 'wt') as outf:
-                writer = csv.writer(outf, delimiter='\t', quotechar='"')
-                Patient.write_observation_header(writer) 
+    # We'll dump consents for each group as they are parsed then the entire study
+    for consent_name in dataset['consent-groups'].keys():
+        TransformConsentGroup(study_name, dataset, consent_name, cde, study_group, tables,
+                delim, stream=stream, chunk_size=chunk_size, tmpdir=tmpdir, columnar=columnar, only=only, metrics=metrics)
+    study_group.write_data(tables.writer('consent'))
+
+def FindChangedParticipants(study, out, study_name, run_args):
+    """Hash each participant's inputs and compare them against the prior run
+
+    Writes the changeset files and returns the hash database (to be committed
+    once the outputs are written) along with the IDs of the participants to 
+    be re-emitted (None if there was no prior run, meaning everyone)."""
+    delim = study.get('delim', '\t')
+    dictionary_key = index_key(study['dict_merge'], study['mcd'], study['merge_col'])
+    hashes = ParticipantHashes(f"{out}/{study_name}/participant_hashes.db")
+    for consent_name, consent in study['consent-groups'].items():
+        LoadConsentConfig(consent)
+        hashes.add(consent_name, hash_participants(consent, delim, 
+                dictionary_key=dictionary_key,
+                chunk_size=run_args.get('chunk_size', DEFAULT_CHUNK_SIZE), 
+                tmpdir=run_args.get('tmpdir')))
+
+    prior_run = hashes.prior_run_exists()
+    changed = hashes.write_changeset(f"{out}/{study_name}/changeset")
+    print(f"{len(changed)} participants added or modified since the last run")
+    if not prior_run:
+        changed = None
+    else:
+        print(f"The transformed tables for {study_name} will only hold those participants")
+    return hashes, changed
+
+def ResolveTerms(cde, out, study_name, term_options, metrics=no_metrics):
+    """Look up every code the study can emit ahead of the transform, using
+    (and filling) the shared term cache. The results are written to
+    OUT/STUDY/term_details.csv and the condition rows are named after the
+    displays found (see CdeVar.use_displays)
+
+    term_lookup's cache is seeded from the shared cache first, and the
+    lookups go through term_lookup, so the transform itself finds every
+    term already looked up (see SaveTermLookups for the other direction)"""
+    source = None
+    if term_options.get('stub') is not None:
+        source = StubTermSource(term_options['stub'])
+    elif not term_options.get('offline'):
+        source = TermLookupSource(term_lookup)
+
+    term_cache = TermCache(term_options['cache'], term_options['ttl_days'], term_options['max_entries'])
+    seeded = term_cache.seed(TermLookupCache())
+    log.info("%d term_lookup entries seeded from %s", seeded, term_options['cache'])
+    resolver = TermResolver(term_cache,
+                source=source,
+                batch_size=term_options['batch_size'],
+                workers=term_options['workers'])
+    try:
+        codes = transform_codes(cde)
+        resolved = resolver.resolve(codes.keys())
+    finally:
+        resolver.close()
+
+    cde.use_displays(resolved)
+    unknown = write_term_details(f"{out}/{study_name}/term_details.csv", codes, resolved)
+    for system, code in unknown:
+        log.warning("%s isn't a known term in %s", code, system)
+    print(f"{len(resolved)} of {len(codes)} terms resolved ({resolver.cache_hits} cached, {resolver.remote_calls} looked up)")
+
+    metrics.count('term_cache_hits', resolver.cache_hits)
+    metrics.count('term_lookups', resolver.remote_calls)
+    metrics.count('term_lookup_failures', resolver.failed)
+
+def SaveTermLookups(term_options):
+    """Keep whatever term_lookup looked up during the transform in the shared
+    term cache"""
+    term_cache = TermCache(term_options['cache'], term_options['ttl_days'], term_options['max_entries'])
+    try:
+        term_cache.save(TermLookupCache())
+    finally:
+        term_cache.close()
+
+def TransformStudy(study, out, run_args, lock=None, cde_index=None, incremental=False, write_files=True, keep_in_memory=False, file_format='tsv', 
+            metrics_report=False, term_options=None):
+    """Transform a single dataset. If keep_in_memory is set, the transformed
+    tables are returned as DataFrames. 
+
+    If metrics_report is set, the study's timings and counts are written to
+    transform_metrics.json and transform_metrics.prom inside OUT/STUDY
+
+    If term_options are provided, the study's terms are resolved before the
+    transform (see ResolveTerms)
+
+    lock is only provided when other datasets are being transformed at the
+    same time, in which case it guards the databases they share"""
+    study_name = study['study_name'].replace(' ', '_')
+    dirname = Path(f"{out}/{study_name}/transformed")
+    dirname.mkdir(parents=True, exist_ok=True)
+    metrics = TransformMetrics(enabled=metrics_report)
+    remote_calls_before = term_lookup.remote_calls
+
+    # Each worker is a fresh (spawned) process, so the connection ChangeLog
+    # opens here is its own. Only purging the priors and the final commit in
+    # ChangeLog.Close() need to wait on the other workers
+    with lock or nullcontext():
+        # Incremental runs need the prior changes to compare against
+        ChangeLog.InitDB(out, study_name, purge_priors=not incremental)
+    with metrics.stage('cde'):
+        cde = CdeVar(study['dict_merge'], study['mcd'], study['merge_col'], index_dir=cde_index)
+        cde.write_cde_to_terms(f"{out}/{study_name}/cde_map.csv")
+    study = use_dictionary_columns(study, cde.cde.values())
+
+    if term_options is not None:
+        with metrics.stage('terms'):
+            ResolveTerms(cde, out, study_name, term_options, metrics=metrics)
+
+    hashes = None
+    only = None
+    if incremental:
+        with metrics.stage('incremental'):
+            hashes, only = FindChangedParticipants(study, out, study_name, run_args)
+
+    with metrics.stage('run'):
+        with TableSet(dirname, write_files=write_files, keep_in_memory=keep_in_memory, file_format=file_format, metrics=metrics) as tables:
+            Run(dirname, study_name, study, cde, only=only, tables=tables, metrics=metrics, **run_args)
+    cde.write_fsh_fragments(f"{out}/{study_name}/pheno.fsh")
+    if term_options is not None:
+        SaveTermLookups(term_options)
+
+    if len(cde.unmatched) > 0:
+        print(f"{len(cde.unmatched)} condition codes had no match in the CDE dictionaries ({sum(cde.unmatched.values())} rows)")
+        for code, count in cde.unmatched.most_common():
+            log.info("No match for code %s (%d rows)", code, count)
+
+    if hashes is not None:
+        hashes.commit()
+        hashes.close()
+
+    if metrics_report:
+        metrics.count('remote_calls', term_lookup.remote_calls - remote_calls_before)
+        metrics.add_unmatched(cde.unmatched)
+        metrics.write_json(f"{out}/{study_name}/transform_metrics.json")
+        metrics.write_prometheus(f"{out}/{study_name}/transform_metrics.prom", study_name)
+        print(f"Metrics written to {out}/{study_name}/transform_metrics.json")
+
+    if keep_in_memory:
+        return tables.frames()
+
+# Guards the databases and caches shared by all of the dataset workers
+_shared_lock = None
+
+def InitStudyWorker(lock):
+    global _shared_lock
+    _shared_lock = lock
+    Variant.cache = LockedCache(Variant.cache, lock)
+
+def TermLookupCache():
+    """term_lookup's in memory cache of the terms looked up so far. The
+    workers hand theirs back to the parent, which writes them all out. If
+    term_lookup keeps no cache, there is nothing to hand back or seed, so
+    an empty (throwaway) dict is returned instead"""
+    if not hasattr(term_lookup, 'cache'):
+        return {}
+    if term_lookup.cache is None:
+        # Nothing has been looked up (or loaded) yet
+        term_lookup.cache = {}
+    return term_lookup.cache
+
+def StudyCodes(studies, cde_index=None):
+    """The (label, DictEntry) pairs DictEntry.all_codes would hold ahead of
+    each study in a serial run. Each study's dictionaries are read just once"""
+    prior_codes = []
+    registered = []
+    for study in studies:
+        prior_codes.append(list(registered))
+        registered.extend(CdeVar(study['dict_merge'], study['mcd'], study['merge_col'], index_dir=cde_index).registered)
+    return prior_codes
+
+def TransformStudyWorker(prior_codes, study, out, run_args, cde_index=None, incremental=False, file_format='tsv', metrics_report=False, 
+            term_options=None):
+    """Transform a single dataset inside a worker process
+
+    DictEntry.all_codes accumulates across every dataset transformed in a 
+    run and pheno.fsh is dumped from it, so the codes registered by the 
+    studies that would have preceded this one (see StudyCodes) are put back
+    first to keep those identical to a serial run. 
+
+    Returns the worker's term lookups and remote call count so the parent can 
+    write a single, merged term cache."""
+    for label, entry in prior_codes:
+        DictEntry.register(label, entry)
+
+    TransformStudy(study, out, run_args, lock=_shared_lock, cde_index=cde_index, incremental=incremental, file_format=file_format, 
+                metrics_report=metrics_report, term_options=term_options)
+
+    # The cache takes the shared lock for itself
+    Variant.cache.commit()
+    with _shared_lock:
+        ChangeLog.Close()
 
-                for p in  sorted(subjects.keys()):
-                    subjects[p].write_observations(study_name, writer)
-            if consent_group is not None:
-                consent_group.write_data(wconsent)
-    study_group.write_data(wconsent)
-    fconsent.close()
+    return dict(TermLookupCache()), term_lookup.remote_calls
 
 if __name__ == "__main__":
     # Some files may end up going in a directory corresponding to the environment
@@ -185,27 +530,177 @@ if __name__ == "__main__":
                 required=True,
                 action='append')
     parser.add_argument("-o", "--out", default='output')
+    parser.add_argument("--stream",
+                action='store_true',
+                help="Sort-merge the participant and condition files on disk rather than holding the whole cohort in memory")
+    parser.add_argument("--sort-chunk-size",
+                type=int,
+                default=DEFAULT_CHUNK_SIZE,
+                help=f"Rows held in memory per sorted run when streaming (default {DEFAULT_CHUNK_SIZE})")
+    parser.add_argument("--sort-tmpdir",
+                default=None,
+                help="Directory used for the sorted runs when streaming")
+    parser.add_argument("-w",
+                "--workers",
+                type=int,
+                default=1,
+                help="Number of processes used to transform consent groups in parallel (default 1)")
+    parser.add_argument("-j",
+                "--parallel-datasets",
+                type=int,
+                default=1,
+                help="Number of datasets to transform at the same time, each in it's own process (default 1)")
+    parser.add_argument("--columnar-encounters",
+                action='store_true',
+                help="Use pandas to build the measurements in bulk. Consent groups with a field_map, data_map or invalid-ids still use the row-wise path")
+    parser.add_argument("--incremental",
+                action='store_true',
+                help="Only write out participants whose inputs have changed since the last run. The tables then hold just those participants, and the changes are listed in OUT/STUDY/changeset")
+    parser.add_argument("--cde-index-dir",
+                default=None,
+                help="Where the compiled CDE lookups are kept between runs (default OUT/cde_index)")
+    parser.add_argument("--no-cde-index",
+                action='store_true',
+                help="Always parse the merge/MCD dictionaries rather than using the compiled index")
+    parser.add_argument("--format",
+                choices=file_formats.keys(),
+                default='tsv',
+                help="File format used for the transformed tables (default tsv)")
+    parser.add_argument("--load",
+                choices=config.keys(),
+                default=None,
+                help="Load the transformed tables straight into this FHIR environment, without reading them back from disk")
+    parser.add_argument("-m", 
+                "--modules-to-load", 
+                default=[], 
+                action='append',
+                help="Which module(s) should be loaded when using --load? Default is all of them")
+    parser.add_argument("--no-tsv",
+                action='store_true',
+                help="When using --load, don't write the transformed TSV files (they are only useful for auditing)")
+    parser.add_argument("--metrics",
+                action='store_true',
+                help="Write timings and counts for each study to OUT/STUDY/transform_metrics.json (and .prom, for Prometheus)")
+    parser.add_argument("--resolve-terms",
+                action='store_true',
+                help="Look up every code the transform emits ahead of time. The conditions are named after the displays found (results are in OUT/STUDY/term_details.csv)")
+    parser.add_argument("--term-cache",
+                default=None,
+                help="SQLite cache used when resolving terms (default OUT/term_cache.db)")
+    parser.add_argument("--term-ttl-days",
+                type=float,
+                default=DEFAULT_TTL_DAYS,
+                help=f"Days before a cached term is looked up again (default {DEFAULT_TTL_DAYS})")
+    parser.add_argument("--term-cache-size",
+                type=int,
+                default=DEFAULT_MAX_ENTRIES,
+                help=f"Most terms kept in the cache, least recently used are dropped first (default {DEFAULT_MAX_ENTRIES})")
+    parser.add_argument("--term-batch-size",
+                type=int,
+                default=DEFAULT_BATCH_SIZE,
+                help=f"Terms committed to the term cache at a time (default {DEFAULT_BATCH_SIZE})")
+    parser.add_argument("--term-workers",
+                type=int,
+                default=DEFAULT_WORKERS,
+                help=f"Terms looked up at the same time (default {DEFAULT_WORKERS})")
+    parser.add_argument("--offline-terms",
+                action='store_true',
+                help="Never call the terminology API. Terms are only resolved from the cache (or --term-stub)")
+    parser.add_argument("--term-stub",
+                default=None,
+                help="Resolve terms from this TSV (system, code, display) instead of the API")
+    parser.add_argument("--log-level",
+                choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                default='WARNING',
+                help="DEBUG includes the per row details (unmatched codes and so on). Default WARNING")
     args = parser.parse_args()
 
-    for dsfile in sorted(args.dataset):
-        study = safe_load(dsfile)
-        study_name = study['study_name'].replace(' ', '_')
-        dirname = Path(f"{args.out}/{study_name}/transformed")
-        dirname.mkdir(parents=True, exist_ok=True)
-        ChangeLog.InitDB(args.out, study_name, purge_priors=True)
-        cde = CdeVar(study['dict_merge'], study['mcd'], study['merge_col'])
-        cde.write_cde_to_terms(f"{args.out}/{study_name}/cde_map.csv")
-
-        Run(dirname, study_name, study, cde)
-        cde.write_fsh_fragments(f"{args.out}/{study_name}/pheno.fsh")
+    logging.basicConfig(level=args.log_level, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
+    if args.no_tsv and args.load is None:
+        parser.error("--no-tsv only makes sense along with --load")
+    if args.load is not None and args.parallel_datasets > 1:
+        parser.error("--load can't be combined with --parallel-datasets")
+
+    if args.load is not None:
+        # Only pull in the loader's dependencies when they are needed
+        from ncpi_fhir_client.fhir_client import FhirClient
+        import ncpi_fhir_plugin as fhir
+        from include_load.study import all_loadable_classes, load_study
+
+        for module in args.modules_to_load:
+            if module not in all_loadable_classes:
+                parser.error(f"Unknown module, {module}. Options are: {', '.join(all_loadable_classes)}")
+        list_of_class_names_to_load = args.modules_to_load or all_loadable_classes
+
+        fhir_host = FhirClient(config[args.load])
+        fhir.set_fhir_server(fhir_host)
+
+    run_args = {
+        'stream': args.stream,
+        'chunk_size': args.sort_chunk_size,
+        'tmpdir': args.sort_tmpdir,
+        'workers': args.workers,
+        'columnar': args.columnar_encounters
+    }
+    term_options = None
+    if args.resolve_terms:
+        term_options = {
+            'cache': args.term_cache or f"{args.out}/term_cache.db",
+            'ttl_days': args.term_ttl_days,
+            'max_entries': args.term_cache_size,
+            'batch_size': args.term_batch_size,
+            'workers': args.term_workers,
+            'offline': args.offline_terms,
+            'stub': args.term_stub
+        }
+    cde_index = None
+    if not args.no_cde_index:
+        cde_index = args.cde_index_dir or f"{args.out}/cde_index"
+    studies = [safe_load(dsfile) for dsfile in sorted(args.dataset, key=lambda f: f.name)]
+    total_remote_calls = 0
+
+    if args.parallel_datasets > 1 and len(studies) > 1:
+        # Spawn rather than fork so that none of the open database handles 
+        # end up shared between processes. Each study gets a fresh process so
+        # that no class level state leaks from one study into the next
+        ctx = get_context('spawn')
+        with ProcessPoolExecutor(max_workers=args.parallel_datasets, 
+                    mp_context=ctx, 
+                    max_tasks_per_child=1, 
+                    initializer=InitStudyWorker, 
+                    initargs=(ctx.Lock(),)) as executor:
+            jobs = [executor.submit(TransformStudyWorker, prior_codes, study, args.out, run_args, cde_index, args.incremental, args.format, args.metrics, term_options) 
+                        for prior_codes, study in zip(StudyCodes(studies, cde_index), studies)]
+
+            for job in jobs:
+                term_cache, calls = job.result()
+                TermLookupCache().update(term_cache)
+                total_remote_calls += calls
+    else:
+        for study in studies:
+            tables = TransformStudy(study, args.out, run_args, 
+                        cde_index=cde_index, 
+                        incremental=args.incremental,
+                        write_files=not args.no_tsv,
+                        keep_in_memory=args.load is not None,
+                        file_format=args.format,
+                        metrics_report=args.metrics,
+                        term_options=term_options)
+
+            if args.load is not None:
+                load_study(fhir_host, args.load, study, args.out, list_of_class_names_to_load, tables=tables)
 
     # Write the term cache to file since the API can sometimes be unresponsive
     write_cache()
 
-    print(f"Total calls to remote api {remote_calls}")
+    total_remote_calls += term_lookup.remote_calls
+    print(f"Total calls to remote api {total_remote_calls}")
 
     # Make sure the cache is saved
     Variant.cache.commit()
-    ChangeLog.Close()
+    if args.parallel_datasets < 2 or len(studies) < 2:
+        # Otherwise, each of the workers has already closed their own
+        ChangeLog.Close()
 
 
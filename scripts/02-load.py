@@ -1,45 +1,27 @@
 #!/usr/bin/env python
 
 import sys
-from os import getenv, remove
-import logging
+from os import getenv
 from pathlib import Path
-from time import sleep
 
 from yaml import safe_load
-from kf_lib_data_ingest.common.io import read_df
-from kf_lib_data_ingest.etl.load.load import LoadStage
 from ncpi_fhir_client.fhir_client import FhirClient
 
 import ncpi_fhir_plugin as fhir # import SetAuthorization, remote_authorization
 
+from include_load.study import all_loadable_classes, load_study, load_study_environments, import_study
+from include_load.fhir_session import FhirSession
+from include_load.batch import BatchSubmitter, DEFAULT_BATCH_SIZE
+from include_load.adaptive import AdaptiveSubmitter
+from include_load.concurrency import AimdLimiter
+from include_load.ndjson import DEFAULT_CHUNK_BYTES
+from include_load.bulk_import import DEFAULT_POLL_INTERVAL, DEFAULT_IMPORT_TIMEOUT
+
 import pdb
 
 from argparse import ArgumentParser, FileType
 
 if __name__ == "__main__":
-    #   "family_relationship",
-    all_loadable_classes = [
-        'patient',
-        "consent",
-        "group",
-        "research_study", 
-        "research_subject",
-        'specimen',
-        "disease",
-        "human_phenotype",
-        "sequencing_center",
-        'encounter',
-        'condition',
-        'measurement',
-        'observation'
-    ]
-    _off = [
-        'service_request'
-    ]
-    """ For now, we'll leave these off. None of those fields mapped well anyway
-        "sequencing_file_info"  """
-
     hostsfile = Path(getenv("FHIRHOSTS", 'fhir_hosts'))
     config = safe_load(hostsfile.open("rt"))
     
@@ -48,8 +30,11 @@ if __name__ == "__main__":
     parser.add_argument("-e", 
                 "--env", 
                 choices=env_options, 
-                default='dev', 
-                help=f"Remote configuration to be used")
+                action='append',
+                help=f"Remote configuration to be used (default dev). Repeat to load several environments at once")
+    parser.add_argument("--all-envs",
+                action='store_true',
+                help="Load every environment in the hosts file at once")
     parser.add_argument("-d", 
                 "--dataset", 
                 type=FileType('rt'),
@@ -65,116 +50,169 @@ if __name__ == "__main__":
     parser.add_argument("-b", 
                 "--write-bundle",
                 action='store_true',
-                help="Optionally write a bundle file")
+                help="Optionally write a bundle file. With --batch-size or --adaptive, the resources are written out as NDJSON, a set of files per resource type, in OUT/{study_id}-{env}-bundle, as the server accepts them")
+    parser.add_argument("--bundle-compression",
+                choices=['none', 'gzip', 'bz2', 'zstd'],
+                default='none',
+                help="Compress the --write-bundle NDJSON files (zstd requires the zstandard package)")
+    parser.add_argument("--bundle-chunk-mb",
+                type=int,
+                default=DEFAULT_CHUNK_BYTES // (1024 * 1024),
+                help=f"Start a new --write-bundle NDJSON file once one reaches this many MB, uncompressed (default {DEFAULT_CHUNK_BYTES // (1024 * 1024)})")
     parser.add_argument("-p",
                 "--purge-ids",
                 action='store_true',
                 help="Purge the ID cache. Use only the database has been rebuilt and it's contents look different from when this was last run.")
+    parser.add_argument("--batch-size",
+                type=int,
+                default=None,
+                help=f"Submit resources in FHIR batch bundles of this many entries rather than one at a time (e.g. {DEFAULT_BATCH_SIZE})")
+    parser.add_argument("--bundle-type",
+                choices=['batch', 'transaction'],
+                default='batch',
+                help="Bundle type used along with --batch-size (default batch)")
+    parser.add_argument("--adaptive",
+                action='store_true',
+                help="Send requests concurrently over pooled keep-alive connections, adjusting how many are in flight to what the server can handle")
+    parser.add_argument("--min-concurrency",
+                type=int,
+                default=int(getenv("LOAD_MIN_CONCURRENCY", 2)),
+                help="Fewest requests kept in flight with --adaptive (env LOAD_MIN_CONCURRENCY, default 2)")
+    parser.add_argument("--max-concurrency",
+                type=int,
+                default=int(getenv("LOAD_MAX_CONCURRENCY", 32)),
+                help="Most requests kept in flight with --adaptive (env LOAD_MAX_CONCURRENCY, default 32)")
+    parser.add_argument("--gzip",
+                action='store_true',
+                default=getenv("LOAD_GZIP", "") not in ("", "0"),
+                help="Gzip request bodies when using --batch-size or --adaptive. The server must accept Content-Encoding: gzip (env LOAD_GZIP)")
+    parser.add_argument("--parallel-classes",
+                type=int,
+                default=int(getenv("LOAD_PARALLEL_CLASSES", 1)),
+                help="Load up to this many independent classes at once when using --batch-size or --adaptive. All of them share the same concurrency budget (env LOAD_PARALLEL_CLASSES, default 1)")
+    parser.add_argument("--resume",
+                action='store_true',
+                help="Pick up an interrupted load where it left off, skipping whatever was already loaded. Requires --batch-size or --adaptive")
+    parser.add_argument("--bulk-import",
+                action='store_true',
+                help="Load using the server's Bulk Data $import, with IDs assigned here. Intended for the first load of a large study")
+    parser.add_argument("--import-dir",
+                default=None,
+                help="Write the --bulk-import NDJSON here (default OUT/{study_id}-{env}-import)")
+    parser.add_argument("--import-url",
+                default=None,
+                help="URL where the server can find the --import-dir files (staged on shared storage, say). Without this, the files are served from here")
+    parser.add_argument("--import-serve",
+                default="127.0.0.1:0",
+                help="host:port the --bulk-import files are served from when there's no --import-url (default 127.0.0.1 on any free port)")
+    parser.add_argument("--import-public-host",
+                default=None,
+                help="Name the FHIR server should use to reach --import-serve, if not it's host")
+    parser.add_argument("--import-poll-interval",
+                type=float,
+                default=DEFAULT_POLL_INTERVAL,
+                help=f"Seconds between checks on the $import's status (default {DEFAULT_POLL_INTERVAL})")
+    parser.add_argument("--import-timeout",
+                type=int,
+                default=DEFAULT_IMPORT_TIMEOUT,
+                help=f"Seconds to wait on the $import before giving up (default {DEFAULT_IMPORT_TIMEOUT})")
     args = parser.parse_args()
 
+    if args.resume and args.batch_size is None and not args.adaptive:
+        parser.error("--resume relies on the load journal, which requires --batch-size or --adaptive")
+
+    if args.parallel_classes > 1 and args.batch_size is None and not args.adaptive:
+        parser.error("--parallel-classes (or LOAD_PARALLEL_CLASSES) requires --batch-size or --adaptive, LoadStage loads one class at a time")
+
+    envs = list(env_options) if args.all_envs else (args.env or ['dev'])
+    # Repeats are harmless, but only load each one once
+    envs = list(dict.fromkeys(envs))
+    if args.bulk_import:
+        if len(envs) > 1:
+            parser.error("--bulk-import loads a single environment at a time")
+        if args.batch_size is not None or args.adaptive or args.resume or args.write_bundle:
+            parser.error("--bulk-import can't be combined with --batch-size, --adaptive, --resume or --write-bundle (the import files are kept in --import-dir)")
+
+    if len(envs) > 1:
+        if args.batch_size is None and not args.adaptive:
+            parser.error("Loading several environments at once requires --batch-size or --adaptive")
+
+    bundle_options = {
+        'compression': None if args.bundle_compression == 'none' else args.bundle_compression,
+        'max_bytes': args.bundle_chunk_mb * 1024 * 1024
+    }
+
     list_of_class_names_to_load = args.modules_to_load
     if len(list_of_class_names_to_load) == 0:
         list_of_class_names_to_load = all_loadable_classes
 
+    def build_submitter(fhir_host):
+        """Each environment gets it's own connections and concurrency limits"""
+        limiter = None
+        if args.adaptive:
+            limiter = AimdLimiter(floor=args.min_concurrency, ceiling=args.max_concurrency)
+
+        if args.batch_size is None and not args.adaptive:
+            return None
+        # Each class being loaded at once can have up to max_concurrency
+        # requests waiting on the limiter (or one bundle at a time without
+        # it), so keep a connection around for every one of them
+        per_class = args.max_concurrency if args.adaptive else 1
+        pool_size = max(args.parallel_classes, 1) * per_class
+        session = FhirSession(fhir_host.target_service_url, fhir_host, pool_size=pool_size, compress=args.gzip)
+        if args.batch_size is not None:
+            return BatchSubmitter(session, batch_size=args.batch_size, bundle_type=args.bundle_type, limiter=limiter)
+        return AdaptiveSubmitter(session, limiter)
+
     #pdb.set_trace()
-    fhir_host = FhirClient(config[args.env])
-    fhir.set_fhir_server(fhir_host)
-    
+    fhir_hosts = {env: FhirClient(config[env]) for env in envs}
+    # The plugin builds the resources just once, so it only needs the one
+    fhir.set_fhir_server(fhir_hosts[envs[0]])
+
+    submitters = {env: build_submitter(fhir_host) for env, fhir_host in fhir_hosts.items()}
+
     datasets = args.dataset 
 
-    path_to_my_target_service_plugin = Path(fhir.__file__).parent / "fhir_plugin.py"
-    target_service_base_url = fhir_host.target_service_url
- 
     for dsfile in datasets:
         study = safe_load(dsfile)
-        study_id = study['study_id']
-        study_name = study['study_name'].replace(' ', '_')
-        study_title = study['study_title']
-
-        #pdb.set_trace()
-        print(f"Loading '{study_id}'")
-        log_filename = f"{args.out}/{study_name}-{args.env}-load.log"
-        print(f"Logfile: {log_filename}")
-
-        # This clears out previous logging entities so we can determine what and where to log
-        for handler in logging.root.handlers[:]:
-            logging.root.removeHandler(handler)
-
-        logging.basicConfig(filename=log_filename,
-                                filemode='wt',
-                                format='%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
-                                datefmt='%H:%M:%S',
-                                level=logging.WARNING)
-
-        fhir_host.init_log()
-        input_file_dir = f"{args.out}/{study_name}/transformed"
-        path_to_cache_storage_directory = Path(f"{input_file_dir}/{args.env}")
-        path_to_cache_storage_directory.mkdir(parents=True, exist_ok=True)
-
-        if args.purge_ids:
-            cache_file = f"{path_to_cache_storage_directory}/LoadStage/localhost_8000_{study_id}_uid_cache.db"
-            print(f"Purging local cache: {cache_file}")
-            try:
-                remove(cache_file)
-            except:
-                pass
-
-        if args.write_bundle:
-            fhir_host.init_bundle(f"{args.out}/{study_id}-{args.env}.json", study_id)
-        """
-        specimens = read_df(f'{input_file_dir}/specimen.tsv')
-        consents = read_df(f'{input_file_dir}/consent_groups.tsv')
-        subjects = read_df(f'{input_file_dir}/subject.tsv')
-        disease = read_df(f'{input_file_dir}/disease.tsv')
-        hpo = read_df(f'{input_file_dir}/hpo.tsv')
-        sequencing_data = read_df(f'{input_file_dir}/sequencing.tsv')
-        """
-        
-        subjects = read_df(f'{input_file_dir}/participant.tsv')
-        conditions = read_df(f"{input_file_dir}/conditions.tsv")
-        diseases = read_df(f"{input_file_dir}/diseases.tsv")
-        encounters = read_df(f"{input_file_dir}/encounters.tsv")
-        observations = read_df(f"{input_file_dir}/observations.tsv")
-        consents = read_df(f"{input_file_dir}/consent_groups.tsv")
-
-        basic_reports = {
-            "default": subjects,
-            'research_study': consents,
-            'consent': consents,
-            'group': consents,
-            'research_subject': subjects,
-            'sequencing_center': consents,
-            'specimen': encounters,
-            'condition': conditions,
-            'disease': diseases,
-            'human_phenotype': conditions,
-            'encounter': encounters,
-            "measurement": encounters,
-            'observation': observations
-        }
-        # Not enough time right now to figure out what is wrong with this
-        offs = {    
-            'service_request': encounters,
-        }
-        if Path(f"{input_file_dir}/discovery_variant.tsv").is_file():
-            discovery_variant = read_df(f"{input_file_dir}/discovery_variant.tsv") 
-
-            basic_reports['discovery_variant'] = discovery_variant
-            basic_reports["discovery_implication"] = discovery_variant
-
-        if Path(f"{input_file_dir}/discovery_report.tsv").is_file():
-            discovery_report = read_df(f"{input_file_dir}/discovery_report.tsv")
-
-            basic_reports["discovery_report"] = discovery_report
-        #pdb.set_trace()
-        use_async = True #use_async = True
-        outcome = LoadStage(
-            path_to_my_target_service_plugin,
-            target_service_base_url,
-            list_of_class_names_to_load,
-            study_id,
-            str(path_to_cache_storage_directory),
-            use_async=use_async
-        ).run(basic_reports)
-
-        fhir_host.close_bundle()
\ No newline at end of file
+        if args.bulk_import:
+            host, port = args.import_serve.rsplit(":", 1)
+            fhir_host = fhir_hosts[envs[0]]
+            import_study(fhir_host,
+                    envs[0],
+                    study,
+                    args.out,
+                    list_of_class_names_to_load,
+                    FhirSession(fhir_host.target_service_url, fhir_host, compress=args.gzip),
+                    purge_ids=args.purge_ids,
+                    import_options={
+                        'directory': args.import_dir,
+                        'base_url': args.import_url,
+                        'serve': (host, int(port)),
+                        'public_host': args.import_public_host,
+                        'poll_interval': args.import_poll_interval,
+                        'timeout': args.import_timeout
+                    })
+        elif len(envs) > 1:
+            load_study_environments(fhir_hosts,
+                    submitters,
+                    study,
+                    args.out,
+                    list_of_class_names_to_load,
+                    purge_ids=args.purge_ids,
+                    parallel_classes=args.parallel_classes,
+                    resume=args.resume,
+                    write_bundle=args.write_bundle,
+                    bundle_options=bundle_options)
+        else:
+            load_study(fhir_hosts[envs[0]], 
+                    envs[0], 
+                    study, 
+                    args.out, 
+                    list_of_class_names_to_load, 
+                    write_bundle=args.write_bundle, 
+                    purge_ids=args.purge_ids,
+                    submitter=submitters[envs[0]],
+                    parallel_classes=args.parallel_classes,
+                    resume=args.resume,
+                    bundle_options=bundle_options)
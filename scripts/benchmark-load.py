@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+
+"""Measure load throughput against a local mock FHIR server
+
+A synthetic study is built with the same row writers 01-transform.py uses and
+loaded, one class at a time, into a MockFhirServer that can be made slow,
+flaky or quick to throttle. For each class we report the resources loaded
+per second, the p50/p99 request latency and how many requests had to be
+retried (those the server throttled or failed), as seen by the server.
+
+    scripts/benchmark-load.py --participants 2000 --latency 0.02 --throttle-rate 0.01
+    scripts/benchmark-load.py --loader adaptive --max-concurrent 16 --json bench.json
+"""
+
+import io
+import json
+import random
+import time
+from argparse import ArgumentParser
+from collections import Counter
+from contextlib import redirect_stdout
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from cmg_transform.consent import ConsentGroup
+from include_transform.patient import Patient
+from include_transform.encounter import Encounter
+from include_transform.records import condition_codes
+from include_transform.cde_conversions import CdeVar
+from include_transform.tables import TableSet
+
+from include_load.study import all_loadable_classes, init_logging
+from include_load.reports import build_basic_reports
+from include_load.mock_server import MockFhirServer
+
+# A handful of real HPO terms so the conditions look the part
+hpo_terms = [
+    ("HP:0001631", "Atrial septal defect"),
+    ("HP:0001629", "Ventricular septal defect"),
+    ("HP:0000365", "Hearing impairment"),
+    ("HP:0000821", "Hypothyroidism"),
+    ("HP:0002719", "Recurrent infections"),
+    ("HP:0000486", "Strabismus"),
+    ("HP:0002910", "Elevated hepatic transaminase"),
+    ("HP:0001263", "Global developmental delay")
+]
+hpo_system = "http://purl.obolibrary.org/obo/hp.owl"
+
+class SyntheticCde:
+    """Stands in for the CdeVar, mapping each condition to it's HPO code"""
+    def __init__(self):
+        self.codes = {name: code for code, name in hpo_terms}
+        self.unmatched = Counter()
+        self.row_templates = {}
+
+    def get_matches(self, code):
+        return [(hpo_system, code, self.codes[code])]
+
+    condition_rows = CdeVar.condition_rows
+
+def synthetic_patient(rand, index):
+    patient = Patient.__new__(Patient)
+    patient.id = f"SYN{index:07d}"
+    patient.family_id = f"SYNFAM{index // 3:07d}"
+    patient.sex = rand.choice(["Female", "Male"])
+    patient.race = rand.choice(["White", "Black or African American", "Asian"])
+    patient.eth = rand.choice(["Not Hispanic or Latino", "Hispanic or Latino"])
+    patient.cohort_type = rand.choice(["Down syndrome", "Control"])
+    patient.phenotype_description = patient.cohort_type
+    patient.abstraction_status = "Complete"
+    patient.karyoptype = "Trisomy 21" if patient.cohort_type == "Down syndrome" else "Normal"
+    patient.diagnosis = patient.karyoptype
+    patient.official_diag = patient.karyoptype
+    patient.age_of_onset = None
+    patient.present = condition_codes.packed()
+    patient.absent = condition_codes.packed()
+    return patient
+
+def synthetic_encounter(rand, patient, visit):
+    encounter = Encounter.__new__(Encounter)
+    encounter.id = patient.id
+    encounter.encounter_id = str(visit + 1)
+    encounter.age_at_event = str(rand.randint(365, 365 * 40))
+    encounter.sample_id = f"{patient.id}-{visit + 1}"
+    height = rand.uniform(90, 190)
+    weight = rand.uniform(15, 110)
+    encounter.height_cm = f"{height:.1f}"
+    encounter.weight_kg = f"{weight:.1f}"
+    encounter.bmi = f"{weight / (height / 100) ** 2:.1f}"
+    return encounter
+
+def synthetic_study(study_name, study_id, participants, conditions, encounters, seed=0):
+    """Build the transformed tables for a study of randomly generated
+    participants. Returns the tables as DataFrames"""
+    rand = random.Random(seed)
+    cde = SyntheticCde()
+    tables = TableSet(None, write_files=False, keep_in_memory=True)
+
+    study_group = ConsentGroup(study_name, study_title=study_name, study_id=study_id, group_name=study_name, consent_name="GRU")
+    consent_group = ConsentGroup(study_name, study_title=study_name, study_id=study_id, group_name="GRU", consent_name="GRU")
+
+    # write_disease chats about every participant, which we don't need to see here
+    with redirect_stdout(io.StringIO()):
+        for index in range(participants):
+            patient = synthetic_patient(rand, index)
+            for code, name in rand.sample(hpo_terms, min(conditions, len(hpo_terms))):
+                patient.add_condition(name, rand.random() < 0.5)
+
+            study_group.add_patient(patient.id, "Synthetic")
+            consent_group.add_patient(patient.id, "Synthetic")
+            patient.write_subject_data(study_name, tables.writer('participant'))
+            patient.write_conditions(study_name, tables.writer('condition'), cde)
+            patient.write_disease(study_name, tables.writer('disease'))
+            patient.write_observations(study_name, tables.writer('observation'))
+            for visit in range(encounters):
+                synthetic_encounter(rand, patient, visit).write_measurements(study_name, tables.writer('encounter'))
+
+    consent_group.write_data(tables.writer('consent'))
+    study_group.write_data(tables.writer('consent'))
+    return tables.frames()
+
+def percentile(values, pct):
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+def summarize(class_name, stats, seconds):
+    """Boil the server's view of a class's requests down to the numbers we
+    care about"""
+    latencies = [stat.seconds for stat in stats]
+    loaded = sum(stat.resources for stat in stats if stat.method != "GET" and 200 <= stat.status < 300)
+    retried = sum(1 for stat in stats if stat.status == 429 or stat.status >= 500)
+    return {
+        'class': class_name,
+        'resources': loaded,
+        'requests': len(stats),
+        'seconds': seconds,
+        'resources_per_sec': loaded / seconds if seconds > 0 else None,
+        'p50_latency': percentile(latencies, 50),
+        'p99_latency': percentile(latencies, 99),
+        'retries': retried
+    }
+
+def class_loader(args, server, study_id, cache_dir):
+    """Returns a function that loads a single class into the mock server
+    using the requested loader"""
+    import ncpi_fhir_plugin as fhir
+    from ncpi_fhir_client.fhir_client import FhirClient
+
+    plugin_path = Path(fhir.__file__).parent / "fhir_plugin.py"
+    fhir_host = FhirClient({
+        'auth_type': 'auth_basic',
+        'username': 'benchmark',
+        'password': 'benchmark',
+        'host_desc': 'Mock FHIR server',
+        'target_service_url': server.base_url
+    })
+    fhir.set_fhir_server(fhir_host)
+
+    if args.loader == 'loadstage':
+        from kf_lib_data_ingest.etl.load.load import LoadStage
+
+        def load(class_name, basic_reports):
+            LoadStage(plugin_path, server.base_url, [class_name], study_id, str(cache_dir), use_async=True).run(basic_reports)
+        return load
+
+    from include_load.fhir_session import FhirSession
+    from include_load.loader import ResourceLoader
+    from include_load.uid_cache import UidCache
+    from include_load.batch import BatchSubmitter
+    from include_load.adaptive import AdaptiveSubmitter
+    from include_load.concurrency import AimdLimiter
+
+    session = FhirSession(server.base_url, fhir_host, pool_size=args.max_concurrency, compress=args.gzip)
+    if args.loader == 'batch':
+        submitter = BatchSubmitter(session, batch_size=args.batch_size)
+    else:
+        submitter = AdaptiveSubmitter(session, AimdLimiter(floor=args.min_concurrency, ceiling=args.max_concurrency))
+    loader = ResourceLoader(plugin_path, UidCache(cache_dir, server.base_url, study_id), submitter)
+
+    def load(class_name, basic_reports):
+        loader.load_class(class_name, basic_reports)
+    return load
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--participants", type=int, default=500, help="Number of synthetic participants (default 500)")
+    parser.add_argument("--conditions", type=int, default=4, help="Conditions recorded for each participant (default 4)")
+    parser.add_argument("--encounters", type=int, default=2, help="Encounters for each participant (default 2)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic data and the server's misbehavior")
+    parser.add_argument("--latency", type=float, default=0.005, help="Seconds the server spends on each request (default 0.005)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Up to this many more seconds are added to each request at random")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests that fail with a 500")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Fraction of requests that are throttled with a 429")
+    parser.add_argument("--max-concurrent", type=int, default=None, help="Throttle requests beyond this many at once")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After sent along with 429s (default 1)")
+    parser.add_argument("--loader",
+                choices=['loadstage', 'batch', 'adaptive'],
+                default='loadstage',
+                help="How the resources are sent (default loadstage, as 02-load.py does by default)")
+    parser.add_argument("--batch-size", type=int, default=250, help="Entries per bundle for the batch loader (default 250)")
+    parser.add_argument("--min-concurrency", type=int, default=2, help="Concurrency floor for the adaptive loader (default 2)")
+    parser.add_argument("--max-concurrency", type=int, default=32, help="Concurrency ceiling for the adaptive loader (default 32)")
+    parser.add_argument("--gzip", action='store_true', help="Gzip request bodies (batch and adaptive loaders)")
+    parser.add_argument("-m",
+                "--modules-to-load",
+                choices=all_loadable_classes,
+                default=[],
+                action='append',
+                help="Which module(s) should be loaded? Default is all of them")
+    parser.add_argument("--json", default=None, help="Also write the results to this file as JSON")
+    args = parser.parse_args()
+
+    class_names = args.modules_to_load or all_loadable_classes
+    study_id = "SYNTHETIC"
+
+    print(f"Building a synthetic study of {args.participants} participants")
+    tables = synthetic_study("Synthetic Study", study_id, args.participants, args.conditions, args.encounters, args.seed)
+    basic_reports = build_basic_reports(tables)
+
+    results = []
+    with TemporaryDirectory() as cache_dir, MockFhirServer(latency=args.latency,
+                jitter=args.jitter,
+                error_rate=args.error_rate,
+                throttle_rate=args.throttle_rate,
+                max_concurrent=args.max_concurrent,
+                retry_after=args.retry_after,
+                seed=args.seed) as server:
+        init_logging(f"{cache_dir}/benchmark-load.log")
+        load = class_loader(args, server, study_id, cache_dir)
+
+        for class_name in class_names:
+            server.take_stats()
+            start = time.monotonic()
+            load(class_name, basic_reports)
+            results.append(summarize(class_name, server.take_stats(), time.monotonic() - start))
+
+    print(f"\n{'Class':<20}{'Resources':>10}{'Requests':>10}{'Seconds':>10}{'Res/sec':>10}{'p50 ms':>10}{'p99 ms':>10}{'Retries':>10}")
+    for result in results:
+        rate = result['resources_per_sec'] or 0
+        p50 = (result['p50_latency'] or 0) * 1000
+        p99 = (result['p99_latency'] or 0) * 1000
+        print(f"{result['class']:<20}{result['resources']:>10}{result['requests']:>10}{result['seconds']:>10.2f}{rate:>10.1f}{p50:>10.1f}{p99:>10.1f}{result['retries']:>10}")
+
+    total_resources = sum(r['resources'] for r in results)
+    total_seconds = sum(r['seconds'] for r in results)
+    print(f"\nTotal: {total_resources} resources in {total_seconds:.2f}s ({total_resources / total_seconds if total_seconds else 0:.1f}/sec)")
+
+    if args.json is not None:
+        with open(args.json, 'wt') as f:
+            json.dump({'settings': vars(args), 'classes': results}, f, indent=2)
+        print(f"Results written to {args.json}")
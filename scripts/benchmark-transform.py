@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+
+"""Time and memory profile the transform against synthetic HTP datasets
+
+For each scale (number of participants), a synthetic dataset is generated
+(or reused if it's already there) and the following are measured, each in a
+fresh process so the peak RSS reported belongs to that stage alone:
+
+    cde         - Building the CdeVar from the merge and MCD dictionaries
+    writers     - Each of the Patient/Encounter row writers over the whole cohort
+    run         - Run() from 01-transform.py, producing the transformed tables
+
+The transformed tables can then be checked against golden copies. Save those
+from a known good version with --save-golden and any faster code path can be
+shown to produce identical output with --golden.
+
+    scripts/benchmark-transform.py --scales 10000 100000 --save-golden golden
+    scripts/benchmark-transform.py --scales 10000 100000 --golden golden --stream
+"""
+
+import csv
+import filecmp
+import json
+import resource
+import runpy
+import shutil
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from multiprocessing import get_context
+from pathlib import Path
+
+from yaml import safe_load
+
+_transform = None
+
+def transform_module():
+    """01-transform.py can't be imported by name, so we load it by path"""
+    global _transform
+    if _transform is None:
+        _transform = runpy.run_path(str(Path(__file__).parent / "01-transform.py"), run_name="transform")
+    return _transform
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def measured(func, *args):
+    """Runs inside the child process. Returns (result, seconds, peak RSS)"""
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start, peak_rss_mb()
+
+def isolated(func, *args):
+    """Run func in a process of it's own"""
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+        return executor.submit(measured, func, *args).result()
+
+class Nowhere:
+    """A file that throws away whatever is written to it"""
+    def write(self, text):
+        return len(text)
+
+class CountingWriter:
+    """Serializes rows just as the csv writer would, but to nowhere"""
+    def __init__(self):
+        self.rows = 0
+        self.writer = csv.writer(Nowhere(), delimiter='\t', quotechar='"')
+
+    def writerow(self, row):
+        self.rows += 1
+        self.writer.writerow(row)
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+def stage_generate(dirname, participants, conditions, visits, consent_groups, condition_vars, seed):
+    from include_transform.synthetic import generate_dataset
+
+    return str(generate_dataset(dirname, participants,
+                conditions_per=conditions,
+                visits=visits,
+                consent_groups=consent_groups,
+                condition_count=condition_vars,
+                seed=seed))
+
+def stage_cde(dataset_file, log_file):
+    from include_transform.cde_conversions import CdeVar
+
+    dataset = safe_load(open(dataset_file))
+    with open(log_file, 'at') as log, redirect_stdout(log):
+        cde = CdeVar(dataset['dict_merge'], dataset['mcd'], dataset['merge_col'])
+    return {'matched_vars': len(cde.matches)}
+
+def stage_writers(dataset_file, log_file):
+    """Load the whole cohort the way Run() does and then time each of the
+    writers over all of it. The inputs are read just as Run() reads them, so
+    compressed files and wide consent groups work here too"""
+    from cmg_transform import Transform
+    from include_transform.patient import Patient
+    from include_transform.encounter import Encounter
+    from include_transform.cde_conversions import CdeVar
+    from include_transform.compression import open_text
+    from include_transform.wide import ConsentSections, use_dictionary_columns
+
+    dataset = safe_load(open(dataset_file))
+    delim = dataset.get('delim', '\t')
+    results = {}
+
+    with open(log_file, 'at') as log, redirect_stdout(log):
+        cde = CdeVar(dataset['dict_merge'], dataset['mcd'], dataset['merge_col'])
+        dataset = use_dictionary_columns(dataset, cde.cde.values())
+        subjects = {}
+        encounters = []
+        for consent in dataset['consent-groups'].values():
+            for section, line in ConsentSections(consent, delim).records():
+                if section == 'participant':
+                    p = Patient(line)
+                    if p.id in subjects:
+                        p.carry_conditions(subjects[p.id])
+                    subjects[p.id] = p
+                elif section == 'condition':
+                    subjects[line['participantid']].load_condition(line)
+                else:
+                    subjects[line['participantid']].load_ds_condition(line)
+            with open_text(consent['encounter']) as f:
+                for line in Transform.GetReader(f, delimiter=delim):
+                    encounters.append(Encounter(line))
+
+        study_name = dataset['study_name'].replace(' ', '_')
+        writers = [
+            ('write_subject_data', lambda p, w: p.write_subject_data(study_name, w), subjects.values()),
+            ('write_conditions', lambda p, w: p.write_conditions(study_name, w, cde), subjects.values()),
+            ('write_disease', lambda p, w: p.write_disease(study_name, w), subjects.values()),
+            ('write_observations', lambda p, w: p.write_observations(study_name, w), subjects.values()),
+            ('write_measurements', lambda e, w: e.write_measurements(study_name, w), encounters)
+        ]
+        for name, write, items in writers:
+            writer = CountingWriter()
+            start = time.perf_counter()
+            for item in items:
+                write(item, writer)
+            seconds = time.perf_counter() - start
+            results[name] = {
+                'rows': writer.rows,
+                'seconds': seconds,
+                'rows_per_sec': writer.rows / seconds if seconds > 0 else None
+            }
+    return results
+
+def stage_run(dataset_file, out, run_args, log_file):
+    from cmg_transform.change_logger import ChangeLog
+    from include_transform.cde_conversions import CdeVar
+
+    transform = transform_module()
+    dataset = safe_load(open(dataset_file))
+    study_name = dataset['study_name'].replace(' ', '_')
+    dirname = Path(out) / "transformed"
+    if dirname.exists():
+        shutil.rmtree(dirname)
+    dirname.mkdir(parents=True)
+
+    with open(log_file, 'at') as log, redirect_stdout(log):
+        ChangeLog.InitDB(out, study_name, purge_priors=True)
+        cde = CdeVar(dataset['dict_merge'], dataset['mcd'], dataset['merge_col'])
+        transform['Run'](dirname, study_name, dataset, cde, **run_args)
+        ChangeLog.Close()
+
+    rows = {}
+    for filename in sorted(dirname.iterdir()):
+        with open(filename, 'rb') as f:
+            rows[filename.name] = sum(1 for line in f) - 1
+    return rows
+
+def compare_to_golden(transformed, golden):
+    """Returns a list of the differences between the two directories"""
+    differences = []
+    for filename in sorted(golden.iterdir()):
+        ours = transformed / filename.name
+        if not ours.is_file():
+            differences.append(f"{filename.name} is missing")
+        elif not filecmp.cmp(ours, filename, shallow=False):
+            with open(ours, 'rt') as a, open(filename, 'rt') as b:
+                for lineno, (x, y) in enumerate(zip(a, b), start=1):
+                    if x != y:
+                        differences.append(f"{filename.name} differs at line {lineno}")
+                        break
+                else:
+                    differences.append(f"{filename.name} differs in length")
+    for filename in sorted(transformed.iterdir()):
+        if not (golden / filename.name).exists():
+            differences.append(f"{filename.name} isn't in the golden copy")
+    return differences
+
+def report(scale, stage, seconds, rss, detail=""):
+    print(f"{scale:>10} {stage:<28}{seconds:>10.2f}s{rss:>10.0f}MB  {detail}")
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--scales",
+                type=int,
+                nargs='+',
+                default=[10000],
+                help="Participant counts to benchmark (e.g. 10000 100000 1000000)")
+    parser.add_argument("--conditions", type=int, default=5, help="Conditions per participant (default 5)")
+    parser.add_argument("--visits", type=int, default=2, help="Encounters per participant (default 2)")
+    parser.add_argument("--consent-groups", type=int, default=1, help="Consent groups per dataset (default 1)")
+    parser.add_argument("--condition-vars", type=int, default=100, help="Distinct condition variables (default 100)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-w", "--workdir", default="benchmark", help="Where datasets and outputs are kept (default benchmark)")
+    parser.add_argument("--regenerate", action='store_true', help="Generate the datasets even if they already exist")
+    parser.add_argument("--stages",
+                nargs='+',
+                choices=['cde', 'writers', 'run'],
+                default=['cde', 'writers', 'run'],
+                help="Which stages to measure (default all)")
+    parser.add_argument("--stream", action='store_true', help="Run() with --stream")
+    parser.add_argument("--workers", type=int, default=1, help="Run() with this many --workers")
+    parser.add_argument("--columnar-encounters", action='store_true', help="Run() with --columnar-encounters")
+    parser.add_argument("--golden", default=None, help="Check the transformed tables against the golden copies in this directory")
+    parser.add_argument("--save-golden", default=None, help="Save the transformed tables as the golden copies in this directory")
+    parser.add_argument("--json", default=None, help="Also write the results to this file as JSON")
+    args = parser.parse_args()
+
+    run_args = {
+        'stream': args.stream,
+        'workers': args.workers,
+        'columnar': args.columnar_encounters
+    }
+    workdir = Path(args.workdir)
+    results = []
+    mismatches = 0
+
+    print(f"{'Scale':>10} {'Stage':<28}{'Time':>11}{'Peak RSS':>12}")
+    for scale in args.scales:
+        name = f"{scale}-c{args.conditions}-v{args.visits}-g{args.consent_groups}-s{args.seed}"
+        dataset_dir = workdir / "datasets" / name
+        out = workdir / "output" / name
+        out.mkdir(parents=True, exist_ok=True)
+        log_file = str(out / "transform.log")
+        dataset_file = dataset_dir / "dataset.yaml"
+        result = {'scale': scale, 'dataset': str(dataset_file), 'stages': {}}
+
+        if args.regenerate or not dataset_file.is_file():
+            _, seconds, rss = isolated(stage_generate, str(dataset_dir), scale, args.conditions, args.visits,
+                        args.consent_groups, args.condition_vars, args.seed)
+            result['stages']['generate'] = {'seconds': seconds, 'peak_rss_mb': rss}
+            report(scale, "generate", seconds, rss)
+
+        if 'cde' in args.stages:
+            detail, seconds, rss = isolated(stage_cde, str(dataset_file), log_file)
+            result['stages']['cde'] = dict(detail, seconds=seconds, peak_rss_mb=rss)
+            report(scale, "CdeVar", seconds, rss, f"{detail['matched_vars']} variables matched")
+
+        if 'writers' in args.stages:
+            writers, seconds, rss = isolated(stage_writers, str(dataset_file), log_file)
+            result['stages']['writers'] = {'seconds': seconds, 'peak_rss_mb': rss, 'writers': writers}
+            report(scale, "writers (incl. loading)", seconds, rss)
+            for writer, stats in writers.items():
+                print(f"{'':>10}   {writer:<25}{stats['seconds']:>10.2f}s{'':>12}  {stats['rows']} rows, {stats['rows_per_sec'] or 0:.0f} rows/sec")
+
+        if 'run' in args.stages:
+            rows, seconds, rss = isolated(stage_run, str(dataset_file), str(out), run_args, log_file)
+            total_rows = sum(rows.values())
+            result['stages']['run'] = {'seconds': seconds, 'peak_rss_mb': rss, 'rows': rows, 'rows_per_sec': total_rows / seconds}
+            report(scale, "Run()", seconds, rss, f"{total_rows} rows, {total_rows / seconds:.0f} rows/sec")
+
+            transformed = out / "transformed"
+            if args.save_golden is not None:
+                golden = Path(args.save_golden) / name
+                if golden.exists():
+                    shutil.rmtree(golden)
+                shutil.copytree(transformed, golden)
+                print(f"{'':>10}   Golden copy saved to {golden}")
+            if args.golden is not None:
+                golden = Path(args.golden) / name
+                if not golden.is_dir():
+                    print(f"{'':>10}   No golden copy for {name}")
+                    differences = None
+                else:
+                    differences = compare_to_golden(transformed, golden)
+                    for difference in differences:
+                        print(f"{'':>10}   MISMATCH: {difference}")
+                    if len(differences) == 0:
+                        print(f"{'':>10}   Output matches the golden copy")
+                    mismatches += len(differences)
+                result['golden_differences'] = differences
+        results.append(result)
+
+    if args.json is not None:
+        with open(args.json, 'wt') as f:
+            json.dump({'settings': vars(args), 'results': results}, f, indent=2)
+        print(f"Results written to {args.json}")
+
+    if mismatches > 0:
+        raise SystemExit(f"{mismatches} difference(s) from the golden copies")
@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+
+"""Write a synthetic HTP dataset (and it's dataset config) for 01-transform.py
+
+    scripts/generate-synthetic-htp.py -o synthetic/100k --participants 100000
+    scripts/01-transform.py -d synthetic/100k/dataset.yaml
+"""
+
+from argparse import ArgumentParser
+
+from include_transform.synthetic import generate_dataset
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("-o", "--out", required=True, help="Directory the dataset is written to")
+    parser.add_argument("--participants", type=int, default=10000, help="Number of participants (default 10000)")
+    parser.add_argument("--conditions", type=int, default=5, help="Conditions recorded for each participant (default 5)")
+    parser.add_argument("--visits", type=int, default=2, help="Encounters for each participant (default 2)")
+    parser.add_argument("--consent-groups", type=int, default=1, help="Number of consent groups the participants are split across (default 1)")
+    parser.add_argument("--condition-vars", type=int, default=100, help="Distinct condition variables in the dictionaries (default 100)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed (default 0)")
+    parser.add_argument("--wide", action='store_true', help="Write official style (wide) HTP CSVs rather than the long participant/condition files")
+    args = parser.parse_args()
+
+    config = generate_dataset(args.out,
+                args.participants,
+                conditions_per=args.conditions,
+                visits=args.visits,
+                consent_groups=args.consent_groups,
+                condition_count=args.condition_vars,
+                seed=args.seed,
+                wide=args.wide)
+    print(f"Dataset config written to {config}")
@@ -18,5 +18,11 @@ setup(
     packages=find_packages(),
     include_package_data=True,
     install_requires=requirements,
-    scripts=["scripts/01-transform.py", "scripts/02-load.py"],
+    scripts=[
+        "scripts/01-transform.py",
+        "scripts/02-load.py",
+        "scripts/benchmark-load.py",
+        "scripts/benchmark-transform.py",
+        "scripts/generate-synthetic-htp.py"
+    ],
 )
@@ -0,0 +1,92 @@
+import pytest
+
+from include_load.batch import BatchSubmitter, resource_request
+from include_load.fhir_session import FhirResponse
+
+def patient(pid, bad=False):
+    body = {"resourceType": "Patient", "identifier": [{"system": "https://example.org/pid", "value": pid}]}
+    if bad:
+        body['gender'] = "not a gender"
+    return (pid, body)
+
+class TransactionServer:
+    """Stands in for the session. Transactions holding a bad Patient are
+    rejected outright, and the first few bundles (fail_first) fail with a
+    503"""
+    def __init__(self, fail_first=0):
+        self.fail_first = fail_first
+        self.bundles = []
+        self.created = []
+
+    def post(self, path, bundle):
+        entries = bundle['entry']
+        self.bundles.append([entry['resource']['identifier'][0]['value'] for entry in entries])
+        if self.fail_first > 0:
+            self.fail_first -= 1
+            return FhirResponse(503, {"resourceType": "OperationOutcome"})
+        if any(entry['resource'].get('gender') == "not a gender" for entry in entries):
+            return FhirResponse(400, {"resourceType": "OperationOutcome"})
+
+        responses = []
+        for entry in entries:
+            self.created.append(entry['resource']['identifier'][0]['value'])
+            responses.append({"response": {"status": "201 Created", "location": f"Patient/{len(self.created)}/_history/1"}})
+        return FhirResponse(200, {"resourceType": "Bundle", "type": "transaction-response", "entry": responses})
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch):
+    monkeypatch.setattr("include_load.batch.time.sleep", lambda seconds: None)
+
+def test_failed_transaction_is_split_to_find_the_bad_resource():
+    server = TransactionServer()
+    submitter = BatchSubmitter(server, batch_size=4, bundle_type='transaction')
+    results = {}
+    entries = [patient('p1'), patient('p2'), patient('p3', bad=True), patient('p4')]
+
+    submitted, failed = submitter.submit('patient', entries, results.__setitem__)
+
+    assert (submitted, failed) == (3, 1)
+    assert sorted(results) == ['p1', 'p2', 'p4']
+    assert sorted(server.created) == ['p1', 'p2', 'p4']
+    # The whole transaction, then each half, then each half of the bad half
+    assert server.bundles == [['p1', 'p2', 'p3', 'p4'], ['p1', 'p2'], ['p3', 'p4'], ['p3'], ['p4']]
+
+def test_retriable_failure_is_split_in_half_and_retried():
+    server = TransactionServer(fail_first=1)
+    submitter = BatchSubmitter(server, batch_size=4, bundle_type='transaction')
+    results = {}
+    entries = [patient('p1'), patient('p2'), patient('p3'), patient('p4')]
+
+    submitted, failed = submitter.submit('patient', entries, results.__setitem__)
+
+    assert (submitted, failed) == (4, 0)
+    assert server.bundles == [['p1', 'p2', 'p3', 'p4'], ['p1', 'p2'], ['p3', 'p4']]
+    assert sorted(results.values(), key=int) == ['1', '2', '3', '4']
+
+def test_gives_up_after_max_retries():
+    server = TransactionServer(fail_first=100)
+    submitter = BatchSubmitter(server, batch_size=2, bundle_type='transaction', max_retries=2)
+
+    submitted, failed = submitter.submit('patient', [patient('p1'), patient('p2')], lambda key, target_id: None)
+
+    assert (submitted, failed) == (0, 2)
+    assert server.created == []
+
+def test_create_without_identifier_is_not_resent():
+    server = TransactionServer(fail_first=1)
+    submitter = BatchSubmitter(server, batch_size=2)
+    entries = [patient('p1'), ('p2', {"resourceType": "Patient", "identifier": [{"value": "p2"}]})]
+
+    submitted, failed = submitter.submit('patient', entries, lambda key, target_id: None)
+
+    assert (submitted, failed) == (1, 1)
+    assert server.created == ['p1']
+
+def test_creates_are_conditional():
+    key, body = patient('p1')
+    assert resource_request(body) == {
+        "method": "POST",
+        "url": "Patient",
+        "ifNoneExist": "identifier=https%3A%2F%2Fexample.org%2Fpid%7Cp1"
+    }
+    assert resource_request(dict(body, id="123")) == {"method": "PUT", "url": "Patient/123"}
@@ -0,0 +1,90 @@
+import pandas as pd
+import pytest
+
+from include_load.bulk_import import BulkImporter, assigned_id
+from include_load.fhir_session import FhirSession
+from include_load.mock_server import MockFhirServer
+from include_load.uid_cache import UidCache
+
+plugin = '''
+class Patient:
+    class_name = 'patient'
+    target_id_concept = 'TARGET_ID'
+
+    @staticmethod
+    def get_key_components(record, get_target_id):
+        return record['pid']
+
+    @staticmethod
+    def build_entity(record, get_target_id):
+        resource = {"resourceType": "Patient", "identifier": [{"system": "https://example.org/pid", "value": record['pid']}]}
+        if record.get('TARGET_ID'):
+            resource['id'] = record['TARGET_ID']
+        return resource
+
+class Observation:
+    class_name = 'observation'
+
+    @staticmethod
+    def get_key_components(record, get_target_id):
+        return (record['pid'], record['value'])
+
+    @staticmethod
+    def build_entity(record, get_target_id):
+        return {
+            "resourceType": "Observation",
+            "identifier": [{"system": "https://example.org/obs", "value": f"{record['pid']}-{record['value']}"}],
+            "subject": {"reference": f"Patient/{get_target_id(Patient, record)}"}
+        }
+
+all_targets = [Patient, Observation]
+'''
+
+study_id = "SD_TEST"
+
+@pytest.fixture
+def plugin_path(tmp_path):
+    path = tmp_path / "plugin.py"
+    path.write_text(plugin)
+    return path
+
+@pytest.fixture
+def server():
+    with MockFhirServer() as server:
+        yield server
+
+def basic_reports():
+    rows = [{'pid': f"p{i}", 'value': value} for i in range(5) for value in ["1", "2"]]
+    return {'default': pd.DataFrame(rows)}
+
+def import_study(tmp_path, plugin_path, server, directory):
+    session = FhirSession(server.base_url)
+    uid_cache = UidCache(tmp_path / "cache", server.base_url, study_id)
+    try:
+        importer = BulkImporter(plugin_path, uid_cache, session, study_id, poll_interval=0.05)
+        outcome = importer.run(['patient', 'observation'], basic_reports(), directory)
+        ids = {pid: uid_cache.get('patient', pid) for pid in [f"p{i}" for i in range(5)]}
+    finally:
+        uid_cache.close()
+        session.close()
+    return outcome, ids
+
+def test_import_round_trip(tmp_path, plugin_path, server):
+    outcome, ids = import_study(tmp_path, plugin_path, server, tmp_path / "import")
+
+    assert outcome == {'patient': (5, 0), 'observation': (10, 0)}
+    assert server.count('Patient') == 5
+    assert server.count('Observation') == 10
+    # Each patient keeps the ID assigned to it, and the observations point there
+    assert ids['p3'] == assigned_id(study_id, 'patient', 'p3')
+    assert set(server.resources['Patient']) == set(ids.values())
+    references = {obs['subject']['reference'] for obs in server.resources['Observation'].values()}
+    assert references == {f"Patient/{target_id}" for target_id in ids.values()}
+
+def test_importing_again_updates_in_place(tmp_path, plugin_path, server):
+    first, ids = import_study(tmp_path, plugin_path, server, tmp_path / "first")
+    second, ids_again = import_study(tmp_path, plugin_path, server, tmp_path / "second")
+
+    assert second == first
+    assert ids_again == ids
+    assert server.count() == 15
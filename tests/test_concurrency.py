@@ -0,0 +1,52 @@
+from include_load.adaptive import AdaptiveSubmitter
+from include_load.concurrency import AimdLimiter
+from include_load.fhir_session import FhirSession
+from include_load.mock_server import MockFhirServer
+
+def respond(limiter, status, latency=0.01):
+    limiter.acquire()
+    limiter.release(latency, status)
+
+def test_backs_off_on_429():
+    limiter = AimdLimiter(floor=2, ceiling=32, initial=16)
+    respond(limiter, 429)
+    assert limiter.current_limit() == 8
+    assert limiter.stats()['throttled'] == 1
+
+def test_never_drops_below_the_floor():
+    limiter = AimdLimiter(floor=2, ceiling=32, initial=4)
+    for attempt in range(10):
+        limiter.last_decrease = 0.0
+        respond(limiter, 429)
+    assert limiter.current_limit() == 2
+
+def test_climbs_back_after_successes():
+    limiter = AimdLimiter(floor=1, ceiling=4, initial=1)
+    for response in range(20):
+        respond(limiter, 200)
+    assert limiter.current_limit() == 4
+
+def test_errors_back_off_too():
+    limiter = AimdLimiter(floor=1, ceiling=32, initial=10)
+    respond(limiter, 0)
+    assert limiter.current_limit() == 5
+    assert limiter.stats()['errors'] == 1
+
+def test_throttled_requests_against_the_mock_server():
+    entries = [(f"p{i}", {"resourceType": "Patient", "identifier": [{"system": "https://example.org/pid", "value": f"p{i}"}]})
+                for i in range(60)]
+    limiter = AimdLimiter(floor=1, ceiling=16, initial=16)
+    results = {}
+
+    with MockFhirServer(throttle_rate=0.3, retry_after=0, seed=7) as server:
+        session = FhirSession(server.base_url)
+        submitted, failed = AdaptiveSubmitter(session, limiter, max_retries=10).submit('patient', entries, results.__setitem__)
+        session.close()
+        assert server.count('Patient') == 60
+
+    stats = limiter.stats()
+    assert (submitted, failed) == (60, 0)
+    assert len(set(results.values())) == 60
+    assert stats['throttled'] > 0
+    assert stats['retries'] == stats['throttled']
+    assert stats['limit'] < 16
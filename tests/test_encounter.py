@@ -0,0 +1,75 @@
+import csv
+import io
+
+import pytest
+
+from include_transform.encounter import Encounter, write_measurements_columnar, columnar_supported
+
+def rowwise(filename, study, only=None):
+    out = io.StringIO()
+    writer = csv.writer(out, delimiter='\t')
+    with open(filename, 'rt', encoding='utf-8-sig') as f:
+        for line in csv.DictReader(f, delimiter='\t'):
+            enc = Encounter(line)
+            if only is None or enc.id in only:
+                enc.write_measurements(study, writer)
+    return out.getvalue()
+
+def columnar(filename, study, only=None, chunksize=2):
+    out = io.StringIO()
+    writer = csv.writer(out, delimiter='\t')
+    write_measurements_columnar(filename, study, writer, chunksize=chunksize, only=only)
+    return out.getvalue()
+
+def write_tsv(path, lines):
+    path.write_text("\n".join("\t".join(line) for line in lines) + "\n")
+    return str(path)
+
+@pytest.fixture
+def encounters(tmp_path):
+    return write_tsv(tmp_path / "encounters.tsv", [
+        ['participantid', 'event_name', 'age_at_visit', 'labid', 'height_cm', 'weight_kg', 'bmi'],
+        ['p1', 'Visit 1', '10', '007', '100', 'NA', ' '],
+        ['p2', 'Visit 2', '', '', ' NA ', '30.50', '12'],
+        ['p3', 'Visit 3', '5', 'L3', '', '', ''],
+        ['p1', 'Visit 4', '11', '008', '101.0', '31', 'NA'],
+        ['p4', 'Visit 1', '7', 'L4', '95', '20', '22.1'],
+    ])
+
+def test_columnar_matches_rowwise(encounters):
+    expected = rowwise(encounters, 'Study')
+    assert expected != ""
+    assert columnar(encounters, 'Study') == expected
+
+def test_columnar_keeps_values_as_written(encounters):
+    written = columnar(encounters, 'Study')
+    assert '\t007\t' in written
+    assert '\t30.50\t' in written
+    assert '\t101.0\t' in written
+
+def test_columnar_matches_rowwise_for_some_participants(encounters):
+    only = {'p1', 'p4'}
+    assert columnar(encounters, 'Study', only=only) == rowwise(encounters, 'Study', only=only)
+
+def test_missing_optional_columns(tmp_path):
+    encounters = write_tsv(tmp_path / "encounters.tsv", [
+        ['participantid', 'event_name', 'height_cm'],
+        ['p1', 'Visit 1', '100'],
+        ['p2', 'Visit 2', 'NA'],
+    ])
+    expected = rowwise(encounters, 'Study')
+    assert expected != ""
+    assert columnar(encounters, 'Study') == expected
+
+def test_missing_required_column(tmp_path):
+    encounters = write_tsv(tmp_path / "encounters.tsv", [
+        ['participantid', 'height_cm'],
+        ['p1', '100'],
+    ])
+    with pytest.raises(KeyError):
+        columnar(encounters, 'Study')
+
+def test_maps_fall_back_to_rowwise():
+    assert columnar_supported({'encounter': 'encounters.tsv'})
+    assert not columnar_supported({'encounter': 'encounters.tsv', 'field_map': 'fields.yaml'})
+    assert not columnar_supported({'encounter': 'encounters.tsv', 'invalid-ids': 'invalid.txt'})
@@ -0,0 +1,112 @@
+import pandas as pd
+import pytest
+
+from include_load.batch import BatchSubmitter
+from include_load.fanout import FanOutLoader
+from include_load.fhir_session import FhirSession
+from include_load.journal import LoadJournal
+from include_load.loader import ResourceLoader
+from include_load.mock_server import MockFhirServer
+from include_load.uid_cache import UidCache
+
+plugin = '''
+class Patient:
+    class_name = 'patient'
+    target_id_concept = 'TARGET_ID'
+
+    @staticmethod
+    def get_key_components(record, get_target_id):
+        return record['pid']
+
+    @staticmethod
+    def build_entity(record, get_target_id):
+        resource = {"resourceType": "Patient", "identifier": [{"system": "https://example.org/pid", "value": record['pid']}]}
+        if record.get('TARGET_ID'):
+            resource['id'] = record['TARGET_ID']
+        return resource
+
+class Observation:
+    class_name = 'observation'
+
+    @staticmethod
+    def get_key_components(record, get_target_id):
+        return (record['pid'], record['value'])
+
+    @staticmethod
+    def build_entity(record, get_target_id):
+        if record['value'] == "broken":
+            raise ValueError("Can't build that")
+        return {
+            "resourceType": "Observation",
+            "identifier": [{"system": "https://example.org/obs", "value": f"{record['pid']}-{record['value']}"}],
+            "subject": {"reference": f"Patient/{get_target_id(Patient, record)}"}
+        }
+
+all_targets = [Patient, Observation]
+'''
+
+study_id = "SD_TEST"
+
+@pytest.fixture
+def plugin_path(tmp_path):
+    path = tmp_path / "plugin.py"
+    path.write_text(plugin)
+    return path
+
+def reports(values):
+    rows = [{'pid': f"p{i}", 'value': value} for i in range(7) for value in values]
+    return {'default': pd.DataFrame(rows)}
+
+class Environment:
+    def __init__(self, tmp_path, name, plugin_path):
+        self.server = MockFhirServer().start()
+        self.session = FhirSession(self.server.base_url)
+        self.uid_cache = UidCache(tmp_path / name, self.server.base_url, study_id)
+        self.journal = LoadJournal(tmp_path / name, study_id)
+        self.loader = ResourceLoader(plugin_path, self.uid_cache, BatchSubmitter(self.session, batch_size=4),
+                    journal=self.journal, label=name)
+
+    def close(self):
+        self.journal.close()
+        self.uid_cache.close()
+        self.session.close()
+        self.server.stop()
+
+@pytest.fixture
+def environments(tmp_path, plugin_path):
+    envs = {name: Environment(tmp_path, name, plugin_path) for name in ['dev', 'qa']}
+    yield envs
+    for env in envs.values():
+        env.close()
+
+def fan_out(plugin_path, environments):
+    # A tiny chunk size, so each class is handed over in several chunks
+    return FanOutLoader(plugin_path, {name: env.loader for name, env in environments.items()}, chunk_size=3)
+
+def test_every_environment_gets_every_chunk(plugin_path, environments):
+    outcome = fan_out(plugin_path, environments).run(['patient', 'observation'], reports(["1", "2"]))
+
+    for name, env in environments.items():
+        assert outcome[name] == {'patient': (7, 0), 'observation': (14, 0)}
+        assert env.server.count('Patient') == 7
+        assert env.server.count('Observation') == 14
+        patient_id = env.uid_cache.get('patient', 'p3')
+        references = {obs['subject']['reference'] for obs in env.server.resources['Observation'].values()}
+        assert f"Patient/{patient_id}" in references
+
+def test_a_loaded_environment_doesnt_hold_up_the_rest(plugin_path, environments):
+    environments['qa'].journal.complete('patient')
+
+    outcome = fan_out(plugin_path, environments).load_class('patient', reports(["1"]))
+
+    assert outcome == {'dev': (7, 0), 'qa': (0, 0)}
+    assert environments['qa'].server.count('Patient') == 0
+
+def test_a_failed_build_doesnt_complete_the_class(plugin_path, environments):
+    loader = fan_out(plugin_path, environments)
+    loader.load_class('patient', reports(["1"]))
+
+    with pytest.raises(ValueError):
+        loader.load_class('observation', reports(["1", "2", "broken"]))
+    for env in environments.values():
+        assert not env.journal.is_complete('observation')
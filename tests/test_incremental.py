@@ -0,0 +1,59 @@
+from include_transform.incremental import ParticipantHashes, hash_participants
+
+def write_tsv(path, lines):
+    path.write_text("\n".join("\t".join(line) for line in lines) + "\n")
+    return str(path)
+
+def consent_group(tmp_path, participants, conditions, weights):
+    return {
+        'participant': write_tsv(tmp_path / "participants.tsv", [['participantid', 'sex']] + participants),
+        'condition': write_tsv(tmp_path / "conditions.tsv", [['participantid', 'condition_code']] + conditions),
+        'ds_condition': write_tsv(tmp_path / "ds_conditions.tsv", [['participantid', 'karyotype']]),
+        'encounter': write_tsv(tmp_path / "encounters.tsv", [['participantid', 'event_name', 'weight_kg']] + weights)
+    }
+
+def changeset(tmp_path, consent, dictionary_key="dd1"):
+    hashes = ParticipantHashes(str(tmp_path / "hashes.db"))
+    hashes.add('GRU', hash_participants(consent, '\t', dictionary_key=dictionary_key, chunk_size=2))
+    changed = hashes.write_changeset(tmp_path / "changeset")
+    hashes.commit()
+    hashes.close()
+    return changed
+
+def listed(tmp_path, change):
+    lines = (tmp_path / "changeset" / f"{change}.tsv").read_text().splitlines()
+    return [line.split("\t")[0] for line in lines[1:]]
+
+def test_changes_between_runs(tmp_path):
+    consent = consent_group(tmp_path,
+            [['A', 'Male'], ['B', 'Female'], ['C', 'Female']],
+            [['A', 'HP:1'], ['B', 'HP:2']],
+            [['C', 'Visit 1', '20']])
+    assert changeset(tmp_path, consent) == {'A', 'B', 'C'}
+
+    consent = consent_group(tmp_path,
+            [['A', 'Male'], ['C', 'Female'], ['D', 'Male']],
+            [['A', 'HP:1'], ['B', 'HP:2']],
+            [['C', 'Visit 1', '21']])
+    assert changeset(tmp_path, consent) == {'C', 'D'}
+    assert listed(tmp_path, 'added') == ['D']
+    assert listed(tmp_path, 'modified') == ['C']
+    assert listed(tmp_path, 'removed') == ['B']
+
+def test_rows_without_a_participant_are_not_changes(tmp_path):
+    consent = consent_group(tmp_path,
+            [['A', 'Male']],
+            [['A', 'HP:1'], ['Z', 'HP:2']],
+            [['Y', 'Visit 1', '20']])
+    assert changeset(tmp_path, consent) == {'A'}
+    assert listed(tmp_path, 'added') == ['A']
+
+def test_dictionary_change_modifies_everyone(tmp_path):
+    consent = consent_group(tmp_path,
+            [['A', 'Male'], ['B', 'Female']],
+            [['A', 'HP:1']],
+            [])
+    changeset(tmp_path, consent)
+    assert changeset(tmp_path, consent) == set()
+    assert changeset(tmp_path, consent, dictionary_key="dd2") == {'A', 'B'}
+    assert listed(tmp_path, 'modified') == ['A', 'B']
@@ -0,0 +1,43 @@
+import runpy
+from pathlib import Path
+
+import pytest
+from yaml import safe_load
+
+from cmg_transform.change_logger import ChangeLog
+from include_transform.cde_conversions import CdeVar
+from include_transform.synthetic import generate_dataset
+from include_transform.tables import TableSet, transformed_tables
+
+@pytest.fixture(scope="module")
+def transform():
+    """01-transform.py can't be imported by name, so it's loaded by path"""
+    return runpy.run_path(str(Path(__file__).parent.parent / "scripts" / "01-transform.py"), run_name="transform")
+
+@pytest.fixture(scope="module")
+def dataset(tmp_path_factory):
+    return generate_dataset(tmp_path_factory.mktemp("synthetic"), 40, conditions_per=4, visits=2, consent_groups=2, condition_count=20, seed=3)
+
+def run(transform, dataset_file, out, **run_args):
+    """The transformed tables (as DataFrames) for the dataset"""
+    dataset = safe_load(open(dataset_file))
+    study_name = dataset['study_name'].replace(' ', '_')
+    out.mkdir(parents=True)
+
+    ChangeLog.InitDB(str(out), study_name, purge_priors=True)
+    try:
+        cde = CdeVar(dataset['dict_merge'], dataset['mcd'], dataset['merge_col'])
+        with TableSet(out, write_files=False, keep_in_memory=True) as tables:
+            transform['Run'](out, study_name, dataset, cde, tables=tables, **run_args)
+    finally:
+        ChangeLog.Close()
+    return tables.frames()
+
+def test_streaming_matches_in_memory(transform, dataset, tmp_path):
+    expected = run(transform, dataset, tmp_path / "memory")
+    # A tiny chunk size, so the external sort spills several runs to disk
+    streamed = run(transform, dataset, tmp_path / "stream", stream=True, chunk_size=7, tmpdir=str(tmp_path))
+
+    for name in transformed_tables:
+        assert len(expected[name]) > 0, name
+        assert streamed[name].equals(expected[name]), name
@@ -0,0 +1,112 @@
+import time
+
+from include_transform.cde_conversions import CdeVar
+from include_transform.synthetic import condition_vars, write_dictionaries
+from include_transform.terms import TermCache, TermResolver, TermLookupSource, StubTermSource, transform_codes, write_term_details
+
+hpo = "http://purl.obolibrary.org/obo/hp.owl"
+
+def write_stub(path, terms):
+    with open(path, 'wt') as f:
+        f.write("system\tcode\tdisplay\n")
+        for system, code, display in terms:
+            f.write(f"{system}\t{code}\t{display}\n")
+    return str(path)
+
+def test_stub_lookups_are_cached_for_offline_runs(tmp_path):
+    stub = StubTermSource(write_stub(tmp_path / "terms.tsv", [
+        (hpo, "HP:0001631", "Atrial septal defect"),
+        (hpo, "HP:0000001", "")
+    ]))
+    keys = [(hpo, "HP:0001631"), (hpo, "HP:0000001"), (hpo, "HP:9999999")]
+
+    resolver = TermResolver(TermCache(tmp_path / "cache.db"), source=stub, batch_size=1, workers=2)
+    resolved = resolver.resolve(keys)
+    resolver.close()
+    assert resolved == {
+        (hpo, "HP:0001631"): "Atrial septal defect",
+        (hpo, "HP:0000001"): None,
+        (hpo, "HP:9999999"): None
+    }
+    assert resolver.remote_calls == 3
+
+    # No source at all, so everything comes from the cache
+    offline = TermResolver(TermCache(tmp_path / "cache.db"))
+    assert offline.resolve(keys) == resolved
+    assert (offline.cache_hits, offline.remote_calls) == (3, 0)
+    offline.close()
+
+def test_offline_without_cache_resolves_nothing(tmp_path):
+    resolver = TermResolver(TermCache(tmp_path / "cache.db"))
+    assert resolver.resolve([(hpo, "HP:0001631")]) == {}
+    resolver.close()
+
+def test_expired_terms_are_looked_up_again(tmp_path):
+    cache = TermCache(tmp_path / "cache.db", ttl_days=1)
+    cache.store({(hpo, "HP:0001631"): "Atrial septal defect"}, now=time.time() - 2 * 24 * 60 * 60)
+    assert cache.lookup([(hpo, "HP:0001631")]) == {}
+    assert cache.evict() == 1
+    cache.close()
+
+def test_eviction_trims_both_tables(tmp_path):
+    cache = TermCache(tmp_path / "cache.db", max_entries=2)
+    for index in range(4):
+        cache.store({(hpo, f"HP:{index}"): f"Term {index}"}, now=1000 + index)
+        cache.save({('hp', f"HP:{index}"): {'display': f"Term {index}"}}, now=1000 + index)
+    cache.evict(now=1010)
+
+    assert len(cache) == 2
+    seeded = {}
+    cache.seed(seeded, now=1010)
+    assert sorted(seeded) == [('hp', "HP:2"), ('hp', "HP:3")]
+    cache.close()
+
+class FakeTermLookup:
+    """Notices if pull_details is ever called from two threads at once"""
+    def __init__(self):
+        self.active = 0
+        self.overlapped = False
+        self.cache = {}
+
+    def pull_details(self, system, code):
+        self.active += 1
+        if self.active > 1:
+            self.overlapped = True
+        time.sleep(0.01)
+        self.cache[(system, code)] = {'display': f"Display of {code}"}
+        self.active -= 1
+        return self.cache[(system, code)]
+
+def test_term_lookup_calls_are_serialised(tmp_path):
+    term_lookup = FakeTermLookup()
+    resolver = TermResolver(TermCache(tmp_path / "cache.db"), source=TermLookupSource(term_lookup), workers=8)
+    resolved = resolver.resolve([(hpo, f"HP:{index}") for index in range(16)])
+    resolver.close()
+
+    assert not term_lookup.overlapped
+    assert len(term_lookup.cache) == 16
+    assert resolved[(hpo, "HP:3")] == "Display of HP:3"
+
+def test_term_details(tmp_path):
+    codes = {(hpo, "HP:1"): "one", (hpo, "HP:2"): "two", (hpo, "HP:3"): "three"}
+    resolved = {(hpo, "HP:1"): "One", (hpo, "HP:2"): None}
+    unknown = write_term_details(tmp_path / "term_details.csv", codes, resolved)
+
+    assert unknown == [(hpo, "HP:2")]
+    lines = (tmp_path / "term_details.csv").read_text().splitlines()
+    assert lines[1:] == [f"{hpo},HP:1,one,One,ok", f"{hpo},HP:2,two,,unknown", f"{hpo},HP:3,three,,unresolved"]
+
+def test_displays_name_the_condition_rows(tmp_path):
+    conditions = condition_vars(3)
+    cde = CdeVar(*write_dictionaries(tmp_path, conditions), 'HTP')
+    htp_var = conditions[0][0]
+    before = cde.condition_rows(htp_var, 'TRUE')
+
+    (system, code), label = next((key, label) for key, label in transform_codes(cde).items() if key[1] == before[0][0][1])
+    cde.use_displays({(system, code): "Resolved display"})
+    after = cde.condition_rows(htp_var, 'TRUE')
+
+    assert before[0][0][4] == label
+    assert after[0][0][4] == "Resolved display"
+    # Codes without a display keep the dictionary's label
+    assert [row[0][4] for row in after[1:]] == [row[0][4] for row in before[1:]]
@@ -0,0 +1,43 @@
+from include_transform.wide import ConsentSections
+
+def write_wide(path, lines):
+    path.write_text("\n".join(",".join(line) for line in lines) + "\n")
+    return str(path)
+
+def test_each_chunk_is_read_once_in_section_order(tmp_path):
+    consent = {
+        'wide': write_wide(tmp_path / "wide.csv", [
+            ['participantid', 'sex', 'karyotype', 'HP:1', 'HP:2'],
+            ['A', 'Male', 'T21', 'TRUE', 'NA'],
+            ['B', 'Female', 'T21', 'FALSE', 'Yes'],
+            ['C', 'Male', '', '', '']
+        ]),
+        'condition_columns': ['HP:1', 'HP:2'],
+        'wide_chunksize': 2
+    }
+    records = list(ConsentSections(consent, ',').records())
+
+    assert [(section, row['participantid']) for section, row in records] == [
+        ('participant', 'A'), ('participant', 'B'),
+        ('condition', 'A'), ('condition', 'B'), ('condition', 'B'),
+        ('ds_condition', 'A'), ('ds_condition', 'B'),
+        ('participant', 'C'),
+        ('ds_condition', 'C')
+    ]
+    conditions = [row for section, row in records if section == 'condition']
+    assert [(row['condition_code'], row['condition_status']) for row in conditions] == [
+        ('HP:1', 'TRUE'), ('HP:1', 'FALSE'), ('HP:2', 'TRUE')
+    ]
+    assert 'HP:1' not in records[0][1]
+    assert records[0][1]['karyotype'] == 'T21'
+
+def test_own_files_wrap_around_the_wide_file(tmp_path):
+    consent = {
+        'participant': write_wide(tmp_path / "participants.tsv", [['participantid\tsex'], ['A\tMale']]),
+        'wide': write_wide(tmp_path / "wide.csv", [['participantid', 'karyotype', 'HP:1'], ['A', 'T21', 'TRUE']]),
+        'condition_pattern': '^HP:'
+    }
+    sections = ConsentSections(consent, '\t')
+
+    assert [section for section, row in sections.records()] == ['participant', 'condition', 'ds_condition']
+    assert sections.filename('condition') == f"{consent['wide']} (condition)"